@@ -0,0 +1,71 @@
+"""
+Compares the legacy code-based upload with the binary upload for sandbox artifacts.
+
+The legacy path base64-encodes the file into Python source that the sandbox has
+to exec. The binary path streams the bytes from memory as the request body.
+Both run against the local stand-in sandbox, peak memory is measured on the
+client with tracemalloc.
+
+Usage:
+    python benchmarks/bench_artifact_upload.py --size-mb 20
+"""
+import io
+import os
+import sys
+import time
+import argparse
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.stub_sandbox import serve  # noqa: E402
+
+
+def measure(fn):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main(args):
+    directory = tempfile.mkdtemp(prefix="sandbox-")
+    server = serve(0, directory)
+    os.environ["SANDBOX_ENDPOINT"] = f"http://127.0.0.1:{server.server_port}"
+
+    from helpers import sandbox_client
+    sandbox_client.SANDBOX_URL = os.environ["SANDBOX_ENDPOINT"]
+
+    payload = os.urandom(int(args.size_mb * 1024 * 1024))
+
+    def legacy():
+        sandbox_client._binary_upload_supported = False
+        try:
+            return sandbox_client.upload_file(io.BytesIO(payload), "legacy.bin", deadline=600)
+        finally:
+            sandbox_client._binary_upload_supported = True
+
+    def binary():
+        return sandbox_client.upload_file(io.BytesIO(payload), "binary.bin", deadline=600)
+
+    print(f"payload={args.size_mb} MB")
+    for name, fn in (("legacy", legacy), ("binary", binary)):
+        times, peaks = [], []
+        for _ in range(args.repeat):
+            files, elapsed, peak = measure(fn)
+            times.append(elapsed)
+            peaks.append(peak)
+        print(f"{name:>7}: files={files} best={min(times) * 1000:.0f}ms peak_client_memory={max(peaks) / 1024 / 1024:.1f}MB")
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=float, default=20)
+    parser.add_argument("--repeat", type=int, default=3)
+    main(parser.parse_args())
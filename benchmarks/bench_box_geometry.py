@@ -0,0 +1,73 @@
+"""
+Compares the per-box Python checks with the vectorized box geometry engine.
+
+Random detections are related to random target areas, the Python loop checks
+each box against each area with the original is_inside/is_overlapping helpers.
+
+Usage:
+    python benchmarks/bench_box_geometry.py --boxes 1000 5000 20000 --regions 50
+"""
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tools.box_geometry import analyze, box_statuses, region_summary  # noqa: E402
+
+
+def is_inside(box, target_area_box):
+    x1, y1, x2, y2 = box
+    gx1, gy1, gx2, gy2 = target_area_box
+    return gx1 <= x1 and gy1 <= y1 and gx2 >= x2 and gy2 >= y2
+
+
+def is_overlapping(box, target_area_box):
+    x1, y1, x2, y2 = box
+    gx1, gy1, gx2, gy2 = target_area_box
+    return not (x2 < gx1 or x1 > gx2 or y2 < gy1 or y1 > gy2)
+
+
+def random_boxes(rng, count, max_size):
+    corners = rng.integers(0, 4000, size=(count, 2))
+    sizes = rng.integers(10, max_size, size=(count, 2))
+    return np.hstack([corners, corners + sizes]).tolist()
+
+
+def loop(boxes, regions):
+    return [[(is_inside(box, region), is_overlapping(box, region)) for region in regions] for box in boxes]
+
+
+def vectorized(boxes, regions, labels):
+    inside, overlapping, iou_matrix = analyze(boxes, regions)
+    box_statuses(inside, overlapping)
+    return region_summary(labels, regions, inside, overlapping, iou_matrix)
+
+
+def main(args):
+    rng = np.random.default_rng(0)
+    regions = random_boxes(rng, args.regions, 1500)
+    for count in args.boxes:
+        boxes = random_boxes(rng, count, 300)
+        labels = [f"item {i % 20}" for i in range(count)]
+
+        start = time.perf_counter()
+        loop(boxes, regions)
+        python_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        vectorized(boxes, regions, labels)
+        numpy_time = time.perf_counter() - start
+
+        print(f"boxes={count:>6} regions={args.regions:>4} python={python_time:8.4f}s "
+              f"numpy={numpy_time:8.4f}s speedup={python_time / numpy_time:6.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--boxes", type=int, nargs="+", default=[1000, 5000, 20000])
+    parser.add_argument("--regions", type=int, default=50)
+    main(parser.parse_args())
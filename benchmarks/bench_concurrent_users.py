@@ -0,0 +1,96 @@
+"""
+Measures /prompt latency when many new users arrive at once.
+
+The real agent is replaced with a stand-in whose construction blocks for
+--build-ms (like get_agent() does) and whose single step awaits for --chat-ms, so the
+numbers reflect the server's locking and scheduling rather than the model.
+
+Usage:
+    python benchmarks/bench_concurrent_users.py --users 100
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+
+
+class FakeMemory:
+    def reset(self):
+        pass
+
+    def get_all(self):
+        return []
+
+
+class FakeTask:
+    def __init__(self, task_id):
+        self.task_id = task_id
+        self.extra_state = {}
+
+
+class FakeStepOutput:
+    is_last = True
+
+
+class FakeAgent:
+    """Answers in a single step through the task/step API core.chat_turn drives."""
+
+    def __init__(self, chat_seconds):
+        self.memory = FakeMemory()
+        self.chat_seconds = chat_seconds
+        self._task_ids = 0
+
+    def create_task(self, message):
+        self._task_ids += 1
+        return FakeTask(str(self._task_ids))
+
+    async def arun_step(self, task_id):
+        await asyncio.sleep(self.chat_seconds)
+        return FakeStepOutput()
+
+    def finalize_response(self, task_id, step_output):
+        return "ok"
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def run(args):
+    def fake_get_agent():
+        time.sleep(args.build_ms / 1000)
+        return FakeAgent(args.chat_ms / 1000)
+
+    server.get_agent = fake_get_agent
+
+    client = server.app.test_client()
+
+    async def one_user(i):
+        start = time.perf_counter()
+        response = await client.post("/prompt", json={"prompt": "hi", "user_id": f"bench-{i}", "channel_id": "bench"})
+        assert response.status_code == 200, await response.get_data()
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    latencies = await asyncio.gather(*(one_user(i) for i in range(args.users)))
+    wall = time.perf_counter() - start
+
+    print(f"users={args.users} build={args.build_ms}ms chat={args.chat_ms}ms")
+    print(f"wall={wall * 1000:.0f}ms p50={statistics.median(latencies) * 1000:.0f}ms "
+          f"p99={percentile(latencies, 99) * 1000:.0f}ms max={max(latencies) * 1000:.0f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--build-ms", type=float, default=50)
+    parser.add_argument("--chat-ms", type=float, default=500)
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,69 @@
+"""
+Compares sending an email to many recipients one call at a time with Graph $batch.
+
+The legacy path is what the agent did before, one send_email_message call and
+one sendMail request per recipient. The batched path sends every copy in $batch
+requests of up to 20 over the pooled client. Both run against the local
+stand-in Graph with a simulated network round trip.
+
+Usage:
+    python benchmarks/bench_graph_batch.py --recipients 40 --latency-ms 50
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.stub_graph import serve, GraphHandler  # noqa: E402
+
+
+def main(args):
+    server = serve(0)
+    base = f"http://127.0.0.1:{server.server_port}"
+    os.environ["GRAPH_API_URL"] = f"{base}/v1.0"
+    os.environ["DATABASE_PATH"] = os.path.join(tempfile.mkdtemp(prefix="mail-"), "bench.db")
+
+    handle = GraphHandler.handle_one_request
+
+    def delayed(self):
+        time.sleep(args.latency_ms / 1000)
+        handle(self)
+    GraphHandler.handle_one_request = delayed
+
+    from helpers.database import init_db, ensure_user, save_user_tokens
+    from tools import email_tools
+
+    init_db()
+    ensure_user("bench-user", "bench")
+    save_user_tokens("bench-user", "bench@example.com", "bench-token")
+    recipients = [f"person{i}@example.com" for i in range(args.recipients)]
+    loop = asyncio.new_event_loop()
+
+    def legacy():
+        for address in recipients:
+            email_tools.send("bench-user", "Report", address, "<p>Report</p>")
+
+    def batched():
+        loop.run_until_complete(email_tools.asend("bench-user", "Report", recipients, "<p>Report</p>", True))
+
+    print(f"recipients={args.recipients} latency={args.latency_ms}ms")
+    for name, fn in (("legacy", legacy), ("batched", batched)):
+        before = len(GraphHandler.mailbox.sent)
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        print(f"{name:>8}: sent={len(GraphHandler.mailbox.sent) - before} time={elapsed * 1000:.0f}ms")
+
+    loop.close()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--recipients", type=int, default=40)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    main(parser.parse_args())
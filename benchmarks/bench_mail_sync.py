@@ -0,0 +1,74 @@
+"""
+Compares re-reading the mailbox head with the delta-synced mailbox cache.
+
+The legacy path lists the newest messages with their full bodies on every read.
+The synced path reads from the local cache after one delta call that returns
+only what changed. Both run against the local stand-in Graph, a few new messages
+arrive between reads.
+
+Usage:
+    python benchmarks/bench_mail_sync.py --messages 2000 --reads 10 --emails 25
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.stub_graph import serve, INBOX  # noqa: E402
+
+
+def main(args):
+    server = serve(0, args.messages)
+    base = f"http://127.0.0.1:{server.server_port}"
+    os.environ["GRAPH_API_URL"] = f"{base}/v1.0"
+    os.environ["DATABASE_PATH"] = os.path.join(tempfile.mkdtemp(prefix="mail-"), "bench.db")
+
+    import requests
+    from helpers.database import init_db, ensure_user, save_user_tokens
+    from tools import email_tools
+
+    init_db()
+    ensure_user("bench-user", "bench")
+    save_user_tokens("bench-user", "bench@example.com", "bench-token")
+
+    def legacy():
+        response = requests.get(f"{base}{INBOX}", params={"$top": args.emails},
+                                headers={"Authorization": "Bearer bench-token"})
+        return len(response.json()["value"])
+
+    # The agent calls the tools on the server's event loop, where the Graph client stays pooled
+    loop = asyncio.new_event_loop()
+
+    def synced():
+        return len(loop.run_until_complete(email_tools.aread("bench-user", args.emails)))
+
+    print(f"mailbox={args.messages} messages, {args.reads} reads of {args.emails} emails")
+    for name, fn in (("legacy", legacy), ("synced", synced)):
+        before = requests.get(f"{base}/_stub/stats").json()["endpoints"]
+        times = []
+        for _ in range(args.reads):
+            requests.post(f"{base}/_stub/messages", json={"count": args.new_per_read})
+            start = time.perf_counter()
+            count = fn()
+            times.append(time.perf_counter() - start)
+        after = requests.get(f"{base}/_stub/stats").json()["endpoints"]
+        calls = sum(after[e]["requests"] - before.get(e, {}).get("requests", 0) for e in after)
+        received = sum(after[e]["bytes"] - before.get(e, {}).get("bytes", 0) for e in after)
+        print(f"{name:>7}: emails={count} first={times[0] * 1000:.0f}ms rest_avg={sum(times[1:]) / max(len(times) - 1, 1) * 1000:.0f}ms "
+              f"graph_calls={calls} received={received / 1024:.0f}KB")
+
+    loop.close()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--reads", type=int, default=10)
+    parser.add_argument("--emails", type=int, default=25)
+    parser.add_argument("--new-per-read", type=int, default=2)
+    main(parser.parse_args())
@@ -0,0 +1,129 @@
+"""
+Compares the per-paragraph replacement loop with the indexed replacement engine.
+
+Synthetic documents get one paragraph per replacement entry, spread over a few
+styles, with 1% of the entries deliberately unmatched so the fallback path runs
+too. The legacy loop is O(paragraphs x replacements) and is only run up to
+--legacy-max paragraphs.
+
+Before timing anything, a document with a text box is replaced twice through
+save_replaced() to check that a cached document is left reusable.
+
+Usage:
+    python benchmarks/bench_replace.py --sizes 1000 5000 20000 50000
+"""
+import os
+import io
+import re
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from docx import Document  # noqa: E402
+from docx.oxml import OxmlElement, parse_xml  # noqa: E402
+from docx.oxml.ns import nsdecls, qn  # noqa: E402
+from tools.edit_word_doc import index_paragraphs, apply_replacements, load_document, save_replaced  # noqa: E402
+
+STYLES = ['Normal', 'Heading 1', 'Heading 2', 'List Paragraph']
+
+
+def legacy_replace(paragraphs, replacements):
+    # The replacement loop as it was before the indexed engine
+    for paragraph in paragraphs:
+        full_text = "".join(run.text for run in paragraph.runs).strip()
+        for replacement in replacements:
+            if not paragraph.style or paragraph.style.name != replacement['style']:
+                continue
+            target_alphanumeric = re.sub(r'[^a-zA-Z0-9]', '', replacement['text'].strip())
+            translated_alphanumeric = re.sub(r'[^a-zA-Z0-9]', '', replacement['translated_text'].strip())
+            if target_alphanumeric == re.sub(r'[^a-zA-Z0-9]', '', full_text):
+                remaining_text = replacement['translated_text'].strip()
+                for run in paragraph.runs:
+                    if remaining_text:
+                        run.text = remaining_text[:len(run.text)]
+                        remaining_text = remaining_text[len(run.text):]
+                    else:
+                        run.text = ""
+            else:
+                for run in paragraph.runs:
+                    if run.text:
+                        run.text = re.sub(target_alphanumeric, translated_alphanumeric, run.text)
+
+
+def build(size):
+    doc = Document()
+    # Document.add_paragraph() scans the body on every call, insert before sectPr directly instead
+    sect_pr = doc.element.body.sectPr
+    style_ids = {name: doc.styles[name].style_id for name in STYLES}
+    replacements = []
+    for i in range(size):
+        style = STYLES[i % len(STYLES)]
+        text = f"Clause {i}: the supplier shall deliver item {i * 7} on time."
+        p = OxmlElement('w:p')
+        sect_pr.addprevious(p)
+        p.style = style_ids[style]
+        p.add_r().text = text
+        if i % 100 == 99:
+            text = f"Text the model changed {i}"
+        replacements.append({'style': style, 'text': text, 'translated_text': f"Clausola {i}: tradotto."})
+    return doc, replacements
+
+
+TEXT_BOX_RUN = (
+    f'<w:r {nsdecls("w")} xmlns:v="urn:schemas-microsoft-com:vml"><w:pict><v:shape><v:textbox><w:txbxContent>'
+    '<w:p><w:r><w:t>Box text</w:t></w:r></w:p></w:txbxContent></v:textbox></v:shape></w:pict></w:r>'
+)
+
+
+def paragraph_texts(data):
+    body = Document(io.BytesIO(data)).element.body
+    return ["".join(t.text or '' for t in p.iter(qn('w:t'))) for p in body.iter(qn('w:p'))]
+
+
+def check_cached_edits():
+    # A replacement edits the cached document in place and has to leave it, text boxes included, as it was parsed
+    doc = Document()
+    doc.add_paragraph("Hello anchor")._p.append(parse_xml(TEXT_BOX_RUN))
+    doc.add_paragraph("Other")
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "text_box.docx")
+        doc.save(path)
+        parsed = load_document(path)
+
+    first, second = io.BytesIO(), io.BytesIO()
+    save_replaced(parsed, [{'style': 'Normal', 'text': 'Hello anchor', 'translated_text': 'Ciao ancora'}], first)
+    report = save_replaced(parsed, [{'style': 'Normal', 'text': 'Box text', 'translated_text': 'Testo box'}], second)
+    assert paragraph_texts(first.getvalue()) == ['Ciao ancoraBox text', 'Box text', 'Other']
+    assert report['matched_entries'] == 1
+    assert paragraph_texts(second.getvalue()) == ['Hello anchorTesto box', 'Testo box', 'Other']
+    print("cached document check passed")
+
+
+def main(args):
+    check_cached_edits()
+    for size in args.sizes:
+        doc, replacements = build(size)
+        start = time.perf_counter()
+        report = apply_replacements(index_paragraphs(doc), replacements)
+        indexed = time.perf_counter() - start
+        line = (f"paragraphs={size:>6} indexed={indexed:8.3f}s "
+                f"matched={report['matched_entries']} unmatched={len(report['unmatched_entries'])}")
+
+        if size <= args.legacy_max:
+            doc, replacements = build(size)
+            start = time.perf_counter()
+            legacy_replace(doc.paragraphs, replacements)
+            legacy = time.perf_counter() - start
+            line += f" legacy={legacy:8.3f}s speedup={legacy / indexed:6.1f}x"
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 5000, 20000, 50000])
+    parser.add_argument("--legacy-max", type=int, default=500,
+                        help="Largest document the legacy loop is run on")
+    main(parser.parse_args())
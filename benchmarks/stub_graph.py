@@ -0,0 +1,324 @@
+"""
+Minimal local stand-in for the Microsoft Graph mail endpoints.
+
+    GET  /v1.0/me/mailFolders/inbox/messages/delta  delta query, paged with Prefer: odata.maxpagesize
+    GET  /v1.0/me/mailFolders/inbox/messages        $top newest messages
+    POST /v1.0/me/sendMail                          records the message, answers 202
+    POST /v1.0/$batch                               runs up to 20 sendMail requests, answers per request
+    POST /oauth2/v2.0/token                         refresh_token grant, issues access tokens valid --token-lifetime seconds
+
+Honours $select and the `receivedDateTime ge` filter. Test controls:
+
+    POST   /_stub/messages       {"subject", "from", "bodyPreview"} or {"count": N} adds inbox messages
+    PATCH  /_stub/messages/ID    {"isRead": true, ...} updates a message
+    DELETE /_stub/messages/ID    deletes a message
+    POST   /_stub/throttle       {"count": N} answers the next N batched requests with 429
+    POST   /_stub/tokens         {"issue": true} issues a token pair, {"expire": true} expires the issued
+                                 access tokens, {"revoke": true} revokes the refresh tokens
+    GET    /_stub/stats          requests and response bytes per endpoint, and the sent messages
+
+Usage:
+    python benchmarks/stub_graph.py --port 8766 --messages 2000
+    GRAPH_API_URL=http://localhost:8766/v1.0 OAUTH_TOKEN_URL=http://localhost:8766/oauth2/v2.0/token python ...
+
+Access tokens the stand-in didn't issue are always accepted.
+"""
+import json
+import time
+import argparse
+import threading
+import itertools
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlparse, parse_qs, urlencode
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+DEFAULT_PAGE_SIZE = 10
+INBOX = "/v1.0/me/mailFolders/inbox/messages"
+
+
+class Mailbox:
+    """The stand-in's inbox. Every change gets a version so delta tokens can replay what changed since."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.messages = {}  # id -> message
+        self.versions = {}  # id -> version of its last change
+        self.removed = []  # (version, id)
+        self.version = 0
+        self.rounds = {}  # round id -> (ids to return, version the round started at)
+        self.round_ids = itertools.count(1)
+        self.sent = []
+        self.stats = {}
+        self.throttle = 0
+        self.access_tokens = {}  # issued access token -> expiry
+        self.refresh_tokens = set()
+        self.token_ids = itertools.count(1)
+        self.token_lifetime = 3600
+
+    def issue_tokens(self):
+        with self.lock:
+            n = next(self.token_ids)
+            access_token, refresh_token = f"access-{n}", f"refresh-{n}"
+            self.access_tokens[access_token] = time.time() + self.token_lifetime
+            self.refresh_tokens.add(refresh_token)
+            return {"token_type": "Bearer", "access_token": access_token, "refresh_token": refresh_token,
+                    "expires_in": self.token_lifetime}
+
+    def add(self, subject, sender, preview, received=None):
+        with self.lock:
+            self.version += 1
+            message_id = f"msg-{self.version}"
+            received = received or datetime.now(timezone.utc)
+            self.messages[message_id] = {
+                "id": message_id,
+                "subject": subject,
+                "from": {"emailAddress": {"address": sender}},
+                "receivedDateTime": received.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "bodyPreview": preview,
+                "isRead": False,
+                "body": {"contentType": "html", "content": f"<p>{preview}</p>" * 20},
+            }
+            self.versions[message_id] = self.version
+            return message_id
+
+    def seed(self, count):
+        now = datetime.now(timezone.utc)
+        for i in range(count, 0, -1):
+            self.add(f"Message {i}", f"sender{i % 7}@example.com", f"Preview of message {i}",
+                     now - timedelta(minutes=30 * i))
+
+    def update(self, message_id, fields):
+        with self.lock:
+            if message_id not in self.messages:
+                return False
+            self.version += 1
+            self.messages[message_id].update(fields)
+            self.versions[message_id] = self.version
+            return True
+
+    def delete(self, message_id):
+        with self.lock:
+            if self.messages.pop(message_id, None) is None:
+                return False
+            self.version += 1
+            self.versions.pop(message_id)
+            self.removed.append((self.version, message_id))
+            return True
+
+    def newest(self, since=None):
+        messages = sorted(self.messages.values(), key=lambda m: m["receivedDateTime"], reverse=True)
+        return [m for m in messages if since is None or m["receivedDateTime"] >= since]
+
+    def start_round(self, ids):
+        round_id = next(self.round_ids)
+        self.rounds[round_id] = (ids, self.version)
+        return round_id
+
+
+def select(message, fields):
+    if not fields:
+        return message
+    return {key: value for key, value in message.items() if key in fields or key == "id"}
+
+
+class GraphHandler(BaseHTTPRequestHandler):
+    mailbox = Mailbox()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body=None, endpoint=None):
+        data = json.dumps(body).encode() if body is not None else b""
+        if endpoint:
+            stats = self.mailbox.stats.setdefault(endpoint, {"requests": 0, "bytes": 0})
+            stats["requests"] += 1
+            stats["bytes"] += len(data)
+        self.send_response(status)
+        if data:
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _json_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length)) if length else {}
+
+    def _authorized(self):
+        authorization = self.headers.get("Authorization", "")
+        if not authorization.startswith("Bearer "):
+            self._reply(401, {"error": {"code": "InvalidAuthenticationToken", "message": "Access token is empty."}})
+            return False
+        expires_at = self.mailbox.access_tokens.get(authorization[len("Bearer "):])
+        if expires_at is not None and expires_at < time.time():
+            self._reply(401, {"error": {"code": "InvalidAuthenticationToken", "message": "Lifetime validation failed, the token is expired."}})
+            return False
+        return True
+
+    def _token(self):
+        length = int(self.headers.get("Content-Length", 0))
+        form = parse_qs(self.rfile.read(length).decode())
+        refresh_token = form.get("refresh_token", [""])[0]
+        if form.get("grant_type", [""])[0] != "refresh_token" or refresh_token not in self.mailbox.refresh_tokens:
+            return self._reply(400, {"error": "invalid_grant", "error_description": "The refresh token is invalid."}, "token")
+        with self.mailbox.lock:
+            self.mailbox.refresh_tokens.discard(refresh_token)
+        self._reply(200, self.mailbox.issue_tokens(), "token")
+
+    def _page_size(self):
+        prefer = self.headers.get("Prefer", "")
+        for part in prefer.split(","):
+            name, _, value = part.strip().partition("=")
+            if name == "odata.maxpagesize" and value.isdigit():
+                return int(value)
+        return DEFAULT_PAGE_SIZE
+
+    def _delta(self, query):
+        box = self.mailbox
+        base = f"http://{self.headers.get('Host')}{INBOX}/delta"
+        fields = set(query.get("$select", [""])[0].split(",")) - {""}
+        with box.lock:
+            if "$skiptoken" in query:
+                round_id, offset = (int(value) for value in query["$skiptoken"][0].split(":"))
+                if round_id not in box.rounds:
+                    return self._reply(410, {"error": {"code": "SyncStateNotFound"}}, "delta")
+            elif "$deltatoken" in query:
+                since = int(query["$deltatoken"][0])
+                if since > box.version:
+                    return self._reply(410, {"error": {"code": "SyncStateNotFound"}}, "delta")
+                changed = [m["id"] for m in box.newest() if box.versions[m["id"]] > since]
+                removed = [message_id for version, message_id in box.removed if version > since]
+                round_id, offset = box.start_round(changed + removed), 0
+            else:
+                since = None
+                for expression in query.get("$filter", []):
+                    field, _, value = expression.partition(" ge ")
+                    if field.strip() == "receivedDateTime":
+                        since = value.strip()
+                round_id, offset = box.start_round([m["id"] for m in box.newest(since)]), 0
+
+            ids, started_at = box.rounds[round_id]
+            page = ids[offset:offset + self._page_size()]
+            value = [
+                select(box.messages[message_id], fields) if message_id in box.messages
+                else {"id": message_id, "@removed": {"reason": "deleted"}}
+                for message_id in page
+            ]
+            body = {"value": value}
+            if offset + len(page) < len(ids):
+                body["@odata.nextLink"] = f"{base}?{urlencode({'$skiptoken': f'{round_id}:{offset + len(page)}'})}"
+            else:
+                box.rounds.pop(round_id)
+                body["@odata.deltaLink"] = f"{base}?{urlencode({'$deltatoken': started_at})}"
+        self._reply(200, body, "delta")
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path == "/_stub/stats":
+            return self._reply(200, {"endpoints": self.mailbox.stats, "sent": self.mailbox.sent})
+        if not self._authorized():
+            return
+        if url.path == f"{INBOX}/delta":
+            return self._delta(query)
+        if url.path == INBOX:
+            fields = set(query.get("$select", [""])[0].split(",")) - {""}
+            top = int(query.get("$top", [DEFAULT_PAGE_SIZE])[0])
+            with self.mailbox.lock:
+                value = [select(message, fields) for message in self.mailbox.newest()[:top]]
+            return self._reply(200, {"value": value}, "list")
+        self._reply(404, {"error": {"code": "ResourceNotFound"}})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path == "/_stub/messages":
+            body = self._json_body()
+            if "count" in body:
+                ids = [self.mailbox.add(f"New message {i}", "new@example.com", f"New preview {i}")
+                       for i in range(int(body["count"]))]
+            else:
+                ids = [self.mailbox.add(body.get("subject", ""), body.get("from", ""), body.get("bodyPreview", ""))]
+            return self._reply(200, {"ids": ids})
+        if url.path == "/_stub/throttle":
+            self.mailbox.throttle = int(self._json_body().get("count", 0))
+            return self._reply(200, {})
+        if url.path == "/_stub/tokens":
+            body = self._json_body()
+            with self.mailbox.lock:
+                if body.get("expire"):
+                    self.mailbox.access_tokens = {token: 0 for token in self.mailbox.access_tokens}
+                if body.get("revoke"):
+                    self.mailbox.refresh_tokens.clear()
+            return self._reply(200, self.mailbox.issue_tokens() if body.get("issue") else {})
+        if url.path == "/oauth2/v2.0/token":
+            return self._token()
+        if not self._authorized():
+            return
+        if url.path == "/v1.0/me/sendMail":
+            status, body = self._send_mail(self._json_body())
+            return self._reply(status, body, "sendMail")
+        if url.path == "/v1.0/$batch":
+            requests = self._json_body().get("requests", [])
+            if len(requests) > 20:
+                return self._reply(400, {"error": {"code": "BadRequest", "message": "Too many requests in batch"}}, "batch")
+            return self._reply(200, {"responses": [self._batched(item) for item in requests]}, "batch")
+        self._reply(404, {"error": {"code": "ResourceNotFound"}})
+
+    def _send_mail(self, body):
+        message = body.get("message", {})
+        if not message.get("toRecipients"):
+            return 400, {"error": {"code": "ErrorInvalidRecipients", "message": "At least one recipient is required."}}
+        for recipient in message["toRecipients"]:
+            if "@" not in recipient.get("emailAddress", {}).get("address", ""):
+                return 400, {"error": {"code": "ErrorInvalidRecipients", "message": "Invalid recipient address."}}
+        with self.mailbox.lock:
+            self.mailbox.sent.append(message)
+        return 202, None
+
+    def _batched(self, item):
+        with self.mailbox.lock:
+            throttled = self.mailbox.throttle > 0
+            self.mailbox.throttle -= throttled
+        if throttled:
+            status, body = 429, {"error": {"code": "TooManyRequests"}}
+            return {"id": item["id"], "status": status, "headers": {"Retry-After": "0"}, "body": body}
+        if item.get("method") == "POST" and item.get("url") == "/me/sendMail":
+            status, body = self._send_mail(item.get("body") or {})
+        else:
+            status, body = 404, {"error": {"code": "ResourceNotFound"}}
+        return {"id": item["id"], "status": status, "headers": {}, "body": body}
+
+    def do_PATCH(self):
+        url = urlparse(self.path)
+        if url.path.startswith("/_stub/messages/"):
+            found = self.mailbox.update(url.path.rsplit("/", 1)[1], self._json_body())
+            return self._reply(200 if found else 404, {})
+        self._reply(404, {"error": {"code": "ResourceNotFound"}})
+
+    def do_DELETE(self):
+        url = urlparse(self.path)
+        if url.path.startswith("/_stub/messages/"):
+            found = self.mailbox.delete(url.path.rsplit("/", 1)[1])
+            return self._reply(200 if found else 404, {})
+        self._reply(404, {"error": {"code": "ResourceNotFound"}})
+
+
+def serve(port=0, messages=0, token_lifetime=3600):
+    """Starts the stand-in on a background thread and returns the server, `server.server_port` is the bound port."""
+    GraphHandler.mailbox = Mailbox()
+    GraphHandler.mailbox.token_lifetime = token_lifetime
+    GraphHandler.mailbox.seed(messages)
+    server = ThreadingHTTPServer(("127.0.0.1", port), GraphHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--messages", type=int, default=200, help="Inbox messages to start with, 30 minutes apart")
+    parser.add_argument("--token-lifetime", type=int, default=3600, help="Seconds the issued access tokens are valid")
+    args = parser.parse_args()
+    server = serve(args.port, args.messages, args.token_lifetime)
+    print(f"Stand-in Graph listening on http://127.0.0.1:{server.server_port}/v1.0")
+    threading.Event().wait()
@@ -0,0 +1,76 @@
+"""
+Minimal local stand-in for the sandbox's file endpoints.
+
+    POST /upload       {"code": "..."}  runs the code, like the real sandbox
+    POST /upload_file  ?filename=NAME   saves the raw request body as NAME
+
+Both answer {"output": {"files": [...]}}, files are written to --directory.
+
+Usage:
+    python benchmarks/stub_sandbox.py --port 8765
+    SANDBOX_ENDPOINT=http://localhost:8765 python ...
+"""
+import os
+import json
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class SandboxHandler(BaseHTTPRequestHandler):
+    directory = "/tmp/sandbox"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get("Content-Length", 0))
+        if url.path == "/upload":
+            code = json.loads(self.rfile.read(length))["code"]
+            before = set(os.listdir(self.directory))
+            exec(compile(code.replace("/tmp/sandbox", self.directory), "<upload>", "exec"), {})
+            files = sorted(set(os.listdir(self.directory)) - before)
+            self._reply(200, {"output": {"files": files}})
+        elif url.path == "/upload_file":
+            filename = os.path.basename(parse_qs(url.query).get("filename", ["upload.bin"])[0])
+            with open(os.path.join(self.directory, filename), "wb") as f:
+                while length > 0:
+                    chunk = self.rfile.read(min(CHUNK_SIZE, length))
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    length -= len(chunk)
+            self._reply(200, {"output": {"files": [filename]}})
+        else:
+            self._reply(404, {"error": "not found"})
+
+
+def serve(port=0, directory="/tmp/sandbox"):
+    """Starts the stand-in on a background thread and returns the server, `server.server_port` is the bound port."""
+    os.makedirs(directory, exist_ok=True)
+    SandboxHandler.directory = directory
+    server = ThreadingHTTPServer(("127.0.0.1", port), SandboxHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--directory", default="/tmp/sandbox")
+    args = parser.parse_args()
+    server = serve(args.port, args.directory)
+    print(f"Stand-in sandbox listening on http://127.0.0.1:{server.server_port}")
+    threading.Event().wait()
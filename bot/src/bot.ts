@@ -1,4 +1,4 @@
-import { ActivityHandler, TurnContext } from 'botbuilder';
+import { ActivityHandler, ActivityTypes, TurnContext } from 'botbuilder';
 import axios from 'axios';
 import { DefaultAzureCredential } from '@azure/identity';
 
@@ -24,7 +24,7 @@ class Bot extends ActivityHandler {
 
             try {
                 await context.sendActivity("Processing your request... I'll be with you shortly!");
-                const response = await this.sendToFlaskApp(userMessage, userId, attachments, channelId);
+                const response = await this.sendToFlaskApp(context, userMessage, userId, attachments, channelId);
                 await context.sendActivity(response);
             } catch (error) {
                 console.error('Error in bot interaction:', error);
@@ -35,7 +35,7 @@ class Bot extends ActivityHandler {
         });
     }
 
-    async sendToFlaskApp(userMessage: string, userId: string, attachments: any, channelId: string) {
+    async sendToFlaskApp(context: TurnContext, userMessage: string, userId: string, attachments: any, channelId: string) {
         try {
             let headers = {}
             const tokenCredential = new DefaultAzureCredential();
@@ -46,22 +46,73 @@ class Bot extends ActivityHandler {
                 user_id: userId,
                 attachments: attachments,
                 channel_id: channelId,
+                stream: true,
             }, {
                 headers: headers,
-                timeout: 600000
+                timeout: 600000,
+                responseType: 'stream'
             });
 
-            if (response.data.oauth_url) {
-                // If there's an oauth_url in the response, prompt the user to authenticate
-                return `Please authenticate by clicking the following link: ${response.data.oauth_url}`;
+            // Plain JSON responses (e.g. the "refresh" command) are not streamed
+            if (!String(response.headers['content-type'] || '').includes('ndjson')) {
+                const data = JSON.parse(await this.readAll(response.data));
+                if (data.oauth_url) {
+                    // If there's an oauth_url in the response, prompt the user to authenticate
+                    return `Please authenticate by clicking the following link: ${data.oauth_url}`;
+                }
+                return data.response;
             }
 
-            return response.data.response;
+            return await this.relayStream(context, response.data);
         } catch (error) {
             console.error('Error sending message to Flask:', error);
+            if (error.response && error.response.status === 429) {
+                const retryAfter = error.response.headers['retry-after'];
+                return `I'm handling a lot of requests right now, please try again in ${retryAfter || 'a few'} seconds.`;
+            }
             throw new Error(`Error interacting with Flask app: ${error.message || error}`);
         }
     }
+
+    async readAll(stream: NodeJS.ReadableStream): Promise<string> {
+        let body = '';
+        for await (const chunk of stream) {
+            body += chunk.toString();
+        }
+        return body;
+    }
+
+    // Relays tool progress to the user while the agent works and returns the final answer
+    async relayStream(context: TurnContext, stream: NodeJS.ReadableStream): Promise<string> {
+        let buffer = '';
+        let answer = '';
+        for await (const chunk of stream) {
+            buffer += chunk.toString();
+            let newline: number;
+            while ((newline = buffer.indexOf('\n')) >= 0) {
+                const line = buffer.slice(0, newline).trim();
+                buffer = buffer.slice(newline + 1);
+                if (!line) {
+                    continue;
+                }
+                const event = JSON.parse(line);
+                if (this.debug) {
+                    console.log('Stream event:', event);
+                }
+                if (event.type === 'tool_call') {
+                    await context.sendActivity(`Working on it: using ${event.tool}...`);
+                    await context.sendActivity({ type: ActivityTypes.Typing });
+                } else if (event.type === 'token') {
+                    answer += event.text;
+                } else if (event.type === 'final') {
+                    answer = event.response;
+                } else if (event.type === 'error') {
+                    throw new Error(event.error);
+                }
+            }
+        }
+        return answer;
+    }
 }
 
 export default Bot;
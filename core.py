@@ -1,29 +1,35 @@
 import os
-import asyncio
 import logging
-import requests
+from functools import lru_cache
 from llama_index.llms.bedrock import Bedrock
 from llama_index.llms.bedrock_converse import BedrockConverse
 from llama_index.core.agent import ReActAgent
 from llama_index.llms.deepseek import DeepSeek
 from llama_index.core.tools import FunctionTool
 from llama_index.core.memory import ChatMemoryBuffer
+from llama_index.core.agent.react.types import ActionReasoningStep, ObservationReasoningStep
+from llama_index.core.chat_engine.types import StreamingAgentChatResponse
 from llama_index.llms.azure_openai import AzureOpenAI
 from llama_index.tools.google import GoogleSearchToolSpec
 from llama_index.llms.azure_inference import AzureAICompletionsModel
 # Import helper functions
 from helpers.get_tool_envs import load_envs
+from helpers import sandbox_client
+from helpers.tool_executor import make_async, run_tool, run_async_tool, run_blocking
+from helpers.metrics import observe_tool, instrument_tool, install_llm_metrics, TURN_ITERATIONS
 # Import tools
 from tools.image_recognition import detect_objects
-from tools.direct_line import send_and_receive_message
-from tools.edit_word_doc import map_style_dependencies_with_text, combined_replace
-from tools.email_tools import send, read
+from tools.direct_line import send_and_receive_message, send_and_receive_message_blocking
+from tools.edit_word_doc import map_style_dependencies_with_text, combined_replace, prefetch_document
+from tools.translate_document import translate_document
+from tools.email_tools import send, read, asend, aread
 
 agent_logger = logging.getLogger(__name__)
 agent_logger.setLevel(logging.DEBUG)
 agent_logger.propagate = True
 
 SANDBOX_URL = os.getenv('SANDBOX_ENDPOINT', '')
+STREAM_OBSERVATION_CHARS = int(os.getenv('STREAM_OBSERVATION_CHARS', 500))
 
 # Initialize the LLM
 def get_llm():
@@ -89,8 +95,17 @@ def get_llm():
 # Create ReAct-compatible tools
 def execute_python_code(query: str):
     try:
-        response = requests.post(f"{SANDBOX_URL}/execute", json={"query": query}, timeout=600)
-        return response.json().get("output", "No output received")
+        with observe_tool("execute_python_code"):
+            return sandbox_client.execute(query)
+    except Exception as e:
+        return f"Execution error: {e}"
+
+
+async def aexecute_python_code(query: str):
+    """Async variant used by the agent, talks to the sandbox with the pooled async client."""
+    try:
+        with observe_tool("execute_python_code"):
+            return await run_async_tool('sandbox', sandbox_client.aexecute, query)
     except Exception as e:
         return f"Execution error: {e}"
     
@@ -98,6 +113,7 @@ def get_execute_tool():
     return FunctionTool.from_defaults(
         name="execute_python_code",
         fn=execute_python_code,
+        async_fn=aexecute_python_code,
         description=f"""This tool allows you to send a natural language query to a coding language model.
         Your input should always be in the form of a query to an LLM asking it to generate some kind of code.
         
@@ -110,10 +126,20 @@ def get_execute_tool():
     )
 
 
-def send_direct_line_message(dl_lantern: str, message: str):
+def send_direct_line_message(dl_lantern: str, message: str, user_id: str):
     """Sends a message to an Azure Direct Line bot and returns its response."""
     try:
-        return asyncio.run(send_and_receive_message(dl_lantern, message))
+        with observe_tool("send_direct_line_message"):
+            return send_and_receive_message_blocking(dl_lantern, message, user_id)
+    except Exception as e:
+        return f"Error communicating with bot: {e}"
+
+
+async def asend_direct_line_message(dl_lantern: str, message: str, user_id: str):
+    """Async variant used by the agent, runs on the event loop with the pooled Direct Line client."""
+    try:
+        with observe_tool("send_direct_line_message"):
+            return await run_async_tool('direct_line', send_and_receive_message, dl_lantern, message, user_id)
     except Exception as e:
         return f"Error communicating with bot: {e}"
 
@@ -124,6 +150,7 @@ def get_direct_line_tool():
     return FunctionTool.from_defaults(
         name="send_direct_line_message",
         fn=send_direct_line_message,
+        async_fn=asend_direct_line_message,
         description=f"""Sends a message to an Azure Direct Line bot and retrieves the response.
 
         The 'dl_lantern' argument should be dynamically chosen based on the user's question:
@@ -134,45 +161,70 @@ def get_direct_line_tool():
 
         The 'message' argument is the text to send to the bot.
 
+        The 'user_id' argument is required, it is the user_id of the user and keeps each user's conversation with the bot separate.
+
         Always wait for the tool to return a response—it will **always** provide one.  
         **Always use the response from this tool to answer the user's question.**""",
     )
 
 
-def map_styles_for_word_doc(document_path: str):
+def map_styles_for_word_doc(document_path: str, page: int = 1, target_language: str = None):
     try:
-        return map_style_dependencies_with_text(document_path)
+        with observe_tool("generate_style_map_for_word_document"):
+            return map_style_dependencies_with_text(document_path, page, target_language)
     except Exception as e:
         return f"Error generating style map: {e}"
+
+
+async def amap_styles_for_word_doc(document_path: str, page: int = 1, target_language: str = None):
+    """
+    Async variant used by the agent.
+
+    With a target language the agent replaces the text once it has read the last
+    page, so the document is parsed in the background while it translates.
+    """
+    result = await run_tool('document', map_styles_for_word_doc, document_path, page, target_language)
+    if target_language and isinstance(result, dict) and result['page'] == result['total_pages']:
+        prefetch_document(document_path)
+    return result
     
 def get_style_map_tool():
     return FunctionTool.from_defaults(
         name="generate_style_map_for_word_document",
         fn=map_styles_for_word_doc,
+        async_fn=amap_styles_for_word_doc,
         description="""Use this tool to generate a style map with corresponding text from a Word document.
         
         * 'document_path' should be the path to a Word document, it will always be in the /srv/ directory
-        This tool will return a list of lists, each nested list will represent one group of text and its styling in the Word document.
+        * 'page' is the page of the style map to return, starting at 1. Large documents are split into several pages.
+        * 'target_language' (optional) when translating, the language you will translate into. Segments translated before are then
+        prefilled with their remembered translation, you only need to translate the segments that are still empty.
+        This tool will return a dictionary with the 'page' number, the 'total_pages' of the style map and the page's 'segments'.
+        'segments' is a list of lists, each nested list will represent one group of text and its styling in the Word document.
         The strcuture of a nested list structure is:
             [
                 'Heading 2', # The style of the body of text
                 'CONFORMITA’ NORMATIVA', # The existing text
-                '' # This text will replace the existing text 
+                '', # This text will replace the existing text 
+                'body:12' # The segment's ID, keep it unchanged
             ]
         
         - You should use this tool to analyze, or 'read' a Word document.
-        - If the user asks you to translate a Word document, you should use this tool to get the document's style and structure and you should add to the translation
+        - If 'total_pages' is more than 1, call this tool again with the next 'page' until you have read every page.
+        - To translate a whole document use the translate_word_document tool instead, it translates large documents in parallel batches.
+        Only translate the style map yourself when the user asks for changes to specific parts of the document.
+        - When you translate parts of a Word document yourself, use this tool to get the document's style and structure and add the translation
         to the empty string in each list, then pass this edited list of lists to the replace_text_in_word_document tool's 'replacements' argument.
+        For documents with several pages, read every page you need first, then pass all of the translated lists in a single replace_text_in_word_document call.
         ** It is important that you preserve all of the original text exactly as it appears in the style map, do not change punctuation of characters at all. **
-        - You should translate the document yourself instead of relying on another tool.
-        - ** IMPORTANT The relevant translations should be completed in a single step **.
         """
     )
 
 
-def replace_text_in_word_doc(document_path: str, replacements: list[list]):
+def replace_text_in_word_doc(document_path: str, replacements: list[list], target_language: str = None):
     try:
-        return combined_replace(document_path, replacements)
+        with observe_tool("replace_text_in_word_document"):
+            return combined_replace(document_path, replacements, target_language)
     except Exception as e:
         return f"Error replacing text: {e}"
     
@@ -180,6 +232,7 @@ def get_replace_text_in_word_tool():
     return FunctionTool.from_defaults(
         name="replace_text_in_word_document",
         fn=replace_text_in_word_doc,
+        async_fn=make_async(replace_text_in_word_doc, 'document'),
         description="""Use the replace_text_in_word_document tool to replace text in a Word document.
         ** Ideal for translations **
         Ensure that the replacements argument is a strict Python list of standard Python lists.
@@ -198,15 +251,55 @@ def get_replace_text_in_word_tool():
             ]
         - ** ALWAYS enter the text to translate EXACTLY as it appears in the style map, NEVER use "..." you should ALWAYS enter the full text. **
         - The document_path argument should be the path to the document you want to edit, this will be the same file path you used in the style map tool.
-        ** IMPORTANT This tool returns the output in this format:
-        {\n    \"stdout\": \"\",\n    \"stderr\": \"\",\n    \"file\": None,\n    \"error\": None\n} send the file URL to the user. **
+        - If the replacements are translations, set the target_language argument to the language they are in so they are remembered for later documents.
+        ** IMPORTANT This tool returns a dictionary, its 'files' entry is the new document, send the file URL to the user. **
+        The other entries report how many paragraphs were replaced and list the 'unmatched_entries' whose text wasn't found in the document,
+        if there are any, correct their text against the style map and call this tool again with the full, corrected list.
+        """
+    )
+
+
+def translate_word_doc(document_path: str, target_language: str, source_language: str = None):
+    try:
+        with observe_tool("translate_word_document"):
+            # On the loop the shared LLM client and the tool semaphores belong to
+            return run_blocking(run_async_tool, 'translation', translate_document, document_path, target_language,
+                                source_language)
+    except Exception as e:
+        return f"Error translating document: {e}"
+
+
+async def atranslate_word_doc(document_path: str, target_language: str, source_language: str = None):
+    """Async variant used by the agent, translates the document's batches concurrently on the event loop."""
+    try:
+        with observe_tool("translate_word_document"):
+            return await run_async_tool('translation', translate_document, document_path, target_language, source_language)
+    except Exception as e:
+        return f"Error translating document: {e}"
+
+def get_translate_word_doc_tool():
+    return FunctionTool.from_defaults(
+        name="translate_word_document",
+        fn=translate_word_doc,
+        async_fn=atranslate_word_doc,
+        description="""Use this tool to translate a whole Word document into another language.
+        The document is translated in batches and the translations are written into a copy of the document, keeping its styles and images.
+
+        * 'document_path' should be the path to a Word document, it will always be in the /srv/ directory
+        * 'target_language' is the language to translate the document into, e.g. 'Italian'
+        * 'source_language' (optional) is the language the document is written in, leave it out if you don't know it
+        Segments translated before are reused from the translation memory, so repeated content is translated instantly.
+
+        ** IMPORTANT This tool returns a dictionary, its 'files' entry is the new document, send the file URL to the user. **
+        It also reports how many segments were translated. If 'untranslated_count' is not 0, tell the user which parts weren't translated.
         """
     )
 
 
 def read_image(query: str, file_path: str, target_area_box=None):
     try:
-        return detect_objects(query, file_path, target_area_box)
+        with observe_tool("detect_objects_in_image"):
+            return detect_objects(query, file_path, target_area_box)
     except Exception as e:
         return f"There was an error: {e}"
 
@@ -214,12 +307,14 @@ def get_read_image_tool():
         return FunctionTool.from_defaults(
         name="detect_objects_in_image",
         fn=read_image,
+        async_fn=make_async(read_image, 'image'),
         description="""Use this tool to "read" an image.
         This tool takes 3 arguments:
         - 'query' The user's query to the image recognition model
         - 'file_path' The path to the image file
-        - 'target_area_box' (optional) A list of 4 integers which are the x, y coordinates for the top right and bottom left corners of a bounding box
-        e.g. [200, 300, 600, 900]
+        - 'target_area_box' (optional) A list of 4 integers which are the x, y pixel coordinates of the top left and bottom right corners of a
+        bounding box in the original image, e.g. [200, 300, 600, 900]. To check several areas at once pass a list of such boxes,
+        e.g. [[200, 300, 600, 900], [700, 300, 1100, 900]]
         ** IMPORTANT Do NOT put the bounding box in the user's request in the 'query' argument, always use the 'target_area_box' variable. **
         ** If the user asks if certain objects fit into a bounding box then you should query the model to put bounding boxes around these objects. **
         ** If the user asks you to draw a bounding box around something or in a specific area, you should send this prompt to the image recognition model. **
@@ -231,14 +326,26 @@ def get_read_image_tool():
         the target_area_box's position. ** This variable should be left out or set to None if the user does not ask for you to look in a specific area. **
 
         ** IMPORTANT This tool returns a string output containing the generated file URL (if applicable) and the response text from the image
-        recognition model. **
+        recognition model. Bounding boxes in the response are [x1, y1, x2, y2] pixel coordinates of the original image. **
+        When target areas are given, each box has a 'status' (Inside, Overlapping or Outside) and the response ends with a summary per target area:
+        the number of boxes inside, overlapping and outside it, the labels inside it and the best IoU of any box with it.
         """
     )
 
 
-def send_email_message(user_id: str, subject: str, recipient: str, message: str):
+def send_email_message(user_id: str, subject: str, recipient: str | list[str], message: str, separately: bool = False):
+    try:
+        with observe_tool("send_email_message"):
+            return send(user_id, subject, recipient, message, separately)
+    except Exception as e:
+        return f"There was an error: {e}"
+
+
+async def asend_email_message(user_id: str, subject: str, recipient: str | list[str], message: str, separately: bool = False):
+    """Async variant used by the agent, talks to Graph with the pooled async client."""
     try:
-        return send(user_id, subject, recipient, message)
+        with observe_tool("send_email_message"):
+            return await run_async_tool('email', asend, user_id, subject, recipient, message, separately)
     except Exception as e:
         return f"There was an error: {e}"
 
@@ -246,26 +353,41 @@ def get_send_email_message_tool():
         return FunctionTool.from_defaults(
         name="send_email_message",
         fn=send_email_message,
+        async_fn=asend_email_message,
         description="""Use this tool to send an email.
         This tool takes the following arguments:
 
         Args:
             - user_id (str): The user_id of the user.
             - subject (str): The subject of the email.
-            - recipient (str): The email address of the recipient.
+            - recipient (str | list): The email address of the recipient, or several addresses as a list or a comma separated string.
+              Send an email to everyone who should get it in one call instead of calling this tool once per recipient.
             - message (str): The body message of the email (can include HTML).
+            - separately (bool): Optional, defaults to False. False sends one email addressed to all the recipients,
+              True sends each recipient their own copy so they don't see each other's addresses.
         
         ** IMPORTANT - When sending an email with files make sure you form the full URL to the sandbox like this: {SANDBOX_URL}/download/<filename>
         being sure to replace <filename> with the actual file name and be sure to omit the /srv/ directory from the filename. Attach this to the body
         of the email as a hyperlink. **
         The message field has content type set to HTML so you can use valid HTML here to form your message.
-        This tool will return a success message if the email sent successfully or an error message if something went wrong."""
+        This tool will return a success message if the email sent successfully or an error message if something went wrong.
+        When the copies are sent separately it returns whether each recipient's copy was sent."""
     )
 
 
 def read_email_messages(user_id: str, number_of_emails: int):
     try:
-        return read(user_id, number_of_emails)
+        with observe_tool("read_email_messages"):
+            return read(user_id, number_of_emails)
+    except Exception as e:
+        return f"There was an error: {e}"
+
+
+async def aread_email_messages(user_id: str, number_of_emails: int):
+    """Async variant used by the agent, syncs the mailbox with the pooled async client."""
+    try:
+        with observe_tool("read_email_messages"):
+            return await run_async_tool('email', aread, user_id, number_of_emails)
     except Exception as e:
         return f"There was an error: {e}"
 
@@ -273,38 +395,107 @@ def get_read_email_messages_tool():
         return FunctionTool.from_defaults(
         name="read_email_messages",
         fn=read_email_messages,
+        async_fn=aread_email_messages,
         description="""Use this tool to read the user's emails.
         This tool takes two arguments:
             - the user_id of the user.
             - the number of emails to read.
             
-        This tool will return the latest n emails' recepient, subject and body content."""
+        This tool will return the latest n emails of the user's inbox, newest first, with their subject, sender,
+        received date, an (unread) marker and a preview of the body. Reading again is cheap, only new and changed
+        emails are fetched."""
     )
 
 
-# Set up agent with tools
-def get_agent():
-    llm = get_llm()
+# Shared LLM client and tools, built once per process
+@lru_cache(maxsize=None)
+def get_shared_llm():
+    install_llm_metrics()
+    return get_llm()
+
 
+@lru_cache(maxsize=None)
+def get_tools():
     google_search_tool_spec = GoogleSearchToolSpec(key=os.getenv('GOOGLE_SEARCH_API_KEY', ''), engine=os.getenv('GOOGLE_SEARCH_ID', ''))
 
     execute_tool = get_execute_tool()
     direct_line_tool = get_direct_line_tool()
     style_map_tool = get_style_map_tool()
     replace_text_tool = get_replace_text_in_word_tool()
+    translate_document_tool = get_translate_word_doc_tool()
     image_recognition_tool = get_read_image_tool()
     send_email_tool = get_send_email_message_tool()
     read_email_tool = get_read_email_messages_tool()
-    google_search_tool = google_search_tool_spec.to_tool_list()
+    google_search_tool = []
+    for tool in google_search_tool_spec.to_tool_list():
+        fn = instrument_tool(tool.fn, tool.metadata.name)
+        google_search_tool.append(FunctionTool(fn=fn, metadata=tool.metadata, async_fn=make_async(fn, 'search')))
 
-    memory = ChatMemoryBuffer.from_defaults(token_limit=int(os.getenv('MODEL_MEMORY_TOKENS', 3000)))
-    tools=[execute_tool, direct_line_tool, style_map_tool, replace_text_tool, image_recognition_tool, send_email_tool, read_email_tool]
+    tools = [execute_tool, direct_line_tool, style_map_tool, replace_text_tool, translate_document_tool, image_recognition_tool,
+             send_email_tool, read_email_tool]
     tools.extend(google_search_tool)
+    return tuple(tools)
+
+
+# Set up agent with tools, only the memory is created per user
+def get_agent():
+    memory = ChatMemoryBuffer.from_defaults(token_limit=int(os.getenv('MODEL_MEMORY_TOKENS', 3000)))
     agent = ReActAgent.from_tools(
-        tools=tools,
-        llm=llm, 
-        verbose=True, 
+        tools=list(get_tools()),
+        llm=get_shared_llm(),
+        verbose=True,
         memory=memory,
         max_iterations=int(os.getenv('MODEL_MAX_ITERATIONS', 10))
     )
     return agent
+
+
+async def chat_turn(agent, message: str):
+    """Runs one chat turn step by step, like agent.achat, recording the number of ReAct iterations."""
+    task = agent.create_task(message)
+    iterations = 0
+    while True:
+        step_output = await agent.arun_step(task.task_id)
+        iterations += 1
+        if step_output.is_last:
+            break
+    TURN_ITERATIONS.observe(iterations)
+    return agent.finalize_response(task.task_id, step_output)
+
+
+def reasoning_step_event(step):
+    """Converts a ReAct reasoning step into a small JSON-serializable progress event."""
+    if isinstance(step, ActionReasoningStep):
+        return {"type": "tool_call", "tool": step.action, "input": step.action_input, "thought": step.thought}
+    if isinstance(step, ObservationReasoningStep):
+        return {"type": "observation", "text": str(step.observation)[:STREAM_OBSERVATION_CHARS]}
+    return {"type": "thought", "text": step.get_content()}
+
+
+async def stream_turn(agent, message: str):
+    """
+    Runs one chat turn step by step, yielding events as they are produced.
+
+    Yields 'tool_call', 'observation' and 'thought' events for every ReAct step,
+    'token' events while the final answer streams in, and a closing 'final' event
+    with the full response.
+    """
+    task = agent.create_task(message)
+    seen = 0
+    iterations = 0
+    while True:
+        step_output = await agent.astream_step(task.task_id)
+        iterations += 1
+        reasoning = task.extra_state.get("current_reasoning", [])
+        for step in reasoning[seen:]:
+            yield reasoning_step_event(step)
+        seen = len(reasoning)
+        if step_output.is_last:
+            break
+    TURN_ITERATIONS.observe(iterations)
+
+    response = agent.finalize_response(task.task_id, step_output)
+    if isinstance(response, StreamingAgentChatResponse):
+        async for token in response.async_response_gen():
+            yield {"type": "token", "text": token}
+    yield {"type": "final", "response": str(response)}
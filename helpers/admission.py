@@ -0,0 +1,148 @@
+import os
+import time
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+
+ADMISSION_MAX_INFLIGHT = int(os.getenv('ADMISSION_MAX_INFLIGHT', 16))
+ADMISSION_MAX_QUEUE = int(os.getenv('ADMISSION_MAX_QUEUE', 64))
+ADMISSION_MAX_PENDING_PER_USER = int(os.getenv('ADMISSION_MAX_PENDING_PER_USER', 3))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv('ADMISSION_QUEUE_TIMEOUT', 120))
+
+
+class AdmissionRejected(Exception):
+    """Raised when a turn can't be admitted, `retry_after` is a suggested wait in seconds."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Limits the number of agent turns running at once.
+
+    Each user's turns first take that user's lock from `user_locks`, so a user has
+    at most one turn waiting for a slot and the FIFO slot queue is served round
+    robin across users. Turns beyond `max_inflight` wait in a queue of at most
+    `max_queue` users. A user can have at most `max_pending_per_user` turns
+    running or waiting. Anything over these limits is rejected straight away
+    with AdmissionRejected.
+    """
+
+    def __init__(self, user_locks, max_inflight=ADMISSION_MAX_INFLIGHT, max_queue=ADMISSION_MAX_QUEUE,
+                 max_pending_per_user=ADMISSION_MAX_PENDING_PER_USER, queue_timeout=ADMISSION_QUEUE_TIMEOUT):
+        self.user_locks = user_locks
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self.max_pending_per_user = max_pending_per_user
+        self.queue_timeout = queue_timeout
+        self.inflight = 0
+        self._queue = deque()  # Futures of turns waiting for a slot
+        self._pending = {}  # user_id -> turns running or waiting
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._turn_seconds = 30.0  # Moving average of turn duration, used for Retry-After
+
+    @property
+    def queued(self) -> int:
+        return len(self._queue)
+
+    def check(self, user_id):
+        """Raises AdmissionRejected if a new turn for the user would be rejected right now."""
+        if self._pending.get(user_id, 0) >= self.max_pending_per_user:
+            self.rejected += 1
+            raise AdmissionRejected("You already have requests in progress, please wait for them to finish.",
+                                    self.retry_after())
+        if self.inflight >= self.max_inflight and len(self._queue) >= self.max_queue:
+            self.rejected += 1
+            raise AdmissionRejected("Server is busy, please try again shortly.", self.retry_after())
+
+    @asynccontextmanager
+    async def admit(self, user_id):
+        """
+        Holds the user's lock and a turn slot for the duration of the block.
+
+        Yields:
+            float: Seconds spent waiting for the slot.
+        """
+        self.check(user_id)
+        self._pending[user_id] = self._pending.get(user_id, 0) + 1
+        try:
+            async with self.user_locks.acquire(user_id):
+                start = time.monotonic()
+                await self._acquire()
+                waited = time.monotonic() - start
+                self.admitted += 1
+                self._wait_total += waited
+                self._wait_max = max(self._wait_max, waited)
+                try:
+                    yield waited
+                finally:
+                    self._turn_seconds = 0.9 * self._turn_seconds + 0.1 * (time.monotonic() - start - waited)
+                    self._release()
+        finally:
+            self._pending[user_id] -= 1
+            if not self._pending[user_id]:
+                del self._pending[user_id]
+
+    def retry_after(self) -> int:
+        """Rough estimate of when a slot will free up, in whole seconds."""
+        waves = len(self._queue) // max(self.max_inflight, 1) + 1
+        return max(1, int(waves * self._turn_seconds))
+
+    def stats(self) -> dict:
+        return {
+            'inflight': self.inflight,
+            'max_inflight': self.max_inflight,
+            'queued': len(self._queue),
+            'max_queue': self.max_queue,
+            'pending_users': len(self._pending),
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+            'timed_out': self.timed_out,
+            'wait_seconds_avg': self._wait_total / self.admitted if self.admitted else 0.0,
+            'wait_seconds_max': self._wait_max,
+        }
+
+    async def _acquire(self):
+        if self.inflight < self.max_inflight and not self._queue:
+            self.inflight += 1
+            return
+        if len(self._queue) >= self.max_queue:
+            self.rejected += 1
+            raise AdmissionRejected("Server is busy, please try again shortly.", self.retry_after())
+
+        future = asyncio.get_running_loop().create_future()
+        self._queue.append(future)
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            if future.done() and not future.cancelled():
+                return  # Admitted just as the timeout fired, keep the slot
+            self._discard(future)
+            self.timed_out += 1
+            raise AdmissionRejected("Timed out waiting for a free slot, please try again shortly.", self.retry_after())
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release()
+            else:
+                self._discard(future)
+            raise
+
+    def _discard(self, future):
+        future.cancel()
+        if future in self._queue:
+            self._queue.remove(future)
+
+    def _release(self):
+        # Hand the slot straight to the next waiting turn
+        while self._queue:
+            future = self._queue.popleft()
+            if not future.done():
+                future.set_result(None)
+                return
+        self.inflight -= 1
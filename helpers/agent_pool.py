@@ -0,0 +1,154 @@
+import os
+import time
+import logging
+from collections import OrderedDict
+from helpers.metrics import AGENT_POOL_EVENTS
+
+pool_logger = logging.getLogger(__name__)
+
+AGENT_POOL_MAX_SIZE = int(os.getenv('AGENT_POOL_MAX_SIZE', 500))
+AGENT_POOL_IDLE_TTL = float(os.getenv('AGENT_POOL_IDLE_TTL', 3600))
+AGENT_POOL_MAX_MEMORY_MB = float(os.getenv('AGENT_POOL_MAX_MEMORY_MB', 0))
+
+# Rough fixed cost of an agent (worker, formatter, memory buffer) on top of its chat history
+AGENT_BASE_BYTES = 64 * 1024
+
+
+def estimate_agent_size(agent) -> int:
+    """
+    Estimates the memory held by an agent from the size of its chat history.
+
+    Args:
+        agent: The agent to measure.
+
+    Returns:
+        int: Approximate size in bytes.
+    """
+    size = AGENT_BASE_BYTES
+    try:
+        for message in agent.memory.get_all():
+            size += len(str(message.content or '')) * 2
+    except Exception:
+        pass
+    return size
+
+
+class _PoolEntry:
+    __slots__ = ('agent', 'last_used', 'size')
+
+    def __init__(self, agent, size):
+        self.agent = agent
+        self.last_used = time.monotonic()
+        self.size = size
+
+
+class AgentPool:
+    """
+    Bounded per-user agent pool with LRU and idle TTL eviction.
+
+    Agents are kept in least-recently-used order. An agent is evicted when it has
+    been idle for longer than `idle_ttl` seconds, when the pool holds more than
+    `max_size` agents, or when the estimated memory of all agents exceeds
+    `max_memory_bytes`. A zero value disables the corresponding limit.
+    """
+
+    def __init__(self, max_size=AGENT_POOL_MAX_SIZE, idle_ttl=AGENT_POOL_IDLE_TTL,
+                 max_memory_bytes=int(AGENT_POOL_MAX_MEMORY_MB * 1024 * 1024), sizeof=estimate_agent_size):
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self.max_memory_bytes = max_memory_bytes
+        self.sizeof = sizeof
+        self._entries = OrderedDict()
+        self._memory_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = {'capacity': 0, 'ttl': 0, 'memory': 0}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, user_id):
+        return user_id in self._entries
+
+    def get(self, user_id):
+        """Returns the agent for `user_id` and marks it as recently used, or None."""
+        self._evict_expired()
+        entry = self._entries.get(user_id)
+        if entry is None:
+            self.misses += 1
+            AGENT_POOL_EVENTS.labels(event='miss').inc()
+            return None
+        self.hits += 1
+        AGENT_POOL_EVENTS.labels(event='hit').inc()
+        entry.last_used = time.monotonic()
+        self._entries.move_to_end(user_id)
+        return entry.agent
+
+    def peek(self, user_id):
+        """Returns the agent for `user_id` without touching counters or recency."""
+        entry = self._entries.get(user_id)
+        return entry.agent if entry else None
+
+    def put(self, user_id, agent):
+        """Adds or replaces the agent for `user_id` and enforces the pool limits."""
+        self.pop(user_id)
+        entry = _PoolEntry(agent, self.sizeof(agent))
+        self._entries[user_id] = entry
+        self._memory_bytes += entry.size
+        self._enforce_limits()
+
+    def touch(self, user_id):
+        """Re-measures an agent after a chat turn, as its memory will have grown."""
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return
+        new_size = self.sizeof(entry.agent)
+        self._memory_bytes += new_size - entry.size
+        entry.size = new_size
+        entry.last_used = time.monotonic()
+        self._entries.move_to_end(user_id)
+        self._enforce_limits()
+
+    def pop(self, user_id):
+        """Removes and returns the agent for `user_id`, or None."""
+        entry = self._entries.pop(user_id, None)
+        if entry is None:
+            return None
+        self._memory_bytes -= entry.size
+        return entry.agent
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'memory_bytes': self._memory_bytes,
+            'max_memory_bytes': self.max_memory_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': dict(self.evictions),
+        }
+
+    def _evict(self, user_id, reason):
+        self.pop(user_id)
+        self.evictions[reason] += 1
+        AGENT_POOL_EVENTS.labels(event=f'eviction_{reason}').inc()
+        pool_logger.debug(f"Evicted agent for user {user_id} ({reason})")
+
+    def _evict_expired(self):
+        if not self.idle_ttl:
+            return
+        cutoff = time.monotonic() - self.idle_ttl
+        # Entries are in recency order so expired ones are always at the front
+        while self._entries:
+            user_id, entry = next(iter(self._entries.items()))
+            if entry.last_used > cutoff:
+                break
+            self._evict(user_id, 'ttl')
+
+    def _enforce_limits(self):
+        self._evict_expired()
+        while self.max_size and len(self._entries) > self.max_size:
+            self._evict(next(iter(self._entries)), 'capacity')
+        while self.max_memory_bytes and self._memory_bytes > self.max_memory_bytes and len(self._entries) > 1:
+            # The most recently used agent is at the end and is never evicted for memory
+            self._evict(next(iter(self._entries)), 'memory')
@@ -0,0 +1,91 @@
+import os
+import re
+import json
+import time
+import hashlib
+from helpers.database import execute
+
+HASH_CHUNK_SIZE = 1024 * 1024
+SHA256_NAME = re.compile(r'^[0-9a-f]{64}$')
+
+_path_hashes = {}  # path -> (mtime, size, sha256)
+
+
+def file_hash(path: str) -> str:
+    """
+    Returns the SHA-256 of a file's content.
+
+    Attachments are stored as <sha256>.<ext> so their hash comes from the name,
+    other files are hashed once per (mtime, size).
+    """
+    stem = os.path.splitext(os.path.basename(path))[0]
+    if SHA256_NAME.match(stem):
+        return stem
+
+    stat = os.stat(path)
+    cached = _path_hashes.get(path)
+    if cached and cached[0] == stat.st_mtime and cached[1] == stat.st_size:
+        return cached[2]
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    _path_hashes[path] = (stat.st_mtime, stat.st_size, digest.hexdigest())
+    return digest.hexdigest()
+
+
+def find_attachment(sha256: str, extension: str):
+    """Returns the stored path of an attachment with this content, or None."""
+    row = execute("SELECT path FROM attachments WHERE sha256 = ? AND extension = ?", (sha256, extension), fetch='one')
+    if row and os.path.exists(row[0]):
+        execute("UPDATE attachments SET last_seen_at = ? WHERE sha256 = ? AND extension = ?",
+                (time.time(), sha256, extension))
+        return row[0]
+    return None
+
+
+def record_attachment(sha256: str, extension: str, path: str, size: int, name: str):
+    now = time.time()
+    execute(
+        "INSERT OR REPLACE INTO attachments (sha256, extension, path, size, name, created_at, last_seen_at) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (sha256, extension, path, size, name, now, now)
+    )
+
+
+def get_artifact(sha256: str, kind: str):
+    row = execute("SELECT value FROM derived_artifacts WHERE sha256 = ? AND kind = ?", (sha256, kind), fetch='one')
+    return json.loads(row[0]) if row else None
+
+
+def put_artifact(sha256: str, kind: str, value):
+    execute("INSERT OR REPLACE INTO derived_artifacts (sha256, kind, value, created_at) VALUES (?, ?, ?, ?)",
+            (sha256, kind, json.dumps(value), time.time()))
+
+
+def cached_artifact(path: str, kind: str, compute):
+    """
+    Returns a result derived from a file, computing and storing it on the first call.
+
+    Args:
+        path (str): The file the result is derived from.
+        kind (str): What the result is, e.g. 'style_map'. Include any parameters
+            the result depends on.
+        compute: A function returning the JSON-serializable result.
+
+    Returns:
+        The cached or freshly computed result.
+    """
+    sha256 = file_hash(path)
+    value = get_artifact(sha256, kind)
+    if value is None:
+        value = compute()
+        put_artifact(sha256, kind, value)
+    return value
+
+
+def query_key(query: str) -> str:
+    """Short, stable key for a free-text query, ignoring case and whitespace differences."""
+    normalized = " ".join(query.lower().split())
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()[:16]
@@ -1,41 +1,138 @@
-import requests
-import uuid
 import os
+import uuid
+import asyncio
+import hashlib
+import aiohttp
+from helpers.database import run_async
+from helpers.artifact_cache import find_attachment, record_attachment
+
+ATTACHMENTS_DIR = os.getenv('ATTACHMENTS_DIR', '/srv')
+ATTACHMENT_MAX_BYTES = int(float(os.getenv('ATTACHMENT_MAX_MB', 50)) * 1024 * 1024)
+ATTACHMENT_TIMEOUT = float(os.getenv('ATTACHMENT_TIMEOUT', 120))
+ATTACHMENT_ALLOWED_EXTENSIONS = {
+    ext.strip().lower().lstrip('.')
+    for ext in os.getenv(
+        'ATTACHMENT_ALLOWED_EXTENSIONS',
+        'docx,doc,pdf,txt,csv,json,md,xlsx,xls,pptx,png,jpg,jpeg,gif,bmp,webp,tif,tiff'
+    ).split(',')
+    if ext.strip()
+}
+CHUNK_SIZE = 64 * 1024
+
+_session = None
+_session_loop = None
+
+
+class AttachmentError(Exception):
+    """Raised when an attachment is rejected or can't be downloaded."""
+
+
+def get_session() -> aiohttp.ClientSession:
+    """Returns the pooled download session of the running event loop."""
+    global _session, _session_loop
+    loop = asyncio.get_running_loop()
+    if _session is None or _session.closed or _session_loop is not loop:
+        _session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=ATTACHMENT_TIMEOUT))
+        _session_loop = loop
+    return _session
+
+
+def get_attachment_url(attachment: dict, channel_id: str):
+    """Returns the download URL of a Bot Framework attachment, or None if it has no file."""
+    if channel_id == "msteams":
+        content = attachment.get("content")
+        return content.get("downloadUrl") if isinstance(content, dict) else None
+    return next((attachment.get(key) for key in ["contentUrl", "fileUrl"] if attachment.get(key)), None)
+
+
+def get_extension(name: str) -> str:
+    return os.path.splitext(name)[1].lower().lstrip('.')
+
 
-def download_and_save(url: str, name: str) -> str:
+async def download_and_save(url: str, name: str) -> str:
     """
-    Downloads a file from a given URL and extracts content while preserving layout.
+    Streams a file from a given URL to disk, enforcing the size limit.
+
+    Files are stored by content as <sha256>.<ext>, so a file that was uploaded
+    before resolves to the same path and isn't stored twice.
 
     Args:
         url (str): The URL of the file to download.
+        name (str): The original file name, used for its extension.
 
     Returns:
         str: The path to the downloaded file.
     """
-    file_path = None  # Initialize file_path to handle exceptions properly
+    extension = get_extension(name)
+    if extension not in ATTACHMENT_ALLOWED_EXTENSIONS:
+        raise AttachmentError(f"Unsupported file type: '{extension or name}'")
 
+    temp_path = f"{ATTACHMENTS_DIR}/.{uuid.uuid4()}.part"
     try:
-        response = requests.get(url, stream=True)
-        if response.status_code != 200:
-            return f"Failed to download file. Status Code: {response.status_code}"
+        async with get_session().get(url) as response:
+            if response.status != 200:
+                raise AttachmentError(f"Failed to download file. Status Code: {response.status}")
+            if response.content_length and response.content_length > ATTACHMENT_MAX_BYTES:
+                raise AttachmentError(f"File is larger than {ATTACHMENT_MAX_BYTES // (1024 * 1024)} MB")
 
-        # Get file extension (assuming docx for now)
-        extension = name.split('.')[1]
+            size = 0
+            digest = hashlib.sha256()
+            with open(temp_path, "wb") as f:
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > ATTACHMENT_MAX_BYTES:
+                        raise AttachmentError(f"File is larger than {ATTACHMENT_MAX_BYTES // (1024 * 1024)} MB")
+                    digest.update(chunk)
+                    f.write(chunk)
+    except asyncio.TimeoutError:
+        _remove(temp_path)
+        raise AttachmentError(f"Download timed out after {ATTACHMENT_TIMEOUT:.0f} seconds")
+    except BaseException:
+        _remove(temp_path)
+        raise
 
-        # Generate file name with extension
-        filename = f"{uuid.uuid4()}.{extension}"
-        file_path = f"/srv/{filename}"
+    sha256 = digest.hexdigest()
+    existing = await run_async(find_attachment, sha256, extension)
+    if existing:
+        _remove(temp_path)
+        return existing
 
-        # Save file
-        with open(file_path, "wb") as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
+    file_path = f"{ATTACHMENTS_DIR}/{sha256}.{extension}"
+    os.replace(temp_path, file_path)
+    await run_async(record_attachment, sha256, extension, file_path, size, name)
+    return file_path
+
+
+async def download_attachments(attachments, channel_id: str):
+    """
+    Downloads every attachment of a message concurrently.
+
+    Args:
+        attachments (list): The Bot Framework attachments of the message.
+        channel_id (str): The channel the message came from.
+
+    Returns:
+        tuple: (list of local file paths, list of (file name, error message) for failed attachments)
+    """
+    downloads = []
+    for attachment in attachments or []:
+        if not isinstance(attachment, dict):
+            continue
+        url = get_attachment_url(attachment, channel_id)
+        if url:
+            downloads.append((attachment.get('name', 'unknown_file'), url))
+
+    results = await asyncio.gather(*(download_and_save(url, name) for name, url in downloads), return_exceptions=True)
 
-        return file_path
+    file_paths, errors = [], []
+    for (name, _), result in zip(downloads, results):
+        if isinstance(result, BaseException):
+            errors.append((name, str(result)))
+        else:
+            file_paths.append(result)
+    return file_paths, errors
 
-    except Exception as e:
-        if file_path and os.path.exists(file_path):
-            os.remove(file_path)
-        return f"Error: {str(e)}"
 
+def _remove(file_path):
+    if os.path.exists(file_path):
+        os.remove(file_path)
@@ -0,0 +1,210 @@
+import os
+import asyncio
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+DATABASE_PATH = os.getenv('DATABASE_PATH', 'ai_employee.db')
+SEEN_USERS_MAX = int(os.getenv('SEEN_USERS_MAX', 10000))
+
+# One connection per process, shared by the event loop's writer thread and the tool threads
+_conn = None
+_conn_lock = threading.RLock()
+# Async callers go through a single thread so SQLite work never runs on the event loop
+_db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+
+# (user_id, channel_id) pairs known to be in the users table, least recently seen first
+_seen_users = OrderedDict()
+_seen_users_lock = threading.Lock()
+
+
+def get_connection() -> sqlite3.Connection:
+    global _conn
+    with _conn_lock:
+        if _conn is None:
+            _conn = sqlite3.connect(DATABASE_PATH, check_same_thread=False, timeout=30)
+            _conn.execute("PRAGMA journal_mode=WAL")
+            _conn.execute("PRAGMA synchronous=NORMAL")
+        return _conn
+
+
+def execute(sql: str, params=(), fetch: str = None):
+    """
+    Runs a single statement on the shared connection and commits it.
+
+    Args:
+        sql (str): The SQL statement.
+        params: Parameters for the statement.
+        fetch (str): 'one' or 'all' to return rows, None otherwise.
+
+    Returns:
+        The fetched row(s) or None.
+    """
+    with _conn_lock:
+        conn = get_connection()
+        cursor = conn.execute(sql, params)
+        if fetch == 'one':
+            result = cursor.fetchone()
+        elif fetch == 'all':
+            result = cursor.fetchall()
+        else:
+            result = None
+        conn.commit()
+        return result
+
+
+def executemany(sql: str, rows):
+    """Runs a statement once per row of parameters in a single transaction."""
+    with _conn_lock:
+        conn = get_connection()
+        conn.executemany(sql, rows)
+        conn.commit()
+
+
+async def run_async(fn, *args):
+    """Runs a database function on the SQLite thread without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_executor, fn, *args)
+
+
+def init_db():
+    execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            channel_id TEXT NOT NULL,
+            user_email TEXT,
+            access_token TEXT,
+            refresh_token TEXT,
+            expires_at REAL,
+            UNIQUE(user_id, channel_id)
+        )
+    """)
+    # Databases created before the token columns existed
+    columns = {row[1] for row in execute("PRAGMA table_info(users)", fetch='all')}
+    for column, column_type in (("refresh_token", "TEXT"), ("expires_at", "REAL")):
+        if column not in columns:
+            execute(f"ALTER TABLE users ADD COLUMN {column} {column_type}")
+    execute("""
+        CREATE TABLE IF NOT EXISTS attachments (
+            sha256 TEXT NOT NULL,
+            extension TEXT NOT NULL,
+            path TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            name TEXT,
+            created_at REAL NOT NULL,
+            last_seen_at REAL NOT NULL,
+            PRIMARY KEY(sha256, extension)
+        )
+    """)
+    execute("""
+        CREATE TABLE IF NOT EXISTS derived_artifacts (
+            sha256 TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            value TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            PRIMARY KEY(sha256, kind)
+        )
+    """)
+    execute("""
+        CREATE TABLE IF NOT EXISTS translation_memory (
+            source_hash TEXT NOT NULL,
+            source_language TEXT NOT NULL,
+            target_language TEXT NOT NULL,
+            model TEXT NOT NULL,
+            source TEXT NOT NULL,
+            translation TEXT NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL,
+            last_used_at REAL NOT NULL,
+            PRIMARY KEY(source_hash, source_language, target_language, model)
+        )
+    """)
+    execute("""
+        CREATE TABLE IF NOT EXISTS mail_messages (
+            user_id TEXT NOT NULL,
+            message_id TEXT NOT NULL,
+            received_at TEXT,
+            subject TEXT,
+            sender TEXT,
+            preview TEXT,
+            is_read INTEGER,
+            PRIMARY KEY(user_id, message_id)
+        )
+    """)
+    execute("CREATE INDEX IF NOT EXISTS mail_messages_received ON mail_messages (user_id, received_at)")
+    execute("""
+        CREATE TABLE IF NOT EXISTS mail_sync_state (
+            user_id TEXT PRIMARY KEY,
+            delta_link TEXT NOT NULL,
+            window_start TEXT,
+            synced_at REAL NOT NULL
+        )
+    """)
+
+
+def _seen(key) -> bool:
+    """Whether a user is known to be registered, marking them as recently seen."""
+    with _seen_users_lock:
+        if key not in _seen_users:
+            return False
+        _seen_users.move_to_end(key)
+        return True
+
+
+def _mark_seen(key):
+    """Remembers a registered user, forgetting the least recently seen ones beyond SEEN_USERS_MAX."""
+    with _seen_users_lock:
+        _seen_users[key] = None
+        _seen_users.move_to_end(key)
+        while len(_seen_users) > SEEN_USERS_MAX:
+            _seen_users.popitem(last=False)
+
+
+def ensure_user(user_id: str, channel_id: str):
+    """Registers a user, skipping the write for users recently seen by this process."""
+    key = (user_id, channel_id)
+    if _seen(key):
+        return
+    execute("INSERT OR IGNORE INTO users (user_id, channel_id) VALUES (?, ?)", key)
+    _mark_seen(key)
+
+
+def get_user_tokens(user_id: str):
+    """
+    Returns the stored email and OAuth tokens of a user.
+
+    Args:
+        user_id (str): The user's ID.
+
+    Returns:
+        tuple: (user_email, access_token, refresh_token, expires_at), None if the
+        user hasn't authenticated. `expires_at` is a Unix time, None for tokens
+        stored before expiries were recorded.
+    """
+    return execute(
+        "SELECT user_email, access_token, refresh_token, expires_at FROM users "
+        "WHERE user_id = ? AND access_token IS NOT NULL",
+        (user_id,), fetch='one'
+    )
+
+
+def save_user_tokens(user_id: str, user_email: str, access_token: str, refresh_token: str = None,
+                     expires_at: float = None):
+    execute(
+        "UPDATE users SET user_email = ?, access_token = ?, refresh_token = ?, expires_at = ? WHERE user_id = ?",
+        (user_email, access_token, refresh_token, expires_at, user_id)
+    )
+
+
+def clear_user_tokens(user_id: str):
+    """Forgets a user's tokens, the user has to authenticate again."""
+    execute("UPDATE users SET access_token = NULL, refresh_token = NULL, expires_at = NULL WHERE user_id = ?",
+            (user_id,))
+
+
+async def ensure_user_async(user_id: str, channel_id: str):
+    if _seen((user_id, channel_id)):
+        return
+    await run_async(ensure_user, user_id, channel_id)
@@ -0,0 +1,191 @@
+import os
+import logging
+import zipfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import Future
+
+cache_logger = logging.getLogger(__name__)
+
+DOC_CACHE_MAX_ENTRIES = int(os.getenv('DOC_CACHE_MAX_ENTRIES', 8))
+DOC_CACHE_MAX_MB = float(os.getenv('DOC_CACHE_MAX_MB', 512))
+
+# A parsed XML part takes several times its uncompressed size, other parts are kept as raw bytes
+PARSED_XML_FACTOR = 5
+
+
+def document_key(path: str):
+    """Identifies a version of a file, a rewritten file gets a new key."""
+    stat = os.stat(path)
+    return path, stat.st_mtime_ns, stat.st_size
+
+
+def estimate_document_size(path: str) -> int:
+    """
+    Estimates the memory a parsed Office document holds from its uncompressed parts.
+
+    Args:
+        path (str): Path to the document.
+
+    Returns:
+        int: Approximate size in bytes.
+    """
+    size = 0
+    with zipfile.ZipFile(path) as archive:
+        for info in archive.infolist():
+            is_xml = info.filename.endswith(('.xml', '.rels'))
+            size += info.file_size * (PARSED_XML_FACTOR if is_xml else 1)
+    return size
+
+
+class _CacheEntry:
+    __slots__ = ('value', 'size', 'lock')
+
+    def __init__(self, value, size):
+        self.value = value
+        self.size = size
+        # Held by the caller that has the document checked out
+        self.lock = threading.Lock()
+
+
+class DocumentCache:
+    """
+    Bounded LRU cache of parsed documents, shared by the tool threads.
+
+    Entries are keyed by path, modification time and size, so an edited file is
+    parsed again. Parsed documents are mutable, so checkout() hands a document to
+    one caller at a time. The caller has to leave it as it was parsed, e.g. by
+    undoing its edits after saving a copy, and the document stays cached for the
+    next call. If the caller raises, the document is dropped from the cache.
+    prefetch() parses a document ahead of a checkout().
+
+    Args:
+        loader: Function that parses the document at a path, e.g. into a
+            python-docx Document and its paragraph index.
+        max_entries (int): Maximum number of cached documents, 0 disables the cache.
+        max_memory_bytes (int): Approximate memory budget, 0 disables the budget.
+    """
+
+    def __init__(self, loader, max_entries=DOC_CACHE_MAX_ENTRIES,
+                 max_memory_bytes=int(DOC_CACHE_MAX_MB * 1024 * 1024), sizeof=estimate_document_size):
+        self.loader = loader
+        self.max_entries = max_entries
+        self.max_memory_bytes = max_memory_bytes
+        self.sizeof = sizeof
+        self._entries = OrderedDict()
+        self._loading = {}  # key -> Future of the entry being parsed
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @contextmanager
+    def checkout(self, path: str):
+        """
+        Yields the parsed document at `path`, parsing it if it isn't cached.
+
+        Waits for a running parse of the same document, and for other callers
+        that have it checked out.
+        """
+        key = document_key(path)
+        entry = self._get_entry(key, path)
+        with entry.lock:
+            try:
+                yield entry.value
+            except BaseException:
+                # The document may be left half edited
+                with self._lock:
+                    if self._entries.get(key) is entry:
+                        self._pop(key)
+                raise
+
+    def prefetch(self, path: str):
+        """
+        Parses the document at `path` into the cache unless it's cached or being parsed.
+
+        Blocks while parsing, run it on a tool thread.
+        """
+        if not self.max_entries:
+            return
+        key = document_key(path)
+        with self._lock:
+            if key in self._entries or key in self._loading:
+                return
+            future = self._loading[key] = Future()
+        try:
+            self._load(key, path, future)
+        except Exception as e:
+            cache_logger.warning(f"Couldn't prefetch {path}: {e}")
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_entries,
+            'memory_bytes': self._memory_bytes,
+            'max_memory_bytes': self.max_memory_bytes,
+            'loading': len(self._loading),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def _get_entry(self, key, path):
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry
+                future = self._loading.get(key)
+                if future is None:
+                    future = self._loading[key] = Future()
+                    self.misses += 1
+                    break
+            try:
+                entry = future.result()
+            except Exception:
+                continue  # Parse it again and let that raise
+            self.hits += 1
+            return entry
+        return self._load(key, path, future)
+
+    def _load(self, key, path, future):
+        try:
+            entry = _CacheEntry(self.loader(path), self.sizeof(path) if self.max_entries else 0)
+            if self.max_entries:
+                with self._lock:
+                    # Older versions of the same file won't be asked for again
+                    for stale in [k for k in self._entries if k[0] == path]:
+                        self._pop(stale)
+                    self._entries[key] = entry
+                    self._memory_bytes += entry.size
+                    self._enforce_limits()
+            future.set_result(entry)
+            return entry
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._loading.pop(key, None)
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._memory_bytes -= entry.size
+        return entry
+
+    def _enforce_limits(self):
+        while len(self._entries) > self.max_entries:
+            self._pop(next(iter(self._entries)))
+            self.evictions += 1
+        while self.max_memory_bytes and self._memory_bytes > self.max_memory_bytes and len(self._entries) > 1:
+            # The most recently added document is at the end and is never evicted for memory
+            self._pop(next(iter(self._entries)))
+            self.evictions += 1
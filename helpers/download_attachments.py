@@ -3,6 +3,7 @@ import json
 import requests
 import pdfplumber
 from docx import Document
+from helpers.artifact_cache import cached_artifact
 
 def download_and_extract_text(url: str, filename: str) -> str:
     """
@@ -59,6 +60,10 @@ def extract_text_from_pdf(filepath: str) -> str:
     Returns:
         str: JSON containing extracted text with positional metadata.
     """
+    return cached_artifact(filepath, 'text:pdf', lambda: _extract_text_from_pdf(filepath))
+
+
+def _extract_text_from_pdf(filepath: str) -> str:
     with pdfplumber.open(filepath) as pdf:
         data = {}
         for page_num, page in enumerate(pdf.pages):
@@ -78,6 +83,10 @@ def extract_text_from_docx(filepath: str) -> str:
     Returns:
         str: Extracted text with basic formatting.
     """
+    return cached_artifact(filepath, 'text:docx', lambda: _extract_text_from_docx(filepath))
+
+
+def _extract_text_from_docx(filepath: str) -> str:
     doc = Document(filepath)
     extracted_text = []
     
@@ -0,0 +1,167 @@
+import os
+import time
+import uuid
+import asyncio
+import logging
+import aiohttp
+from collections import OrderedDict
+from urllib.parse import urlsplit
+from helpers.admission import AdmissionRejected
+
+jobs_logger = logging.getLogger(__name__)
+
+JOB_TTL = float(os.getenv('JOB_TTL', 3600))
+JOB_MAX_STORED = int(os.getenv('JOB_MAX_STORED', 1000))
+JOB_MAX_PENDING = int(os.getenv('JOB_MAX_PENDING', 100))
+JOB_CALLBACK_TIMEOUT = float(os.getenv('JOB_CALLBACK_TIMEOUT', 10))
+# Callbacks only go to these hosts, over https, so /prompt can't be used to reach internal services
+JOB_CALLBACK_ALLOWED_HOSTS = {
+    host.strip().lower() for host in os.getenv('JOB_CALLBACK_ALLOWED_HOSTS', '').split(',') if host.strip()
+}
+JOB_RETRY_AFTER = 30
+
+
+def validate_callback_url(url: str, allowed_hosts=JOB_CALLBACK_ALLOWED_HOSTS):
+    """
+    Checks that a job callback URL is an https URL on one of the allowed hosts.
+
+    Raises:
+        ValueError: If the URL may not be called back.
+    """
+    if not allowed_hosts:
+        raise ValueError("Job callbacks are disabled, poll the job's status_url instead")
+    try:
+        parts = urlsplit(url)
+        host = (parts.hostname or '').lower()
+    except ValueError:
+        raise ValueError("callback_url is not a valid URL")
+    if parts.scheme != 'https' or host not in allowed_hosts:
+        raise ValueError("callback_url must be an https URL on an allowed host")
+
+
+class Job:
+    def __init__(self, user_id, callback_url=None):
+        self.id = str(uuid.uuid4())
+        self.user_id = user_id
+        self.callback_url = callback_url
+        self.status = 'queued'
+        self.response = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    def start(self):
+        """Marks the job as running, it stays queued until its turn is admitted."""
+        self.status = 'running'
+        self.started_at = time.time()
+
+    @property
+    def done(self) -> bool:
+        return self.status in ('succeeded', 'failed')
+
+    def to_dict(self) -> dict:
+        return {
+            'job_id': self.id,
+            'user_id': self.user_id,
+            'status': self.status,
+            'response': self.response,
+            'error': self.error,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+
+
+class JobStore:
+    """
+    In-memory store of background agent turns for this worker.
+
+    Finished jobs are kept for `ttl` seconds so their results can be collected,
+    and the oldest finished jobs are dropped once more than `max_stored` are held.
+    At most `max_pending` jobs are queued or running at once.
+    """
+
+    def __init__(self, ttl=JOB_TTL, max_stored=JOB_MAX_STORED, max_pending=JOB_MAX_PENDING):
+        self.ttl = ttl
+        self.max_stored = max_stored
+        self.max_pending = max_pending
+        self._jobs = OrderedDict()
+        self._tasks = set()  # Strong references so running jobs aren't garbage collected
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def get(self, job_id):
+        self._evict()
+        return self._jobs.get(job_id)
+
+    def submit(self, user_id, run, callback_url=None) -> Job:
+        """
+        Starts `run(job)` in the background and returns its job straight away.
+
+        Args:
+            user_id: The user the job belongs to.
+            run: A coroutine function taking the job and returning its response.
+                It calls job.start() once the job gets to run.
+            callback_url (str): Optional URL the finished job is POSTed to, see
+                validate_callback_url().
+
+        Returns:
+            Job: The queued job.
+
+        Raises:
+            ValueError: If the callback URL isn't allowed.
+            AdmissionRejected: If `max_pending` jobs are already queued or running.
+        """
+        if callback_url:
+            validate_callback_url(callback_url)
+        self._evict()
+        if self.pending() >= self.max_pending:
+            raise AdmissionRejected("Too many background requests in progress, please try again later.",
+                                    JOB_RETRY_AFTER)
+        job = Job(user_id, callback_url)
+        self._jobs[job.id] = job
+        task = asyncio.create_task(self._run(job, run))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return job
+
+    def running(self) -> int:
+        return sum(1 for job in self._jobs.values() if job.status == 'running')
+
+    def pending(self) -> int:
+        """Number of jobs queued or running."""
+        return sum(1 for job in self._jobs.values() if not job.done)
+
+    async def _run(self, job, run):
+        try:
+            job.response = await run(job)
+            job.status = 'succeeded'
+        except Exception as e:
+            job.error = str(e)
+            job.status = 'failed'
+        job.finished_at = time.time()
+        if job.callback_url:
+            await self._notify(job)
+
+    async def _notify(self, job):
+        try:
+            timeout = aiohttp.ClientTimeout(total=JOB_CALLBACK_TIMEOUT)
+            async with aiohttp.ClientSession(timeout=timeout) as session:
+                # A redirect could lead anywhere, the allowed host has to answer itself
+                async with session.post(job.callback_url, json=job.to_dict(), allow_redirects=False) as response:
+                    if response.status >= 400:
+                        jobs_logger.warning(f"Job {job.id} callback returned {response.status}")
+        except Exception as e:
+            jobs_logger.warning(f"Job {job.id} callback failed: {e}")
+
+    def _evict(self):
+        cutoff = time.time() - self.ttl
+        finished = [job_id for job_id, job in self._jobs.items() if job.done]
+        excess = len(self._jobs) - self.max_stored
+        for job_id in finished:
+            job = self._jobs[job_id]
+            if job.finished_at < cutoff or excess > 0:
+                del self._jobs[job_id]
+                excess -= 1
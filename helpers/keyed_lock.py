@@ -0,0 +1,37 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+
+class KeyedLock:
+    """
+    A set of asyncio locks keyed by an arbitrary hashable value.
+
+    Holders of different keys never wait for each other, while holders of the same
+    key are serialized. Locks are created on demand and dropped as soon as nobody
+    holds or waits for them, so the number of live locks never exceeds the number
+    of in-flight keys.
+    """
+
+    def __init__(self):
+        self._locks = {}  # key -> [asyncio.Lock, number of holders and waiters]
+
+    def __len__(self):
+        return len(self._locks)
+
+    def locked(self, key) -> bool:
+        entry = self._locks.get(key)
+        return bool(entry and entry[0].locked())
+
+    @asynccontextmanager
+    async def acquire(self, key):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
@@ -0,0 +1,88 @@
+import os
+import time
+from helpers.database import execute, executemany
+
+MAIL_CACHE_MAX_MESSAGES = int(os.getenv('MAIL_CACHE_MAX_MESSAGES', 500))
+
+
+def get_sync_state(user_id: str):
+    """
+    Returns where a user's mailbox sync stands.
+
+    Returns:
+        tuple: (delta_link, window_start). `delta_link` returns the changes since
+        the last sync, None if the mailbox was never synced. `window_start` is the
+        oldest receivedDateTime the sync covers, None when it covers the whole inbox.
+    """
+    row = execute("SELECT delta_link, window_start FROM mail_sync_state WHERE user_id = ?", (user_id,), fetch='one')
+    if not row:
+        return None, None
+    return row[0], row[1]
+
+
+def save_sync_state(user_id: str, delta_link: str, window_start: str):
+    execute(
+        "INSERT OR REPLACE INTO mail_sync_state (user_id, delta_link, window_start, synced_at) VALUES (?, ?, ?, ?)",
+        (user_id, delta_link, window_start, time.time())
+    )
+
+
+def reset(user_id: str):
+    """Forgets a user's cached messages and sync state."""
+    execute("DELETE FROM mail_sync_state WHERE user_id = ?", (user_id,))
+    execute("DELETE FROM mail_messages WHERE user_id = ?", (user_id,))
+
+
+def apply_changes(user_id: str, messages: list):
+    """
+    Applies a page of Graph messages to the cache.
+
+    Args:
+        user_id (str): The user's ID.
+        messages (list): Graph message objects. Entries marked `@removed` are
+            deleted, the others are inserted or updated. Fields missing from an
+            update keep their cached value.
+    """
+    removed = [(user_id, message['id']) for message in messages if '@removed' in message]
+    changed = [
+        (
+            user_id,
+            message['id'],
+            message.get('receivedDateTime'),
+            message.get('subject'),
+            ((message.get('from') or {}).get('emailAddress') or {}).get('address'),
+            message.get('bodyPreview'),
+            None if message.get('isRead') is None else int(message['isRead']),
+        )
+        for message in messages if '@removed' not in message
+    ]
+    if removed:
+        executemany("DELETE FROM mail_messages WHERE user_id = ? AND message_id = ?", removed)
+    if changed:
+        executemany(
+            "INSERT INTO mail_messages (user_id, message_id, received_at, subject, sender, preview, is_read) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT(user_id, message_id) DO UPDATE SET "
+            "received_at = COALESCE(excluded.received_at, received_at), subject = COALESCE(excluded.subject, subject), "
+            "sender = COALESCE(excluded.sender, sender), preview = COALESCE(excluded.preview, preview), "
+            "is_read = COALESCE(excluded.is_read, is_read)",
+            changed
+        )
+
+
+def count(user_id: str) -> int:
+    row = execute("SELECT COUNT(*) FROM mail_messages WHERE user_id = ?", (user_id,), fetch='one')
+    return row[0] if row else 0
+
+
+def latest(user_id: str, limit: int) -> list:
+    """
+    Returns a user's most recent cached messages.
+
+    Returns:
+        list: (received_at, subject, sender, preview, is_read) tuples, newest first.
+    """
+    return execute(
+        "SELECT received_at, subject, sender, preview, is_read FROM mail_messages WHERE user_id = ? "
+        "ORDER BY received_at DESC LIMIT ?",
+        (user_id, limit), fetch='all'
+    )
@@ -0,0 +1,137 @@
+import time
+import functools
+from contextlib import contextmanager
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+from llama_index.core.instrumentation import get_dispatcher
+from llama_index.core.instrumentation.event_handlers import BaseEventHandler
+from llama_index.core.instrumentation.events.llm import (
+    LLMChatStartEvent,
+    LLMChatEndEvent,
+    LLMCompletionStartEvent,
+    LLMCompletionEndEvent,
+)
+
+REGISTRY = CollectorRegistry()
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+PROMPT_LATENCY = Histogram(
+    'ai_employee_prompt_seconds', 'Time to answer a /prompt request', ['mode'],
+    buckets=LATENCY_BUCKETS, registry=REGISTRY
+)
+PROMPT_RESPONSES = Counter(
+    'ai_employee_prompt_responses_total', '/prompt responses by status code', ['status'], registry=REGISTRY
+)
+TURN_LATENCY = Histogram(
+    'ai_employee_turn_seconds', 'Duration of an agent turn', ['mode'], buckets=LATENCY_BUCKETS, registry=REGISTRY
+)
+TURN_ITERATIONS = Histogram(
+    'ai_employee_turn_iterations', 'ReAct iterations per agent turn',
+    buckets=(1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 30), registry=REGISTRY
+)
+LLM_LATENCY = Histogram(
+    'ai_employee_llm_call_seconds', 'Latency of LLM calls', ['backend'], buckets=LATENCY_BUCKETS, registry=REGISTRY
+)
+LLM_TOKENS = Counter(
+    'ai_employee_llm_tokens_total', 'Tokens used by LLM calls', ['backend', 'kind'], registry=REGISTRY
+)
+TOOL_LATENCY = Histogram(
+    'ai_employee_tool_seconds', 'Latency of tool calls', ['tool'], buckets=LATENCY_BUCKETS, registry=REGISTRY
+)
+TOOL_CALLS = Counter(
+    'ai_employee_tool_calls_total', 'Tool calls by outcome', ['tool', 'outcome'], registry=REGISTRY
+)
+ADMISSION_WAIT = Histogram(
+    'ai_employee_admission_wait_seconds', 'Time turns wait for an admission slot',
+    buckets=(0, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120), registry=REGISTRY
+)
+ACTIVE_SESSIONS = Gauge('ai_employee_active_sessions', 'User agents held in the agent pool', registry=REGISTRY)
+AGENT_POOL_EVENTS = Counter(
+    'ai_employee_agent_pool_events', 'Agent pool hits, misses and evictions', ['event'], registry=REGISTRY
+)
+INFLIGHT_TURNS = Gauge('ai_employee_inflight_turns', 'Agent turns currently running', registry=REGISTRY)
+QUEUED_TURNS = Gauge('ai_employee_queued_turns', 'Agent turns waiting for an admission slot', registry=REGISTRY)
+RUNNING_JOBS = Gauge('ai_employee_running_jobs', 'Background jobs not yet finished', registry=REGISTRY)
+
+
+@contextmanager
+def observe_tool(name: str):
+    """Times a tool call and counts it as an error if it raises."""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        TOOL_CALLS.labels(tool=name, outcome='error').inc()
+        raise
+    else:
+        TOOL_CALLS.labels(tool=name, outcome='ok').inc()
+    finally:
+        TOOL_LATENCY.labels(tool=name).observe(time.perf_counter() - start)
+
+
+def instrument_tool(fn, name: str):
+    """Wraps a tool function so every call is timed with observe_tool."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with observe_tool(name):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+def render_metrics():
+    """Returns the exposition body and its content type."""
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+
+
+def _token_usage(response):
+    """Pulls (prompt, completion) token counts out of the varied raw responses of each backend."""
+    if response is None:
+        return None, None
+    raw = getattr(response, 'raw', None) or {}
+    usage = raw.get('usage') if isinstance(raw, dict) else getattr(raw, 'usage', None)
+    if usage is not None and not isinstance(usage, dict):
+        usage = usage.model_dump() if hasattr(usage, 'model_dump') else vars(usage)
+    usage = usage or getattr(response, 'additional_kwargs', None) or {}
+    prompt = usage.get('prompt_tokens') or usage.get('input_tokens') or usage.get('inputTokens')
+    completion = usage.get('completion_tokens') or usage.get('output_tokens') or usage.get('outputTokens')
+    return prompt, completion
+
+
+_llm_calls_started = {}  # span_id -> (start time, backend)
+
+
+class LLMMetricsHandler(BaseEventHandler):
+    """Records latency and token usage of every LLM call made through llama_index."""
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "LLMMetricsHandler"
+
+    def handle(self, event, **kwargs):
+        if isinstance(event, (LLMChatStartEvent, LLMCompletionStartEvent)):
+            backend = (event.model_dict or {}).get('class_name', 'unknown')
+            if len(_llm_calls_started) > 10000:
+                _llm_calls_started.clear()  # Calls that failed never send an end event
+            _llm_calls_started[event.span_id] = (time.perf_counter(), backend)
+        elif isinstance(event, (LLMChatEndEvent, LLMCompletionEndEvent)):
+            started = _llm_calls_started.pop(event.span_id, None)
+            if started is None:
+                return
+            start, backend = started
+            LLM_LATENCY.labels(backend=backend).observe(time.perf_counter() - start)
+            prompt, completion = _token_usage(event.response)
+            if prompt:
+                LLM_TOKENS.labels(backend=backend, kind='prompt').inc(prompt)
+            if completion:
+                LLM_TOKENS.labels(backend=backend, kind='completion').inc(completion)
+
+
+_llm_handler = None
+
+
+def install_llm_metrics():
+    """Subscribes the LLM metrics handler to llama_index's root dispatcher once per process."""
+    global _llm_handler
+    if _llm_handler is None:
+        _llm_handler = LLMMetricsHandler()
+        get_dispatcher().add_event_handler(_llm_handler)
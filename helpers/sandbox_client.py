@@ -0,0 +1,263 @@
+import os
+import time
+import base64
+import random
+import asyncio
+import logging
+import httpx
+import requests
+from contextlib import asynccontextmanager
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError
+from prometheus_client import Counter, Histogram
+from helpers.metrics import REGISTRY, LATENCY_BUCKETS
+
+sandbox_logger = logging.getLogger(__name__)
+
+SANDBOX_URL = os.getenv('SANDBOX_ENDPOINT', '')
+SANDBOX_EXECUTE_TIMEOUT = float(os.getenv('SANDBOX_EXECUTE_TIMEOUT', 600))
+SANDBOX_UPLOAD_TIMEOUT = float(os.getenv('SANDBOX_UPLOAD_TIMEOUT', 30))
+SANDBOX_CONNECT_TIMEOUT = float(os.getenv('SANDBOX_CONNECT_TIMEOUT', 10))
+SANDBOX_MAX_RETRIES = int(os.getenv('SANDBOX_MAX_RETRIES', 3))
+SANDBOX_POOL_SIZE = int(os.getenv('SANDBOX_POOL_SIZE', 16))
+SANDBOX_FILE_UPLOAD_PATH = os.getenv('SANDBOX_FILE_UPLOAD_PATH', '/upload_file')
+
+RETRY_STATUS_CODES = {502, 503, 504}
+# Answers that mean a request wasn't run, the only ones retried for requests that mustn't run twice
+UNSENT_RETRY_STATUS_CODES = {503}
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 8.0
+
+SANDBOX_LATENCY = Histogram(
+    'ai_employee_sandbox_request_seconds', 'Latency of sandbox requests', ['endpoint'],
+    buckets=LATENCY_BUCKETS, registry=REGISTRY
+)
+SANDBOX_REQUESTS = Counter(
+    'ai_employee_sandbox_requests_total', 'Sandbox requests by outcome', ['endpoint', 'outcome'], registry=REGISTRY
+)
+
+_session = None
+_async_client = None
+_async_client_loop = None
+_binary_upload_supported = True
+
+
+class SandboxError(Exception):
+    """Raised when the sandbox can't be reached or keeps failing within the call's deadline."""
+
+
+def get_session() -> requests.Session:
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=SANDBOX_POOL_SIZE, pool_maxsize=SANDBOX_POOL_SIZE)
+        _session.mount("http://", adapter)
+        _session.mount("https://", adapter)
+    return _session
+
+
+@asynccontextmanager
+async def get_async_client():
+    """Yields the pooled client of the event loop it was created on, or a short-lived one on any other loop."""
+    global _async_client, _async_client_loop
+    loop = asyncio.get_running_loop()
+    if _async_client is None or _async_client.is_closed:
+        _async_client = httpx.AsyncClient(limits=httpx.Limits(max_connections=SANDBOX_POOL_SIZE))
+        _async_client_loop = loop
+    if _async_client_loop is loop:
+        yield _async_client
+    else:
+        async with httpx.AsyncClient() as client:
+            yield client
+
+
+def _backoff(attempt: int) -> float:
+    # Full jitter, so retries from many callers don't arrive in lockstep
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def _timeout_for(remaining: float) -> float:
+    return max(0.1, remaining)
+
+
+def _retry_status_codes(idempotent: bool):
+    return RETRY_STATUS_CODES if idempotent else UNSENT_RETRY_STATUS_CODES
+
+
+def _connection_failed(error: requests.ConnectionError) -> bool:
+    """Whether the connection couldn't be opened, i.e. the sandbox never got the request."""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    # requests wraps urllib3's MaxRetryError, whose reason is NewConnectionError when the connection was refused
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, ConnectTimeoutError)
+
+
+def post(endpoint: str, deadline: float, idempotent: bool = True, **kwargs) -> requests.Response:
+    """
+    POSTs to a sandbox endpoint, retrying transient failures until the deadline.
+
+    Connection errors and 502/503/504 responses are retried with jittered
+    exponential backoff. Read timeouts are not retried, the sandbox may still be
+    running the request. Requests that mustn't run twice are only retried when
+    the connection couldn't be opened or the sandbox answered 503.
+
+    Args:
+        endpoint (str): The sandbox path, e.g. '/execute'.
+        deadline (float): Seconds the whole call, retries included, may take.
+        idempotent (bool): False for requests with side effects, like running code.
+
+    Returns:
+        requests.Response: The final response.
+    """
+    url = f"{SANDBOX_URL}{endpoint}"
+    end = time.monotonic() + deadline
+    attempt = 0
+    body = kwargs.get('data')
+    while True:
+        if hasattr(body, 'seek'):
+            body.seek(0)  # Rewind file bodies so a retry sends them in full
+        start = time.monotonic()
+        remaining = end - start
+        try:
+            response = get_session().post(
+                url, timeout=(min(SANDBOX_CONNECT_TIMEOUT, _timeout_for(remaining)), _timeout_for(remaining)), **kwargs
+            )
+            retry = response.status_code in _retry_status_codes(idempotent)
+            error = f"status {response.status_code}" if retry else None
+        except requests.ConnectionError as e:
+            if not idempotent and not _connection_failed(e):
+                SANDBOX_REQUESTS.labels(endpoint=endpoint, outcome='error').inc()
+                raise SandboxError(f"Sandbox request to {endpoint} failed: {e}") from e
+            response, error = None, e
+        except requests.Timeout as e:
+            SANDBOX_REQUESTS.labels(endpoint=endpoint, outcome='timeout').inc()
+            raise SandboxError(f"Sandbox request to {endpoint} timed out") from e
+        finally:
+            SANDBOX_LATENCY.labels(endpoint=endpoint).observe(time.monotonic() - start)
+
+        if error is None:
+            SANDBOX_REQUESTS.labels(endpoint=endpoint, outcome='ok').inc()
+            return response
+
+        delay = _backoff(attempt)
+        attempt += 1
+        if attempt > SANDBOX_MAX_RETRIES or time.monotonic() + delay >= end:
+            SANDBOX_REQUESTS.labels(endpoint=endpoint, outcome='error').inc()
+            if response is not None:
+                return response
+            raise SandboxError(f"Sandbox request to {endpoint} failed: {error}")
+        SANDBOX_REQUESTS.labels(endpoint=endpoint, outcome='retry').inc()
+        sandbox_logger.debug(f"Retrying sandbox request to {endpoint} in {delay:.2f}s ({error})")
+        time.sleep(delay)
+
+
+async def apost(endpoint: str, deadline: float, idempotent: bool = True, **kwargs) -> httpx.Response:
+    """Async variant of post() using a pooled httpx client."""
+    url = f"{SANDBOX_URL}{endpoint}"
+    end = time.monotonic() + deadline
+    attempt = 0
+    while True:
+        start = time.monotonic()
+        remaining = end - start
+        try:
+            timeout = httpx.Timeout(_timeout_for(remaining), connect=min(SANDBOX_CONNECT_TIMEOUT, _timeout_for(remaining)))
+            async with get_async_client() as client:
+                response = await client.post(url, timeout=timeout, **kwargs)
+            retry = response.status_code in _retry_status_codes(idempotent)
+            error = f"status {response.status_code}" if retry else None
+        except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+            response, error = None, e
+        except httpx.RemoteProtocolError as e:
+            if not idempotent:
+                SANDBOX_REQUESTS.labels(endpoint=endpoint, outcome='error').inc()
+                raise SandboxError(f"Sandbox request to {endpoint} failed: {e}") from e
+            response, error = None, e
+        except httpx.TimeoutException as e:
+            SANDBOX_REQUESTS.labels(endpoint=endpoint, outcome='timeout').inc()
+            raise SandboxError(f"Sandbox request to {endpoint} timed out") from e
+        finally:
+            SANDBOX_LATENCY.labels(endpoint=endpoint).observe(time.monotonic() - start)
+
+        if error is None:
+            SANDBOX_REQUESTS.labels(endpoint=endpoint, outcome='ok').inc()
+            return response
+
+        delay = _backoff(attempt)
+        attempt += 1
+        if attempt > SANDBOX_MAX_RETRIES or time.monotonic() + delay >= end:
+            SANDBOX_REQUESTS.labels(endpoint=endpoint, outcome='error').inc()
+            if response is not None:
+                return response
+            raise SandboxError(f"Sandbox request to {endpoint} failed: {error}")
+        SANDBOX_REQUESTS.labels(endpoint=endpoint, outcome='retry').inc()
+        sandbox_logger.debug(f"Retrying sandbox request to {endpoint} in {delay:.2f}s ({error})")
+        await asyncio.sleep(delay)
+
+
+def execute(query: str, deadline: float = SANDBOX_EXECUTE_TIMEOUT):
+    """Sends a natural language query to the sandbox's coding model and returns its output."""
+    # Not idempotent, a retried query may run its code twice
+    response = post("/execute", deadline, idempotent=False, json={"query": query})
+    return response.json().get("output", "No output received")
+
+
+async def aexecute(query: str, deadline: float = SANDBOX_EXECUTE_TIMEOUT):
+    response = await apost("/execute", deadline, idempotent=False, json={"query": query})
+    return response.json().get("output", "No output received")
+
+
+def upload_code(code: str, deadline: float = SANDBOX_UPLOAD_TIMEOUT):
+    """
+    Runs file-saving code on the sandbox and returns the saved file name(s).
+
+    Returns:
+        The 'files' entry of the sandbox output, or the raw output if there isn't one.
+    """
+    response = post("/upload", deadline, json={"code": code})
+    return _uploaded_files(response)
+
+
+def upload_file(fileobj, filename: str, content_type: str = 'application/octet-stream',
+                deadline: float = SANDBOX_UPLOAD_TIMEOUT):
+    """
+    Uploads a file to the sandbox's download directory and returns the saved file name(s).
+
+    The bytes are streamed from `fileobj` as the raw request body, so no encoded
+    copies are made. Sandboxes without the binary endpoint get the legacy
+    code-based upload instead.
+
+    Args:
+        fileobj: A binary file object, e.g. io.BytesIO, positioned anywhere.
+        filename (str): The name to save the file under.
+        content_type (str): The MIME type of the file.
+
+    Returns:
+        The 'files' entry of the sandbox output, or the raw output if there isn't one.
+    """
+    global _binary_upload_supported
+    if _binary_upload_supported:
+        response = post(SANDBOX_FILE_UPLOAD_PATH, deadline, data=fileobj, params={"filename": filename},
+                        headers={"Content-Type": content_type})
+        if response.status_code not in (404, 405):
+            return _uploaded_files(response)
+        sandbox_logger.info(f"Sandbox has no {SANDBOX_FILE_UPLOAD_PATH} endpoint, using code uploads")
+        _binary_upload_supported = False
+
+    fileobj.seek(0)
+    encoded = base64.b64encode(fileobj.read()).decode("utf-8")
+    code = f"""
+import base64
+
+# Decode and save the file
+with open("/tmp/sandbox/{filename}", "wb") as f:
+    f.write(base64.b64decode("{encoded}"))
+    """
+    return upload_code(code, deadline)
+
+
+def _uploaded_files(response):
+    r = response.json().get("output", "No output received")
+    if isinstance(r, dict):
+        r = r["files"]
+    return r
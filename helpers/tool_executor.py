@@ -0,0 +1,111 @@
+import os
+import asyncio
+import functools
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+# Default number of concurrent calls per class of tool, override with TOOL_CONCURRENCY_<CLASS>
+DEFAULT_TOOL_CONCURRENCY = {
+    'sandbox': 8,
+    'document': 2,
+    'image': 4,
+    'email': 8,
+    'direct_line': 8,
+    'search': 8,
+    'translation': 2,
+}
+
+TOOL_MAX_THREADS = int(os.getenv('TOOL_MAX_THREADS', 32))
+
+_executor = ThreadPoolExecutor(max_workers=TOOL_MAX_THREADS, thread_name_prefix="tool")
+_semaphores = {}
+_loop = None  # The event loop run_blocking() runs coroutines on
+_loop_lock = threading.Lock()
+
+
+def get_tool_concurrency(tool_class: str) -> int:
+    return int(os.getenv(f"TOOL_CONCURRENCY_{tool_class.upper()}", DEFAULT_TOOL_CONCURRENCY.get(tool_class, 4)))
+
+
+def _get_semaphore(tool_class: str) -> asyncio.Semaphore:
+    semaphore = _semaphores.get(tool_class)
+    if semaphore is None:
+        semaphore = _semaphores[tool_class] = asyncio.Semaphore(get_tool_concurrency(tool_class))
+    return semaphore
+
+
+async def run_tool(tool_class: str, fn, *args, **kwargs):
+    """
+    Runs a synchronous tool function in the shared tool thread pool.
+
+    At most TOOL_CONCURRENCY_<CLASS> calls of the same class run at once, further
+    calls wait without blocking the event loop.
+
+    Args:
+        tool_class (str): The class of tool, e.g. 'sandbox' or 'email'.
+        fn: The synchronous function to run.
+
+    Returns:
+        The return value of `fn`.
+    """
+    async with _get_semaphore(tool_class):
+        loop = asyncio.get_running_loop()
+        ctx = contextvars.copy_context()
+        return await loop.run_in_executor(_executor, functools.partial(ctx.run, fn, *args, **kwargs))
+
+
+async def run_async_tool(tool_class: str, coro_fn, *args, **kwargs):
+    """Runs an async tool function under the concurrency limit of its class."""
+    async with _get_semaphore(tool_class):
+        return await coro_fn(*args, **kwargs)
+
+
+def make_async(fn, tool_class: str):
+    """
+    Wraps a synchronous tool function in an async function with the same signature,
+    suitable for FunctionTool's `async_fn`.
+    """
+    @functools.wraps(fn)
+    async def async_fn(*args, **kwargs):
+        return await run_tool(tool_class, fn, *args, **kwargs)
+    return async_fn
+
+
+def set_event_loop(loop):
+    """Makes run_blocking() run coroutines on `loop`, the server's loop that the shared clients are bound to."""
+    global _loop
+    with _loop_lock:
+        _loop = loop
+
+
+def _get_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None or _loop.is_closed():
+            # No server loop, keep one in the background for the life of the process
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="tool-loop", daemon=True).start()
+        return _loop
+
+
+def run_blocking(coro_fn, *args, **kwargs):
+    """
+    Runs an async tool function from synchronous code and returns its result.
+
+    The coroutine runs on the loop set with set_event_loop(), or on a background
+    loop kept for the life of the process. Semaphores and pooled clients bound to
+    that loop are then never used from a second one, as they would be with a new
+    asyncio.run() loop per call.
+
+    Raises:
+        RuntimeError: If called from that loop's own thread, it would wait on itself.
+    """
+    loop = _get_loop()
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is loop:
+        raise RuntimeError("run_blocking() can't wait for its own event loop, await the tool instead")
+    return asyncio.run_coroutine_threadsafe(coro_fn(*args, **kwargs), loop).result()
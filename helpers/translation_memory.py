@@ -0,0 +1,119 @@
+import os
+import time
+import hashlib
+from prometheus_client import Counter
+from helpers.database import execute, executemany
+from helpers.metrics import REGISTRY
+
+AUTO_LANGUAGE = 'auto'
+# SQLite's default limit on host parameters is 999, leave room for the other key columns
+LOOKUP_CHUNK_SIZE = 500
+
+TRANSLATION_MEMORY_LOOKUPS = Counter(
+    'ai_employee_translation_memory_lookups_total', 'Translation memory lookups by outcome', ['outcome'],
+    registry=REGISTRY
+)
+
+_hits = 0
+_misses = 0
+
+
+def normalize_segment(text: str) -> str:
+    """Collapses whitespace, the same sentence with different spacing translates the same."""
+    return " ".join(text.split())
+
+
+def normalize_language(language) -> str:
+    return (language or AUTO_LANGUAGE).strip().lower()
+
+
+def current_model() -> str:
+    return os.getenv('MODEL_NAME', '')
+
+
+def segment_hash(text: str) -> str:
+    return hashlib.sha256(normalize_segment(text).encode("utf-8")).hexdigest()
+
+
+def lookup(texts, target_language: str, source_language: str = None, model: str = None) -> dict:
+    """
+    Returns the remembered translations of the given texts.
+
+    Args:
+        texts: The source texts.
+        target_language (str): The language translated into.
+        source_language (str): The language translated from, None when unknown.
+        model (str): The translation model, defaults to MODEL_NAME.
+
+    Returns:
+        dict: Source text -> translation, for the texts that have one.
+    """
+    global _hits, _misses
+    hashes = {}
+    for text in texts:
+        hashes.setdefault(segment_hash(text), []).append(text)
+    key = (normalize_language(source_language), normalize_language(target_language), model or current_model())
+
+    found = {}
+    keys = list(hashes)
+    for i in range(0, len(keys), LOOKUP_CHUNK_SIZE):
+        chunk = keys[i:i + LOOKUP_CHUNK_SIZE]
+        rows = execute(
+            "SELECT source_hash, translation FROM translation_memory WHERE source_language = ? "
+            f"AND target_language = ? AND model = ? AND source_hash IN ({', '.join('?' * len(chunk))})",
+            (*key, *chunk), fetch='all'
+        )
+        for source_hash, translation in rows:
+            for text in hashes[source_hash]:
+                found[text] = translation
+        if rows:
+            executemany(
+                "UPDATE translation_memory SET hits = hits + 1, last_used_at = ? WHERE source_hash = ? "
+                "AND source_language = ? AND target_language = ? AND model = ?",
+                [(time.time(), source_hash, *key) for source_hash, _ in rows]
+            )
+
+    hits = len(found)
+    misses = sum(len(set(group)) for group in hashes.values()) - hits
+    _hits += hits
+    _misses += misses
+    TRANSLATION_MEMORY_LOOKUPS.labels(outcome='hit').inc(hits)
+    TRANSLATION_MEMORY_LOOKUPS.labels(outcome='miss').inc(misses)
+    return found
+
+
+def store(translations: dict, target_language: str, source_language: str = None, model: str = None):
+    """
+    Remembers translations, replacing older translations of the same text.
+
+    Args:
+        translations (dict): Source text -> translation. Empty translations are ignored.
+        target_language (str): The language translated into.
+        source_language (str): The language translated from, None when unknown.
+        model (str): The translation model, defaults to MODEL_NAME.
+    """
+    key = (normalize_language(source_language), normalize_language(target_language), model or current_model())
+    now = time.time()
+    rows = [
+        (segment_hash(source), *key, normalize_segment(source), translation.strip(), now, now)
+        for source, translation in translations.items()
+        if source.strip() and translation and translation.strip()
+    ]
+    if rows:
+        executemany(
+            "INSERT OR REPLACE INTO translation_memory (source_hash, source_language, target_language, model, source, "
+            "translation, created_at, last_used_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            rows
+        )
+
+
+def stats() -> dict:
+    """Lookup counters of this worker and the number of remembered translations."""
+    lookups = _hits + _misses
+    row = execute("SELECT COUNT(*) FROM translation_memory", fetch='one')
+    return {
+        'entries': row[0] if row else 0,
+        'hits': _hits,
+        'misses': _misses,
+        'hit_rate': round(_hits / lookups, 3) if lookups else None,
+    }
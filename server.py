@@ -1,12 +1,27 @@
 import os
 import aiohttp
 import logging
+import json
+import time
 import asyncio
-import sqlite3
-from core import get_agent
-from quart import Quart, request, jsonify
+from core import get_agent, get_shared_llm, get_tools, chat_turn, stream_turn
+from quart import Quart, Response, request, jsonify
 # Import helper functions
-from helpers.attachments_handler import download_and_save
+from helpers.attachments_handler import download_attachments
+from helpers.agent_pool import AgentPool
+from helpers.keyed_lock import KeyedLock
+from helpers.jobs import JobStore
+from helpers.tool_executor import set_event_loop
+from helpers.admission import AdmissionController, AdmissionRejected
+from helpers.metrics import (
+    render_metrics, PROMPT_LATENCY, PROMPT_RESPONSES, TURN_LATENCY, ADMISSION_WAIT,
+    ACTIVE_SESSIONS, INFLIGHT_TURNS, QUEUED_TURNS, RUNNING_JOBS,
+)
+from helpers.database import init_db, ensure_user_async, run_async
+from helpers import translation_memory
+from tools.edit_word_doc import document_cache
+from tools.translate_document import translation_progress
+from tools import token_manager
 
 # Set up logging
 DEBUG = os.getenv('DEBUG', 'False').lower() == 'true'
@@ -22,41 +37,100 @@ CLIENT_ID = os.getenv("CLIENT_ID", "")
 CLIENT_SECRET = os.getenv("CLIENT_SECRET", "")
 REDIRECT_URI = os.getenv("REDIRECT_URI", "")
 TENANT_ID = os.getenv('TENANT_ID', '')
-TOKEN_URL = f"https://login.microsoftonline.com/{TENANT_ID}/oauth2/v2.0/token"
+TOKEN_URL = token_manager.TOKEN_URL
 GRAPH_API_URL = "https://graph.microsoft.com/v1.0/me"
 
 # Initialize the app
 app = Quart(__name__)
+# Streamed responses can last as long as a full agent run
+app.config["RESPONSE_TIMEOUT"] = float(os.getenv('RESPONSE_TIMEOUT', 600))
 
 app.logger.setLevel(logging.DEBUG)
 
-user_agents = {}
-user_agents_lock = asyncio.Lock()
-
-def init_db():
-    conn = sqlite3.connect('ai_employee.db')
-    cursor = conn.cursor()
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id TEXT NOT NULL,
-            channel_id TEXT NOT NULL,
-            user_email TEXT,
-            access_token TEXT,
-            UNIQUE(user_id, channel_id)
-        )
-    """)
-    conn.commit()
-    conn.close()
+user_agents = AgentPool()
+user_locks = KeyedLock()  # Serializes turns per user, different users run in parallel
+jobs = JobStore()
+admission = AdmissionController(user_locks)  # Bounds concurrent agent turns and queues the rest
 
 init_db()  # Ensure the database is set up at startup
 
-if DEBUG:
-    app.logger.info("AGENT CREATED AND READY TO CHAT")
+@app.before_serving
+async def warm_up():
+    """Builds the shared LLM client and tools before the first user arrives."""
+    # Synchronous tool calls run their coroutines on this loop too
+    set_event_loop(asyncio.get_running_loop())
+    get_shared_llm()
+    get_tools()
+    if DEBUG:
+        app.logger.info("AGENT CREATED AND READY TO CHAT")
+
+async def get_user_agent(user_id):
+    """Returns the user's agent, creating one if needed. Call while holding the user's lock."""
+    agent = user_agents.get(user_id)
+    if agent is None:
+        agent = await asyncio.to_thread(get_agent)  # Create a new agent off the event loop
+        user_agents.put(user_id, agent)
+        if DEBUG:
+            app.logger.info(f"New agent created for user: {user_id}")
+    return agent
+
+
+async def run_turn(user_id, full_message, on_admitted=None):
+    """
+    Runs one chat turn for the user and returns the agent's response.
+
+    `on_admitted` is called once the turn has been admitted and starts running.
+    """
+    async with admission.admit(user_id) as waited:
+        ADMISSION_WAIT.observe(waited)
+        if on_admitted is not None:
+            on_admitted()
+        start = time.perf_counter()
+        agent = await get_user_agent(user_id)
+        response = await chat_turn(agent, full_message)
+        user_agents.touch(user_id)
+        TURN_LATENCY.labels(mode="wait").observe(time.perf_counter() - start)
+
+    if not isinstance(response, (dict, list)):
+        response = str(response)
+    if DEBUG:
+        app.logger.info(f"RESPONSE: {response}")
+    return response
+
+
+async def stream_events(user_id, full_message, started):
+    """
+    Runs a turn for the user and yields its progress events as JSON lines.
+
+    `started` is the perf_counter() time the request came in, the request's
+    latency is recorded once the stream ends.
+    """
+    try:
+        async with admission.admit(user_id) as waited:
+            ADMISSION_WAIT.observe(waited)
+            start = time.perf_counter()
+            try:
+                agent = await get_user_agent(user_id)
+                async for event in stream_turn(agent, full_message):
+                    if DEBUG and event["type"] != "token":
+                        app.logger.info(f"STREAM EVENT: {event}")
+                    yield json.dumps(event) + "\n"
+            finally:
+                user_agents.touch(user_id)
+                TURN_LATENCY.labels(mode="stream").observe(time.perf_counter() - start)
+    except AdmissionRejected as e:
+        yield json.dumps({"type": "error", "error": str(e), "retry_after": e.retry_after}) + "\n"
+    except Exception as e:
+        yield json.dumps({"type": "error", "error": str(e)}) + "\n"
+    finally:
+        PROMPT_LATENCY.labels(mode="stream").observe(time.perf_counter() - started)
+
 
 @app.route("/prompt", methods=["POST"])
 async def prompt():
     """Handles messages from Azure Bot, processes with LLM asynchronously, and responds with context."""
+    start = time.perf_counter()
+    mode = "wait"
     try:
         data = await request.get_json()
         prompt = data.get("prompt", '')
@@ -67,19 +141,16 @@ async def prompt():
             app.logger.info(f"CHANNEL ID: {channel_id}")
             app.logger.info(f"USER PROMPT: {prompt}")
         try:
-            conn = sqlite3.connect('ai_employee.db')
-            cursor = conn.cursor()
-            cursor.execute("INSERT OR IGNORE INTO users (user_id, channel_id) VALUES (?, ?)", (user_id, channel_id))
-            conn.commit()
-            conn.close()
+            await ensure_user_async(user_id, channel_id)
 
             # Check if the user sent the "refresh" command
             if prompt.lower() == "refresh":
                 # Clear the chat history for this user
-                async with user_agents_lock:
-                    if user_id in user_agents:
-                        agent = user_agents[user_id]
+                async with user_locks.acquire(user_id):
+                    agent = user_agents.peek(user_id)
+                    if agent is not None:
                         agent.memory.reset()  # Reset the agent's chat history
+                        user_agents.touch(user_id)
                         if DEBUG:
                             app.logger.info(f"Chat history cleared for user: {user_id}")
                 return jsonify({"response": "Chat history has been refreshed."}), 200
@@ -88,25 +159,12 @@ async def prompt():
             if DEBUG:
                 app.logger.info(f"ATTACHMENTS: {attachments}")
 
-            # Get download URL for attachments
-            file_path = ''
-            if attachments and isinstance(attachments, list) and isinstance(attachments[0], dict):
-                if channel_id == "msteams":
-                    url = attachments[0].get("content", {}).get("downloadUrl")
-                else:
-                    url = next(
-                        (attachments[0].get(key) for key in ["contentUrl", "fileUrl"] if attachments[0].get(key)),
-                        None
-                    )
-                if url:
-                    name = attachments[0].get('name', 'unknown_file')
-                    try:
-                        file_path = download_and_save(url, name)
-                    except Exception as e:
-                        if DEBUG:
-                            app.logger.info(f"Error downloading document:  {e}")
+            # Download every attachment concurrently
+            file_paths, attachment_errors = await download_attachments(attachments, channel_id)
+            if DEBUG and attachment_errors:
+                app.logger.info(f"Error downloading attachments: {attachment_errors}")
         except:
-            file_path = ''
+            file_paths, attachment_errors = [], []
 
         if not user_id:
             return jsonify({"error": "user_id is required"}), 400
@@ -117,32 +175,86 @@ async def prompt():
             full_message_parts.append(f"USER ID: {user_id}")
         if prompt:
             full_message_parts.append(f"PROMPT: {prompt}")
-        if file_path:
+        for file_path in file_paths:
             full_message_parts.append(f"ATTACHMENT: {file_path}")
+        for name, error in attachment_errors:
+            full_message_parts.append(f"ATTACHMENT ERROR: {name}: {error}")
 
         full_message = "\n".join(full_message_parts)
 
         if DEBUG:
             app.logger.info(f"FULL PROMPT: {full_message}")
 
-        # Get or create an agent for this user
-        async with user_agents_lock:
-            if user_id not in user_agents:
-                user_agents[user_id] = get_agent()  # Create a new agent
-                if DEBUG:
-                    app.logger.info(f"New agent created for user: {user_id}")
-
-            agent = user_agents[user_id]
-
-        response = await agent.achat(full_message)
-
-        if not isinstance(response, (dict, list)):
-            response = str(response)
-        if DEBUG:
-            app.logger.info(f"RESPONSE: {response}")
+        # Turn the request away early if the worker is already at capacity
+        admission.check(user_id)
+
+        # Stream tool progress and answer tokens as JSON lines if the client asked for it
+        if data.get("stream"):
+            mode = "stream"
+            return Response(stream_events(user_id, full_message, start), mimetype="application/x-ndjson")
+
+        # Run the turn in the background and hand back a job id straight away
+        if data.get("async"):
+            mode = "async"
+            try:
+                job = jobs.submit(user_id, lambda job: run_turn(user_id, full_message, on_admitted=job.start),
+                                  callback_url=data.get("callback_url"))
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+            return jsonify({"job_id": job.id, "status": job.status, "status_url": f"/jobs/{job.id}"}), 202
+
+        response = await run_turn(user_id, full_message)
         return jsonify({"response": response}), 200
+    except AdmissionRejected as e:
+        return jsonify({"error": str(e), "retry_after": e.retry_after}), 429, {"Retry-After": str(e.retry_after)}
     except Exception as e:
         return jsonify({"error": str(e)}), 500
+    finally:
+        # Streams are timed by stream_events() once they end
+        if mode != "stream":
+            PROMPT_LATENCY.labels(mode=mode).observe(time.perf_counter() - start)
+
+
+@app.after_request
+async def count_prompt_responses(response):
+    if request.path == "/prompt":
+        PROMPT_RESPONSES.labels(status=str(response.status_code)).inc()
+    return response
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+async def job_status(job_id):
+    """Returns the status of a background turn, and its response once it has finished."""
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job.to_dict()), 200
+
+
+@app.route("/status", methods=["GET"])
+async def status():
+    """Reports agent pool, job, admission, document cache, translation memory and token counters for this worker."""
+    return jsonify({
+        "agents": user_agents.stats(),
+        "jobs": {"stored": len(jobs), "pending": jobs.pending(), "running": jobs.running(),
+                 "max_pending": jobs.max_pending},
+        "admission": admission.stats(),
+        "documents": document_cache.stats(),
+        "translations": translation_progress(),
+        "translation_memory": await run_async(translation_memory.stats),
+        "tokens": token_manager.stats(),
+    }), 200
+
+
+@app.route("/metrics", methods=["GET"])
+async def metrics():
+    """Exposes latency histograms, counters and gauges in the Prometheus text format."""
+    ACTIVE_SESSIONS.set(len(user_agents))
+    INFLIGHT_TURNS.set(admission.inflight)
+    QUEUED_TURNS.set(admission.queued)
+    RUNNING_JOBS.set(jobs.running())
+    body, content_type = render_metrics()
+    return Response(body, content_type=content_type)
 
 
 async def get_access_token(auth_code):
@@ -154,7 +266,7 @@ async def get_access_token(auth_code):
             "code": auth_code,
             "redirect_uri": REDIRECT_URI,
             "grant_type": "authorization_code",
-            "scope": "User.Read Mail.Read"
+            "scope": token_manager.GRAPH_SCOPES
         }
         async with session.post(TOKEN_URL, data=data) as response:
             return await response.json()
@@ -183,19 +295,13 @@ async def callback():
     if "access_token" not in token_response:
         return jsonify({"error": "Failed to get access token", "details": token_response}), 400
 
-    access_token = token_response["access_token"]
-
     # Fetch user info from Microsoft Graph
-    user_info = await get_user_info(access_token)
+    user_info = await get_user_info(token_response["access_token"])
     if not user_info:
         return jsonify({"error": "Failed to fetch user info"}), 400
 
     user_email = user_info.get("mail") or user_info.get("userPrincipalName")
 
-    conn = sqlite3.connect('ai_employee.db')
-    cursor = conn.cursor()
-    cursor.execute("UPDATE users SET access_token = ?, user_email = ? WHERE user_id = ?", (access_token, user_email, user_id))
-    conn.commit()
-    conn.close()
+    await token_manager.store(user_id, user_email, token_response)
 
     return jsonify({"message": "Authentication successful!", "user_id": user_id, "email": user_email})
@@ -0,0 +1,108 @@
+import numpy as np
+
+INSIDE = 'Inside'
+OVERLAPPING = 'Overlapping'
+OUTSIDE = 'Outside'
+
+
+def as_boxes(boxes) -> np.ndarray:
+    """Converts a sequence of [x1, y1, x2, y2] boxes to an (N, 4) float array."""
+    return np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+
+
+def normalize_regions(target_area_box):
+    """
+    Accepts a single [x1, y1, x2, y2] region or a list of them.
+
+    Returns:
+        list: A list of regions with their corners ordered, empty if there are none.
+    """
+    if not target_area_box:
+        return []
+    if all(isinstance(value, (int, float)) for value in target_area_box):
+        target_area_box = [target_area_box]
+
+    regions = []
+    for region in target_area_box:
+        if len(region) != 4:
+            raise ValueError(f"A target area needs 4 coordinates [x1, y1, x2, y2], got {list(region)}")
+        x1, y1, x2, y2 = region
+        regions.append([min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)])
+    return regions
+
+
+def containment(boxes: np.ndarray, regions: np.ndarray) -> np.ndarray:
+    """(N, M) mask of the boxes fully inside each region, edges included."""
+    b = boxes[:, None, :]
+    r = regions[None, :, :]
+    return (r[..., 0] <= b[..., 0]) & (r[..., 1] <= b[..., 1]) & (r[..., 2] >= b[..., 2]) & (r[..., 3] >= b[..., 3])
+
+
+def overlap(boxes: np.ndarray, regions: np.ndarray) -> np.ndarray:
+    """(N, M) mask of the boxes that touch or intersect each region."""
+    b = boxes[:, None, :]
+    r = regions[None, :, :]
+    return ~((b[..., 2] < r[..., 0]) | (b[..., 0] > r[..., 2]) | (b[..., 3] < r[..., 1]) | (b[..., 1] > r[..., 3]))
+
+
+def iou(boxes: np.ndarray, regions: np.ndarray) -> np.ndarray:
+    """(N, M) intersection over union of every box with every region."""
+    b = boxes[:, None, :]
+    r = regions[None, :, :]
+    width = np.clip(np.minimum(b[..., 2], r[..., 2]) - np.maximum(b[..., 0], r[..., 0]), 0, None)
+    height = np.clip(np.minimum(b[..., 3], r[..., 3]) - np.maximum(b[..., 1], r[..., 1]), 0, None)
+    intersection = width * height
+    box_area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    region_area = (regions[:, 2] - regions[:, 0]) * (regions[:, 3] - regions[:, 1])
+    union = box_area[:, None] + region_area[None, :] - intersection
+    return np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+
+
+def analyze(boxes, regions):
+    """
+    Relates N boxes to M regions in one pass.
+
+    Args:
+        boxes: [x1, y1, x2, y2] boxes.
+        regions: [x1, y1, x2, y2] regions.
+
+    Returns:
+        tuple: (inside, overlapping, iou) arrays of shape (N, M). A box inside a
+        region is not counted as overlapping it.
+    """
+    boxes, regions = as_boxes(boxes), as_boxes(regions)
+    inside = containment(boxes, regions)
+    return inside, overlap(boxes, regions) & ~inside, iou(boxes, regions)
+
+
+def box_statuses(inside: np.ndarray, overlapping: np.ndarray):
+    """Status of each box over all regions: inside any region, else overlapping any, else outside."""
+    statuses = np.full(inside.shape[0], OUTSIDE, dtype=object)
+    statuses[overlapping.any(axis=1)] = OVERLAPPING
+    statuses[inside.any(axis=1)] = INSIDE
+    return statuses.tolist()
+
+
+def region_summary(labels, regions, inside: np.ndarray, overlapping: np.ndarray, iou_matrix: np.ndarray):
+    """
+    Summarizes the boxes in each region.
+
+    Returns:
+        list: One dict per region with its box, the number of boxes inside,
+        overlapping and outside it, the labels inside it with their counts, and
+        the best IoU of any box with it.
+    """
+    labels = np.asarray([str(label) for label in labels], dtype=object)
+    summary = []
+    for j, region in enumerate(as_boxes(regions).tolist()):
+        inside_labels, counts = np.unique(labels[inside[:, j]], return_counts=True)
+        n_inside, n_overlapping = int(inside[:, j].sum()), int(overlapping[:, j].sum())
+        summary.append({
+            'region': [round(value) for value in region],
+            'inside': n_inside,
+            'overlapping': n_overlapping,
+            'outside': len(labels) - n_inside - n_overlapping,
+            'labels_inside': dict(zip(inside_labels.tolist(), counts.tolist())),
+            'best_iou': round(float(iou_matrix[:, j].max()), 3) if len(labels) else 0.0,
+        })
+    return summary
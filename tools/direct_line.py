@@ -1,14 +1,62 @@
 import httpx
 import asyncio
+import time
 import os
+from contextlib import asynccontextmanager
+from helpers.keyed_lock import KeyedLock
 
 DIRECT_LINE_ENDPOINT = 'https://directline.botframework.com/v3/directline'
 TIMEOUT = 25.0
+REPLY_TIMEOUT = float(os.getenv('DIRECT_LINE_REPLY_TIMEOUT', 30))
+CONVERSATION_TTL = float(os.getenv('DIRECT_LINE_CONVERSATION_TTL', 1800))
+POLL_INITIAL_DELAY = 0.2
+POLL_MAX_DELAY = 2.0
+FROM_ID = 'user1'
+
+_client = None
+_client_loop = None
+_conversations = {}  # (user_id, secret name) -> Conversation
+_conversation_locks = KeyedLock()
+
+
+class Conversation:
+    def __init__(self, conversation_id):
+        self.id = conversation_id
+        self.watermark = None
+        self.last_used = time.monotonic()
+
+    @property
+    def expired(self) -> bool:
+        return time.monotonic() - self.last_used > CONVERSATION_TTL
+
+
+@asynccontextmanager
+async def get_client():
+    """Yields the pooled client of the event loop it was created on, or a short-lived one on any other loop."""
+    global _client, _client_loop
+    loop = asyncio.get_running_loop()
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(timeout=TIMEOUT, limits=httpx.Limits(max_keepalive_connections=20))
+        _client_loop = loop
+    if _client_loop is loop:
+        yield _client
+    else:
+        async with httpx.AsyncClient(timeout=TIMEOUT) as client:
+            yield client
+
+
+async def close_client():
+    """Closes the pooled client if it was created on the running loop, so a new one can be pooled on the next loop."""
+    global _client
+    if _client is not None and _client_loop is asyncio.get_running_loop():
+        await _client.aclose()
+        _client = None
+
 
 async def start_conversation(client, headers):
     url = f'{DIRECT_LINE_ENDPOINT}/conversations'
     try:
-        response = await client.post(url, headers=headers, timeout=TIMEOUT)  # Set timeout to 10 seconds
+        response = await client.post(url, headers=headers, timeout=TIMEOUT)
         if response.status_code in [200, 201]:
             conversation_data = response.json()
             conversation_id = conversation_data['conversationId']
@@ -23,58 +71,160 @@ async def start_conversation(client, headers):
 
 
 async def send_message(client, conversation_id, message, headers):
+    """Posts a message activity and returns its activity ID, or None if it wasn't accepted."""
     url = f'{DIRECT_LINE_ENDPOINT}/conversations/{conversation_id}/activities'
     message_data = {
         "type": "message",
-        "from": {"id": "user1"},
+        "from": {"id": FROM_ID},
         "text": message
     }
     try:
-        response = await client.post(url, headers=headers, json=message_data, timeout=TIMEOUT)  # Timeout for sending message
+        response = await client.post(url, headers=headers, json=message_data, timeout=TIMEOUT)
         if response.status_code == 200:
-            return True
+            return response.json().get('id', '')
         else:
             print(f"Error sending message: {response.status_code}")
-            return False
+            return None
     except httpx.TimeoutException:
         print("Timeout occurred while sending the message.")
-        return False
+        return None
 
 
-async def get_bot_reply(client, conversation_id, headers):
-    url = f'{DIRECT_LINE_ENDPOINT}/conversations/{conversation_id}/activities'
-    try:
-        response = await client.get(url, headers=headers, timeout=TIMEOUT)  # Timeout for getting reply
-        if response.status_code == 200:
-            activities = response.json().get('activities', [])
-            activities.sort(key=lambda x: x['timestamp'], reverse=True)
+def activity_sequence(activity_id):
+    """The position of an activity in its conversation, from Direct Line's '<conversation id>|<sequence>' IDs."""
+    _, _, sequence = (activity_id or '').rpartition('|')
+    return int(sequence) if sequence.isdigit() else None
 
-            for activity in activities:
-                if activity['from']['id'] != 'user1':
-                    bot_message = activity
-                    return bot_message
-        else:
-            print(f"Error getting bot reply: {response.status_code}")
+
+def combine_replies(replies):
+    """
+    Merges the messages a bot sent for one turn into a single activity.
+
+    The latest message is returned with the text of every message, in order, and
+    all of their attachments.
+    """
+    if len(replies) == 1:
+        return replies[0]
+    texts = [reply.get('text') for reply in replies if reply.get('text')]
+    attachments = [attachment for reply in replies for attachment in reply.get('attachments') or []]
+    return {**replies[-1], 'text': "\n\n".join(texts), 'attachments': attachments}
+
+
+async def get_bot_reply(client, conversation, activity_id, headers, timeout=REPLY_TIMEOUT):
+    """
+    Polls the conversation from its watermark until the bot replies to `activity_id`.
+
+    The poll interval starts short and backs off, so fast bots answer in a fraction
+    of a second while slow bots aren't polled aggressively. Every reply in the page
+    the first one arrives in is kept, since the watermark moves past the whole page.
+    For bots that don't set replyToId, messages without one that were posted after
+    ours are taken as replies. When the order of the activities can't be told, such
+    messages are only returned once the timeout is reached.
+
+    Returns:
+        dict: The bot's reply activity, see combine_replies() for bots that sent
+        several, or None if none arrived before the timeout.
+
+    Raises:
+        ValueError: If `activity_id` is empty, any bot message would pass for the reply.
+    """
+    if not activity_id:
+        raise ValueError("The activity ID of the message is required to match the bot's reply")
+    url = f'{DIRECT_LINE_ENDPOINT}/conversations/{conversation.id}/activities'
+    deadline = time.monotonic() + timeout
+    delay = POLL_INITIAL_DELAY
+    own_sequence = activity_sequence(activity_id)
+    fallback = []
+    while True:
+        try:
+            params = {'watermark': conversation.watermark} if conversation.watermark else None
+            response = await client.get(url, headers=headers, params=params, timeout=TIMEOUT)
+            if response.status_code == 200:
+                data = response.json()
+                conversation.watermark = data.get('watermark', conversation.watermark)
+                replies = []
+                for activity in data.get('activities', []):
+                    if activity.get('from', {}).get('id') == FROM_ID or activity.get('type') != 'message':
+                        continue
+                    if activity.get('replyToId') == activity_id:
+                        replies.append(activity)
+                        continue
+                    if activity.get('replyToId'):
+                        continue  # A late reply to an earlier message
+                    sequence = activity_sequence(activity.get('id'))
+                    if own_sequence is not None and sequence is not None:
+                        if sequence > own_sequence:
+                            replies.append(activity)
+                        continue  # Posted before ours, e.g. a welcome message
+                    # Some bots don't set replyToId, keep these messages in case no reply arrives
+                    fallback.append(activity)
+                if replies:
+                    return combine_replies(replies)
+            else:
+                print(f"Error getting bot reply: {response.status_code}")
+                return None
+        except httpx.TimeoutException:
+            print("Timeout occurred while waiting for the bot's reply.")
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return combine_replies(fallback) if fallback else None
+        await asyncio.sleep(min(delay, remaining))
+        delay = min(delay * 1.5, POLL_MAX_DELAY)
+
+
+async def get_conversation(client, headers, key, refresh=False):
+    """Returns the cached conversation for `key`, starting a new one if needed."""
+    conversation = _conversations.get(key)
+    if conversation is None or conversation.expired or refresh:
+        conversation_id = await start_conversation(client, headers)
+        if not conversation_id:
+            _conversations.pop(key, None)
             return None
-    except httpx.TimeoutException:
-        print("Timeout occurred while waiting for the bot's reply.")
-        return None
+        conversation = _conversations[key] = Conversation(conversation_id)
+        for stale in [k for k, c in _conversations.items() if c.expired]:
+            del _conversations[stale]
+    conversation.last_used = time.monotonic()
+    return conversation
 
 
-async def send_and_receive_message(secret, message):
+async def send_and_receive_message(secret, message, user_id):
+    if not user_id:
+        # Conversations are kept per user, without an ID users would share one
+        return "Error: Missing user ID."
     s = os.getenv(secret, '')
     headers = {
         'Authorization': f'Bearer {s}',
         'Content-Type': 'application/json'
     }
+    key = (user_id, secret)
 
-    async with httpx.AsyncClient() as client:
-        conversation_id = await start_conversation(client, headers)
-        if conversation_id:
-            await send_message(client, conversation_id, message, headers)
-            await asyncio.sleep(2)  # Wait for the bot to respond
-            res = await get_bot_reply(client, conversation_id, headers)
+    async with _conversation_locks.acquire(key):
+        async with get_client() as client:
+            conversation = await get_conversation(client, headers, key)
+            if conversation is None:
+                return None
+            activity_id = await send_message(client, conversation.id, message, headers)
+            if activity_id is None:
+                # The conversation may have expired on the Direct Line side, start over once
+                conversation = await get_conversation(client, headers, key, refresh=True)
+                if conversation is None:
+                    return None
+                activity_id = await send_message(client, conversation.id, message, headers)
+                if activity_id is None:
+                    return None
+            if not activity_id:
+                return "Error: Direct Line accepted the message without an activity ID, the bot's reply can't be matched."
+            res = await get_bot_reply(client, conversation, activity_id, headers)
             print(f"Response: {res}")
             return res
-        return None
-    
\ No newline at end of file
+
+
+def send_and_receive_message_blocking(secret, message, user_id):
+    """Runs send_and_receive_message() on an event loop of its own, closing the client pooled on that loop."""
+    async def run():
+        try:
+            return await send_and_receive_message(secret, message, user_id)
+        finally:
+            await close_client()
+    return asyncio.run(run())
@@ -1,102 +1,324 @@
 from docx import Document
-import base64
+from docx.enum.style import WD_STYLE_TYPE
+from docx.oxml.ns import qn
+from docx.text.paragraph import Paragraph
+from docx.text.run import Run
+import asyncio
 import uuid
-import os
-import requests
+import io
 import re
+from helpers import sandbox_client
+from helpers.artifact_cache import cached_artifact
+from helpers.document_cache import DocumentCache
+from helpers.tool_executor import run_tool
+from helpers import translation_memory
+from tools.style_map import iter_segments, paginate
 
-def map_style_dependencies_with_text(document_path):
+NON_WORD = re.compile(r'[\W_]+')
+HEADER_FOOTER_PART = re.compile(r'^/word/(header|footer)\d*\.xml$')
+RUN_TEXT_TAGS = {qn('w:rPr'), qn('w:t'), qn('w:tab'), qn('w:br'), qn('w:cr'), qn('w:noBreakHyphen')}
+
+_prefetches = set()  # Background parses, referenced until they finish
+
+def get_style_segments(document_path):
+    """Returns every style map segment of a document, see tools.style_map.iter_segments()."""
+    return cached_artifact(document_path, 'style_map:v2', lambda: list(iter_segments(document_path)))
+
+
+def map_style_dependencies_with_text(document_path, page=1, target_language=None):
+    """
+    Extracts the text of a Word document with the style of each paragraph,
+    including headers, footers, tables and text boxes.
+
+    The document XML is streamed rather than loaded, and the result is split into
+    pages of at most STYLE_MAP_TOKEN_BUDGET tokens. The segments are cached
+    against the document's content hash, so later pages are served from the cache.
+
+    Args:
+        document_path (str): Path to the .docx file.
+        page (int): The 1-based page of segments to return.
+        target_language (str): If given, segments with a remembered translation
+            into this language are prefilled with it.
+
+    Returns:
+        dict: The page number, the total number of pages and the page's segments,
+        each [style, text, translation or '', segment id].
+    """
+    pages = paginate(get_style_segments(document_path))
+    if not 1 <= page <= len(pages):
+        raise ValueError(f"Page {page} doesn't exist, the style map has {len(pages)} page(s)")
+    segments = pages[page - 1]
+    result = {
+        'page': page,
+        'total_pages': len(pages),
+        'segments': segments,
+    }
+    if target_language:
+        remembered = translation_memory.lookup([segment[1] for segment in segments], target_language)
+        # Copy the segments, the cached style map is shared
+        result['segments'] = [[style, text, remembered.get(text, ''), segment_id]
+                              for style, text, _, segment_id in segments]
+        result['prefilled'] = sum(1 for segment in result['segments'] if segment[2])
+    return result
+
+
+def normalize_text(text):
+    """Reduces text to its letters and digits, so punctuation and spacing differences don't prevent a match."""
+    return NON_WORD.sub('', text)
+
+
+def paragraph_style_names(doc):
+    """Returns paragraph style names by style ID, plus the name of the default paragraph style."""
+    names = {style.style_id: style.name for style in doc.styles if style.type == WD_STYLE_TYPE.PARAGRAPH}
+    default = doc.styles.default(WD_STYLE_TYPE.PARAGRAPH)
+    return names, default.name if default is not None else None
+
+
+def story_elements(doc):
+    """Returns the root element of the body and of every header and footer part."""
+    elements = [doc.element.body]
+    for part in doc.part.package.iter_parts():
+        if HEADER_FOOTER_PART.match(str(part.partname)):
+            elements.append(part.element)
+    return elements
+
+
+def index_paragraphs(doc):
+    """
+    Lists every paragraph of a document as (style name, normalized text, paragraph).
+
+    Covers the body, tables, text boxes, headers and footers. Paragraphs without
+    any letters or digits are left out, there is nothing to replace in them.
+    """
+    style_names, default_style = paragraph_style_names(doc)
+    index = []
+    for root in story_elements(doc):
+        for p in root.iter(qn('w:p')):
+            paragraph = Paragraph(p, None)
+            normalized = normalize_text(paragraph_text(paragraph))
+            if normalized:
+                style_id = p.style
+                style = style_names.get(style_id, style_id) if style_id else default_style
+                index.append((style, normalized, paragraph))
+    return index
+
+
+def paragraph_runs(paragraph):
+    return [Run(r, paragraph) for r in paragraph._p.xpath('./w:r | ./w:hyperlink/w:r')]
+
+
+def paragraph_text(paragraph):
+    return "".join(run.text for run in paragraph_runs(paragraph))
+
+
+def set_run_text(run, text):
+    """Sets a run's text while keeping its other content, e.g. drawings and text boxes."""
+    kept = [child for child in run._r if child.tag not in RUN_TEXT_TAGS]
+    run.text = text
+    for child in kept:
+        run._r.append(child)
+
+
+def rewrite_paragraph(paragraph, translated_text):
+    """
+    Writes the translated text over the paragraph's text runs, keeping their formatting.
+
+    Each run takes as many characters as it held before, the last run takes the rest.
+    """
+    runs = [run for run in paragraph_runs(paragraph) if run.text]
+    remaining_text = translated_text
+    for i, run in enumerate(runs):
+        if i == len(runs) - 1:
+            chunk, remaining_text = remaining_text, ''
+        else:
+            chunk, remaining_text = remaining_text[:len(run.text)], remaining_text[len(run.text):]
+        set_run_text(run, chunk)
+
+
+def build_replacement_index(replacements):
+    """
+    Indexes replacements by (style, normalized text).
+
+    Entries with an empty text or translation are skipped. When the same text and
+    style appear more than once, the first translation is used.
+
+    Returns:
+        tuple: (dict of (style, normalized text) -> replacement, number of skipped entries)
+    """
+    index, skipped = {}, 0
+    for replacement in replacements:
+        target_text = replacement['text'].strip()
+        translated_text = replacement['translated_text'].strip()
+        normalized = normalize_text(target_text)
+        if not normalized or not translated_text:
+            skipped += 1
+            continue
+        index.setdefault((replacement['style'], normalized), dict(replacement, text=target_text,
+                                                                  translated_text=translated_text))
+    return index, skipped
+
+
+def keep_original(originals, paragraph):
+    """
+    Remembers the children of a paragraph's runs before its first edit, see restore_runs().
+
+    Only references are kept. Editing a run replaces its text elements and keeps
+    the others, like drawings holding text box paragraphs, as they are.
+    """
+    if originals is None:
+        return
+    for run in paragraph_runs(paragraph):
+        if run._r not in originals:
+            originals[run._r] = list(run._r)
+
+
+def restore_runs(originals):
+    """
+    Puts the original children back into edited runs.
+
+    The elements themselves are put back rather than copies, so every paragraph
+    a paragraph index refers to, text boxes included, stays in the document.
+    """
+    for r, children in originals.items():
+        r[:] = children
+
+
+def apply_replacements(paragraph_index, replacements, originals=None):
     """
-    Analyzes style inheritance relationships and extracts text content,
-    including text from embedded content (headers, footers, tables, text boxes).
-    Requires: python-docx
+    Replaces text in indexed paragraphs without removing images.
+
+    Each paragraph is looked up once by (style, normalized text). Paragraphs without
+    an exact match then get substring replacements from the entries that haven't
+    matched anywhere, using one compiled pattern per style.
+
+    Args:
+        paragraph_index: The output of index_paragraphs().
+        replacements: A list of dicts with 'style', 'text' and 'translated_text'.
+        originals (dict): If given, receives the original children of every
+            edited run, by run element, see keep_original().
+
+    Returns:
+        dict: The number of replaced paragraphs, the matched and skipped entry counts
+        and the [style, text] of every entry that didn't match.
     """
+    index, skipped = build_replacement_index(replacements)
+    matched = set()
+    leftovers = []
+    replaced = 0
+    for style, normalized, paragraph in paragraph_index:
+        replacement = index.get((style, normalized))
+        if replacement is None:
+            leftovers.append((style, paragraph))
+            continue
+        keep_original(originals, paragraph)
+        rewrite_paragraph(paragraph, replacement['translated_text'])
+        matched.add((style, normalized))
+        replaced += 1
+
+    # Fall back to replacing the remaining texts inside runs, grouped by style
+    fallback = {}
+    for key, replacement in index.items():
+        if key not in matched:
+            fallback.setdefault(key[0], {})[replacement['text']] = key
+    patterns = {
+        style: re.compile("|".join(re.escape(text) for text in sorted(texts, key=len, reverse=True)))
+        for style, texts in fallback.items()
+    }
+    for style, paragraph in leftovers:
+        pattern = patterns.get(style)
+        if pattern is None:
+            continue
+        texts = fallback[style]
+        changed = False
+        for run in paragraph_runs(paragraph):
+            hits = [m.group(0) for m in pattern.finditer(run.text)]
+            if hits:
+                keep_original(originals, paragraph)
+                set_run_text(run, pattern.sub(lambda m: index[texts[m.group(0)]]['translated_text'], run.text))
+                matched.update(texts[hit] for hit in hits)
+                changed = True
+        replaced += changed
+
+    return {
+        'replaced_paragraphs': replaced,
+        'matched_entries': len(matched),
+        'skipped_entries': skipped,
+        'unmatched_entries': [[key[0], entry['text']] for key, entry in index.items() if key not in matched],
+    }
+
+
+class ParsedDocument:
+    """A python-docx Document with its paragraph index."""
+    __slots__ = ('doc', 'paragraph_index')
+
+    def __init__(self, doc, paragraph_index):
+        self.doc = doc
+        self.paragraph_index = paragraph_index
+
+
+def load_document(document_path):
     doc = Document(document_path)
-    text_content = []
-
-    # Extract text content with styles from the main document
-    for para in doc.paragraphs:
-        para_text = para.text.strip()
-        if para_text:
-            text_content.append([
-                para.style.name if para.style else 'Unknown',
-                para_text,
-                ''
-            ])
-
-    # Extract text from tables
-    for table in doc.tables:
-        for row in table.rows:
-            for cell in row.cells:
-                for para in cell.paragraphs:
-                    para_text = para.text.strip()
-                    if para_text:
-                        text_content.append([
-                            para.style.name if para.style else 'Unknown',
-                            para_text,
-                            ''
-                        ])
-
-    # Extract text from headers and footers
-    for section in doc.sections:
-        for header in [section.header, section.footer]:
-            if header:
-                for para in header.paragraphs:
-                    para_text = para.text.strip()
-                    if para_text:
-                        text_content.append([
-                            para.style.name if para.style else 'Unknown',
-                            para_text,
-                            ''
-                        ])
-
-    return text_content
-
-
-def replace_in_paragraphs(paragraphs, replacements):
-    """
-    Replaces text in paragraphs without removing images.
-    """
-    for paragraph in paragraphs:
-        full_text = "".join(run.text for run in paragraph.runs).strip()
-        for replacement in replacements:
-            if not paragraph.style or paragraph.style.name != replacement['style']:
-                continue
-
-            target_text = replacement['text'].strip()
-            translated_text = replacement['translated_text'].strip()
-
-            # Normalize both target and translated text by removing non-alphanumeric characters
-            target_alphanumeric = re.sub(r'[^a-zA-Z0-9]', '', target_text)
-            translated_alphanumeric = re.sub(r'[^a-zA-Z0-9]', '', translated_text)
-
-            # Update text without clearing the paragraph (preserving images)
-            if target_alphanumeric == re.sub(r'[^a-zA-Z0-9]', '', full_text):
-                # Modify text in runs instead of clearing
-                remaining_text = translated_text
-                for run in paragraph.runs:
-                    xml = run._element
-                    drawing = xml.find(".//{http://schemas.openxmlformats.org/wordprocessingml/2006/main}drawing")
-                    if remaining_text:
-                        run.text = remaining_text[:len(run.text)]  # Update part of text
-                        remaining_text = remaining_text[len(run.text):]  # Remaining text
-                    else:
-                        run.text = ""  # Clear remaining runs
-                    if drawing is not None:
-                        print("not none")
-                        run._element.append(drawing)
-                        
-            else:
-                for run in paragraph.runs:
-                    if run.text:
-                        # Use regex to find and replace alphanumeric content
-                        run.text = re.sub(target_alphanumeric, translated_alphanumeric, run.text)
-
-
-def combined_replace(document_path, replacements):
-    """
-    Combines the structured replacement (for paragraphs, headers/footers, tables)
-    with embedded content processing (tables and chart series) using the same
+    return ParsedDocument(doc, index_paragraphs(doc))
+
+
+document_cache = DocumentCache(load_document)
+
+
+def prefetch_document(document_path):
+    """
+    Parses and indexes a document in the background, ahead of an expected replacement.
+
+    The parse runs under the 'document' tool class limit. Call it from the event loop.
+    """
+    task = asyncio.get_running_loop().create_task(run_tool('document', document_cache.prefetch, document_path))
+    _prefetches.add(task)
+    task.add_done_callback(_prefetches.discard)
+
+
+def save_replaced(parsed, replacements, buffer):
+    """
+    Saves a copy of a parsed document with the replacements applied.
+
+    The document is edited in place, saved to `buffer`, then put back as it was
+    parsed so it can stay cached.
+
+    Args:
+        parsed (ParsedDocument): The document and its paragraph index.
+        replacements: A list of dicts with 'style', 'text' and 'translated_text'.
+        buffer: A binary file object the new document is written to.
+
+    Returns:
+        dict: The replacement report from apply_replacements().
+    """
+    translations = {entry['text'].strip(): entry['translated_text'].strip() for entry in replacements}
+    originals, renamed_series = {}, []
+    try:
+        # Replace in the body, tables, text boxes, headers and footers in one pass
+        report = apply_replacements(parsed.paragraph_index, replacements, originals)
+
+        # Process embedded content in inline shapes (charts).
+        for shape in parsed.doc.inline_shapes:
+            if hasattr(shape, 'chart'):
+                chart_part = shape.chart
+                # Translate each chart series' name.
+                for series in chart_part.series:
+                    # Chart series don't have style info so we simply check for an exact text match.
+                    if hasattr(series, 'name') and series.name and translations.get(series.name.strip()):
+                        renamed_series.append((series, series.name))
+                        series.name = translations[series.name.strip()]
+
+        parsed.doc.save(buffer)
+    finally:
+        restore_runs(originals)
+        for series, name in renamed_series:
+            series.name = name
+    return report
+
+
+def combined_replace(document_path, replacements, target_language=None):
+    """
+    Combines the structured replacement (for paragraphs, headers/footers, tables,
+    text boxes) with embedded content processing (chart series) using the same
     list-of-dicts structure.
     
     Parameters:
@@ -105,9 +327,12 @@ def combined_replace(document_path, replacements):
           'style': the style name (e.g., 'Normal', 'Heading 1')
           'text': the original text to be replaced
           'translated_text': the new text to replace with
+      target_language: If the replacements are translations, the language they
+          are in. They are then added to the translation memory.
           
     Returns:
-      The path to the new document.
+      A dict with the new document's 'files' in the sandbox and the replacement
+      report from apply_replacements().
     """
     def convert_to_dict(nested_list):
         # Convert each inner list into a dictionary with the appropriate keys
@@ -121,64 +346,17 @@ def combined_replace(document_path, replacements):
         ]
     
     replacements = convert_to_dict(replacements)
-    doc = Document(document_path)
-    
-    # Replace in main document paragraphs.
-    replace_in_paragraphs(doc.paragraphs, replacements)
-    
-    # Replace in tables (iterate over each cell's paragraphs).
-    for table in doc.tables:
-        for row in table.rows:
-            for cell in row.cells:
-                replace_in_paragraphs(cell.paragraphs, replacements)
-    
-    # Replace in headers and footers.
-    for section in doc.sections:
-        for part in (section.header, section.footer):
-            if part:
-                replace_in_paragraphs(part.paragraphs, replacements)
-    
-    # Process embedded content in inline shapes (charts).
-    for shape in doc.inline_shapes:
-        if hasattr(shape, 'chart'):
-            chart_part = shape.chart
-            # Translate each chart series' name.
-            for series in chart_part.series:
-                # Chart series don't have style info so we simply check for an exact text match.
-                for replacement in replacements:
-                    target_text = replacement['text'].strip()
-                    translated_text = replacement['translated_text'].strip()
-                    if hasattr(series, 'name') and series.name and series.name.strip() == target_text:
-                        series.name = translated_text
-
-    fn = str(uuid.uuid4())
-    temp_save_path = f"/tmp/{fn}.docx"
-    doc.save(temp_save_path)
-
-    # Read and encode the document for transfer
-    with open(temp_save_path, "rb") as f:
-        doc_bytes = f.read()
-        encoded_doc = base64.b64encode(doc_bytes).decode("utf-8")  # Convert to Base64 string
-
-    # Python code to be executed remotely
-    code = f"""
-import uuid
-import base64
-from docx import Document
+    translations = {entry['text'].strip(): entry['translated_text'].strip() for entry in replacements}
+
+    buffer = io.BytesIO()
+    with document_cache.checkout(document_path) as parsed:
+        report = save_replaced(parsed, replacements, buffer)
 
-# Decode and save the file
-doc_bytes = base64.b64decode("{encoded_doc}")
-fn = uuid.uuid4()
-fn = str(fn)
-file_path = f"/tmp/sandbox/{{fn}}.docx"
-with open(file_path, "wb") as f:
-    f.write(doc_bytes)
-    """
-
-    SANDBOX_URL = os.getenv('SANDBOX_ENDPOINT', '')
-    # Execute remotely and return result
-    response = requests.post(f"{SANDBOX_URL}/upload", json={"code": code}, timeout=30)
-    r = response.json().get("output", "No output received")
-    if isinstance(r, dict):
-        r = r["files"]
-    return r
+    # Stream the bytes to the sandbox
+    files = sandbox_client.upload_file(
+        buffer, f"{uuid.uuid4()}.docx",
+        content_type="application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+    )
+    if target_language:
+        translation_memory.store(translations, target_language)
+    return {'files': files, **report}
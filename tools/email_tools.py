@@ -5,10 +5,14 @@ from email.mime.multipart import MIMEMultipart
 from email.mime.base import MIMEBase
 from email import encoders
 import os
-import sqlite3
-# Reading emails
-from azure.identity import ManagedIdentityCredential
-import requests
+import re
+from urllib.parse import quote
+from helpers.database import run_async
+from helpers.keyed_lock import KeyedLock
+from helpers import mail_cache
+from tools import graph_client, token_manager
+from tools.graph_client import GraphError
+from tools.token_manager import AuthenticationRequired
 
 EMAIL_ADDRESS = os.getenv('EMAIL_ADDRESS', '')
 EMAIL_PASSWORD = os.getenv('EMAIL_PASSWORD', '')
@@ -17,16 +21,21 @@ CLIENT_ID = os.getenv("CLIENT_ID", "")
 REDIRECT_URI = os.getenv("REDIRECT_URI", "")
 TENANT_ID = os.getenv('TENANT_ID', '')
 
-def get_access_token(user_id: str):
-    conn = sqlite3.connect("ai_employee.db")
-    cursor = conn.cursor()
-    cursor.execute("SELECT access_token FROM users WHERE user_id = ?", (user_id,))
-    result = cursor.fetchone()
-    conn.close()
-    if result:
-        return result[0]
-    else:
-        return None
+MAIL_SYNC_PAGE_SIZE = int(os.getenv('MAIL_SYNC_PAGE_SIZE', 50))
+
+# Only the fields read() renders
+MESSAGE_FIELDS = "id,subject,from,receivedDateTime,bodyPreview,isRead"
+RECIPIENT_SEPARATORS = re.compile(r"[,;\s]+")
+
+_sync_locks = KeyedLock()  # One sync of a mailbox at a time
+
+def authentication_message(user_id: str) -> str:
+    oauth_url = (
+        f"https://login.microsoftonline.com/{TENANT_ID}/oauth2/v2.0/authorize"
+        f"?client_id={CLIENT_ID}&response_type=code&redirect_uri={REDIRECT_URI}"
+        f"&scope={quote(token_manager.GRAPH_SCOPES)}&prompt=consent&state={user_id}"
+    )
+    return f"The user isn't authenticated, please provide them with this URL: {oauth_url} and tell them to let you know when they have authenticated so you can carry on."
 
 
 # def send(subject, recipient, message, attachments=None):
@@ -75,94 +84,246 @@ def get_access_token(user_id: str):
 #     except Exception as e:
 #         return f"Failed to send email: {e}"
 
-def send(user_id: str, subject: str, recepient: str, message: str):
+async def with_access_token(user_id: str, call):
+    """
+    Runs `call(access_token)` with the user's token, and once more with a renewed
+    token if Graph rejects it as expired or revoked.
+
+    Raises:
+        AuthenticationRequired: If the user has to authenticate again.
+    """
+    access_token = await token_manager.get_token(user_id)
     try:
-        GRAPH_API_URL = "https://graph.microsoft.com/v1.0"
+        return await call(access_token)
+    except GraphError as e:
+        if e.status_code != 401:
+            raise
+    return await call(await token_manager.renew(user_id, access_token))
 
-        if not user_id:
-            return "Error: Missing user ID."
 
-        access_token = get_access_token(user_id)
+async def batch_with_access_token(user_id: str, requests: list) -> list:
+    """
+    Runs requests with graph_client.batch(), then sends the ones Graph rejected
+    the token for once more with a renewed token. The others aren't sent again.
 
-        if not access_token:
-            oauth_url = (
-                f"https://login.microsoftonline.com/{TENANT_ID}/oauth2/v2.0/authorize"
-                f"?client_id={CLIENT_ID}&response_type=code&redirect_uri={REDIRECT_URI}"
-                f"&scope=User.Read%20Mail.Read%20Mail.Send&prompt=consent&state={user_id}"
-            )
-            return f"The user isn't authenticated, please provide them with this URL: {oauth_url} and tell them to let you know when they have authenticated so you can carry on."
+    Returns:
+        list: One dict per request, see graph_client.batch(). Requests still
+        rejected because the user has to authenticate again answer 401.
+
+    Raises:
+        AuthenticationRequired: If the token was rejected for every request and can't be renewed.
+    """
+    access_token = await token_manager.get_token(user_id)
+    results = await graph_client.batch(requests, access_token)
+    rejected = [i for i, result in enumerate(results) if result["status"] == 401]
+    if not rejected:
+        return results
+    try:
+        access_token = await token_manager.renew(user_id, access_token)
+    except AuthenticationRequired:
+        if len(rejected) == len(results):
+            raise
+        return results
+    for i, result in zip(rejected, await graph_client.batch([requests[i] for i in rejected], access_token)):
+        results[i] = result
+    return results
+
+
+def parse_recipients(recipients) -> list:
+    """Accepts one address, a comma or semicolon separated string of them, or a list, returns the unique addresses in order."""
+    if isinstance(recipients, str):
+        recipients = RECIPIENT_SEPARATORS.split(recipients)
+    return list(dict.fromkeys(address.strip() for address in recipients if address and address.strip()))
 
-        headers = {
-            "Authorization": f"Bearer {access_token}",
-            "Content-Type": "application/json"
-        }
 
-        # Always set content type to 'HTML'
-        content_type = "HTML"
-
-        # Compose the email message in the required JSON format
-        email_data = {
-            "message": {
-                "subject": subject,
-                "body": {
-                    "contentType": content_type,
-                    "content": message
-                },
-                "toRecipients": [
-                    {
-                        "emailAddress": {
-                            "address": recepient
-                        }
-                    }
-                ]
-            }
+def mail_payload(subject: str, recipients: list, message: str) -> dict:
+    return {
+        "message": {
+            "subject": subject,
+            # Always HTML, the agent writes links to files as anchors
+            "body": {"contentType": "HTML", "content": message},
+            "toRecipients": [{"emailAddress": {"address": address}} for address in recipients],
         }
+    }
 
-        # Send the email via POST request to /sendMail
-        response = requests.post(f"{GRAPH_API_URL}/me/sendMail", headers=headers, json=email_data)
 
-        if response.status_code == 202:
-            return "Email sent successfully!"
-        else:
-            return f"Error sending email: {response.status_code} {response.text}"
+def error_text(status, body) -> str:
+    if isinstance(body, dict):
+        body = (body.get("error") or {}).get("message") or body
+    return f"{status} {body}"
 
+
+async def asend(user_id: str, subject: str, recipients: str | list[str], message: str, separately: bool = False):
+    """
+    Sends an email from the user's mailbox.
+
+    Args:
+        user_id (str): The user's ID.
+        subject (str): The subject of the email.
+        recipients: One address, a comma separated string of addresses, or a list of them.
+        message (str): The HTML body of the email.
+        separately (bool): Send every recipient their own copy instead of one email
+            to all of them. The copies go out in Graph $batch requests of up to 20.
+
+    Returns:
+        str: A success message, the result for each recipient when sent separately,
+        or the authentication URL or the error.
+    """
+    try:
+        if not user_id:
+            return "Error: Missing user ID."
+        recipients = parse_recipients(recipients)
+        if not recipients:
+            return "Error: Missing recipient."
+
+        if not separately or len(recipients) == 1:
+            async def send_one(access_token):
+                response = await graph_client.request(
+                    "POST", "/me/sendMail", access_token, json=mail_payload(subject, recipients, message)
+                )
+                if response.status_code != 202:
+                    raise GraphError(response.status_code, response.text)
+
+            try:
+                await with_access_token(user_id, send_one)
+            except GraphError as e:
+                return f"Error sending email: {e}"
+            return f"Email sent successfully to {', '.join(recipients)}!"
+
+        requests = [
+            {"method": "POST", "url": "/me/sendMail", "body": mail_payload(subject, [address], message)}
+            for address in recipients
+        ]
+        results = await batch_with_access_token(user_id, requests)
+        lines = [
+            f"{address}: sent" if result["status"] == 202
+            else f"{address}: error {error_text(result['status'], result['body'])}"
+            for address, result in zip(recipients, results)
+        ]
+        sent = sum(result["status"] == 202 for result in results)
+        report = f"Sent {sent} of {len(recipients)} emails:\n" + "\n".join(lines)
+        if any(result["status"] == 401 for result in results):
+            report += "\n" + authentication_message(user_id)
+        return report
+
+    except AuthenticationRequired:
+        return authentication_message(user_id)
     except Exception as e:
         return f"Error: {e}"
 
 
-def read(user_id: str, number_of_emails: int):
-    try:
-        GRAPH_API_URL = "https://graph.microsoft.com/v1.0"
+def send(user_id: str, subject: str, recipients: str | list[str], message: str, separately: bool = False):
+    return graph_client.run_blocking(asend, user_id, subject, recipients, message, separately)
 
+
+async def _follow_delta(user_id: str, access_token: str, url: str, params=None) -> str:
+    """Applies every page of a delta round to the cache and returns the round's delta link."""
+    headers = {"Prefer": f"odata.maxpagesize={MAIL_SYNC_PAGE_SIZE}"}
+    data = await graph_client.get_json(url, access_token, params=params, headers=headers)
+    while True:
+        await run_async(mail_cache.apply_changes, user_id, data.get("value", []))
+        if "@odata.deltaLink" in data:
+            return data["@odata.deltaLink"]
+        data = await graph_client.get_json(data["@odata.nextLink"], access_token, headers=headers)
+
+
+async def _start_sync(user_id: str, access_token: str, wanted: int):
+    """Syncs a window holding the newest `wanted` messages of the inbox from scratch."""
+    await run_async(mail_cache.reset, user_id)
+    # Only the dates, to find where the window starts
+    head = (await graph_client.get_json("/me/mailFolders/inbox/messages", access_token, params={
+        "$select": "receivedDateTime",
+        "$top": wanted,
+        "$orderby": "receivedDateTime desc",
+    })).get("value", [])
+    # A window shorter than asked for is the whole inbox
+    window_start = head[-1]["receivedDateTime"] if len(head) >= wanted else None
+
+    params = {"$select": MESSAGE_FIELDS, "$orderby": "receivedDateTime desc"}
+    if window_start:
+        params["$filter"] = f"receivedDateTime ge {window_start}"
+    delta_link = await _follow_delta(user_id, access_token, "/me/mailFolders/inbox/messages/delta", params)
+    await run_async(mail_cache.save_sync_state, user_id, delta_link, window_start)
+
+
+async def sync_mailbox(user_id: str, access_token: str, wanted: int):
+    """
+    Brings the user's cached inbox up to date with a Graph delta query.
+
+    The first sync covers just the newest `wanted` messages: their dates are
+    listed to find where that window starts, then a delta query filtered on it
+    fetches their metadata and previews. Graph then hands out a delta link, so
+    every later sync is a single call that returns only the messages added,
+    changed or deleted since. The window is only synced again when more
+    messages are asked for than it holds, or when the cache outgrows
+    MAIL_CACHE_MAX_MESSAGES.
+
+    Args:
+        user_id (str): The user's ID.
+        access_token (str): The user's Graph access token.
+        wanted (int): The number of messages the caller is about to read.
+
+    Raises:
+        GraphError: If Graph answers with an error.
+    """
+    async with _sync_locks.acquire(user_id):
+        delta_link, window_start = await run_async(mail_cache.get_sync_state, user_id)
+        if delta_link is not None:
+            try:
+                delta_link = await _follow_delta(user_id, access_token, delta_link)
+            except GraphError as e:
+                if e.status_code != 410:
+                    raise
+                # Graph expired the sync state, start over
+                delta_link = None
+            else:
+                await run_async(mail_cache.save_sync_state, user_id, delta_link, window_start)
+
+        cached = await run_async(mail_cache.count, user_id) if delta_link is not None else 0
+        too_small = window_start is not None and cached < wanted
+        too_large = cached > max(mail_cache.MAIL_CACHE_MAX_MESSAGES, wanted)
+        if delta_link is None or too_small or too_large:
+            await _start_sync(user_id, access_token, wanted)
+
+
+def format_message(received_at, subject, sender, preview, is_read) -> str:
+    status = " (unread)" if is_read == 0 else ""
+    return f"Subject: {subject}\nFrom: {sender}\nReceived: {received_at}{status}\nBody Preview: {preview}"
+
+
+async def aread(user_id: str, number_of_emails: int):
+    """
+    Returns the user's latest emails from the local mailbox cache, synced with Graph first.
+
+    Args:
+        user_id (str): The user's ID.
+        number_of_emails (int): The number of emails to return.
+
+    Returns:
+        list: One "Subject/From/Received/Body Preview" string per email, newest
+        first, or a string with the authentication URL or the error.
+    """
+    try:
         if not user_id:
             return "Error: Missing user ID."
-        
-        access_token = get_access_token(user_id)
-
-        if not access_token:
-            oauth_url = (
-                f"https://login.microsoftonline.com/{TENANT_ID}/oauth2/v2.0/authorize"
-                f"?client_id={CLIENT_ID}&response_type=code&redirect_uri={REDIRECT_URI}"
-                f"&scope=User.Read%20Mail.Read%20Mail.Send&prompt=consent&state={user_id}"
+
+        number_of_emails = int(number_of_emails)
+        try:
+            await with_access_token(
+                user_id, lambda access_token: sync_mailbox(user_id, access_token, number_of_emails)
             )
-            return f"The user isn't authenticated, please provide them with this URL: {oauth_url} and tell them to let you know when they have authenticated so you can carry on."
+        except GraphError as e:
+            return f"Error fetching emails: {e}"
 
-        headers = {
-            "Authorization": f"Bearer {access_token}",
-            "Content-Type": "application/json"
-        }
+        rows = await run_async(mail_cache.latest, user_id, number_of_emails)
+        messages = [format_message(*row) for row in rows]
+        return messages if messages else ["No emails found."]
 
-        response = requests.get(f"{GRAPH_API_URL}/me/messages?$top={number_of_emails}", headers=headers)
+    except AuthenticationRequired:
+        return authentication_message(user_id)
+    except Exception as e:
+        return f"Error: {e}"
 
-        if response.status_code == 200:
-            emails = response.json()
-            messages = [
-                f"Subject: {email['subject']}\nFrom: {email['from']['emailAddress']['address']}\nBody Preview: {email['bodyPreview']}"
-                for email in emails.get("value", [])
-            ]
-            return messages if messages else ["No emails found."]
-        else:
-            return f"Error fetching emails: {response.status_code} {response.text}"
 
-    except Exception as e:
-        return f"Error: {e}"
\ No newline at end of file
+def read(user_id: str, number_of_emails: int):
+    return graph_client.run_blocking(aread, user_id, number_of_emails)
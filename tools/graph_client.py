@@ -0,0 +1,202 @@
+import os
+import random
+import asyncio
+import logging
+import httpx
+from contextlib import asynccontextmanager
+
+graph_logger = logging.getLogger(__name__)
+
+GRAPH_API_URL = os.getenv('GRAPH_API_URL', 'https://graph.microsoft.com/v1.0').rstrip('/')
+GRAPH_TIMEOUT = float(os.getenv('GRAPH_TIMEOUT', 30))
+GRAPH_POOL_SIZE = int(os.getenv('GRAPH_POOL_SIZE', 16))
+GRAPH_MAX_RETRIES = int(os.getenv('GRAPH_MAX_RETRIES', 2))
+# Graph accepts at most 20 requests in one $batch
+GRAPH_BATCH_SIZE = 20
+
+RETRY_STATUS_CODES = {429, 503, 504}
+# Other methods, like POST /me/sendMail, may have run when Graph answers 503 or 504
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+RETRY_AFTER_MAX = 30.0
+
+_client = None
+_client_loop = None
+
+
+class GraphError(Exception):
+    def __init__(self, status_code: int, message: str):
+        super().__init__(f"{status_code} {message}")
+        self.status_code = status_code
+
+
+@asynccontextmanager
+async def get_client():
+    """Yields the pooled client of the event loop it was created on, or a short-lived one on any other loop."""
+    global _client, _client_loop
+    loop = asyncio.get_running_loop()
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(timeout=GRAPH_TIMEOUT, limits=httpx.Limits(max_connections=GRAPH_POOL_SIZE))
+        _client_loop = loop
+    if _client_loop is loop:
+        yield _client
+    else:
+        async with httpx.AsyncClient(timeout=GRAPH_TIMEOUT) as client:
+            yield client
+
+
+async def close_client():
+    """Closes the pooled client if it was created on the running loop, so a new one can be pooled on the next loop."""
+    global _client
+    if _client is not None and _client_loop is asyncio.get_running_loop():
+        await _client.aclose()
+        _client = None
+
+
+def run_blocking(coro_fn, *args):
+    """Runs a Graph coroutine function on an event loop of its own, closing the client pooled on that loop."""
+    async def run():
+        try:
+            return await coro_fn(*args)
+        finally:
+            await close_client()
+    return asyncio.run(run())
+
+
+def _url(path: str) -> str:
+    """Absolute URL of a Graph path like '/me/messages', next and delta links are already absolute."""
+    return path if path.startswith("http") else f"{GRAPH_API_URL}{path}"
+
+
+def _retry_after(headers):
+    return (headers or {}).get("Retry-After") or (headers or {}).get("retry-after")
+
+
+def _should_retry(status_code, headers, idempotent: bool) -> bool:
+    """
+    Whether an answer is worth sending the request again for.
+
+    Throttled requests (429) weren't run. A request that isn't idempotent is
+    otherwise only retried on a 503 with a Retry-After, which Graph sends when it
+    turned the request away rather than failing while running it.
+    """
+    if status_code not in RETRY_STATUS_CODES:
+        return False
+    if idempotent or status_code == 429:
+        return True
+    return status_code == 503 and bool(_retry_after(headers))
+
+
+def _retry_delay(headers, attempt: int) -> float:
+    retry_after = _retry_after(headers)
+    if retry_after and str(retry_after).isdigit():
+        return min(float(retry_after), RETRY_AFTER_MAX)
+    return random.uniform(0, 2 ** attempt)
+
+
+async def request(method: str, path: str, access_token: str, idempotent: bool = None, **kwargs) -> httpx.Response:
+    """
+    Sends a request to Graph with the pooled client.
+
+    Throttled (429) and unavailable (503, 504) answers are retried up to
+    GRAPH_MAX_RETRIES times, after the Retry-After Graph asks for. Requests that
+    aren't idempotent, like POST /me/sendMail, are only retried when throttled
+    or on a 503 with a Retry-After, so they aren't run twice.
+
+    Args:
+        method (str): The HTTP method.
+        path (str): A Graph path like '/me/sendMail', or an absolute URL.
+        access_token (str): The user's Graph access token.
+        idempotent (bool): Whether the request may run twice, by default
+            whether `method` is idempotent.
+        **kwargs: Passed on to httpx, e.g. params, json or headers.
+
+    Returns:
+        httpx.Response: The last response.
+    """
+    if idempotent is None:
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+    headers = {"Authorization": f"Bearer {access_token}", **kwargs.pop("headers", {})}
+    async with get_client() as client:
+        for attempt in range(GRAPH_MAX_RETRIES + 1):
+            response = await client.request(method, _url(path), headers=headers, **kwargs)
+            if not _should_retry(response.status_code, response.headers, idempotent) or attempt == GRAPH_MAX_RETRIES:
+                return response
+            await asyncio.sleep(_retry_delay(response.headers, attempt))
+
+
+async def get_json(path: str, access_token: str, **kwargs) -> dict:
+    """
+    GETs a Graph resource.
+
+    Raises:
+        GraphError: If Graph doesn't answer 200.
+    """
+    response = await request("GET", path, access_token, **kwargs)
+    if response.status_code != 200:
+        raise GraphError(response.status_code, response.text)
+    return response.json()
+
+
+async def _send_batch(requests: list, access_token: str) -> dict:
+    """Sends one $batch of at most GRAPH_BATCH_SIZE requests, returns the answers by request id."""
+    # The batch can run twice only if every request in it can
+    idempotent = all(item["method"].upper() in IDEMPOTENT_METHODS for item in requests)
+    response = await request("POST", "/$batch", access_token, idempotent=idempotent, json={"requests": requests})
+    if response.status_code != 200:
+        # The whole batch failed, every request in it gets the batch's error
+        error = {"status": response.status_code, "body": response.text}
+        return {item["id"]: error for item in requests}
+    return {item["id"]: item for item in response.json().get("responses", [])}
+
+
+async def batch(requests: list, access_token: str) -> list:
+    """
+    Runs Graph requests in as few round trips as possible with JSON $batch.
+
+    Requests are sent in batches of GRAPH_BATCH_SIZE, the batches concurrently.
+    Requests Graph throttled inside a batch are sent again in a later batch, up
+    to GRAPH_MAX_RETRIES times, with the same rules as request().
+
+    Args:
+        requests (list): Dicts with the 'method' and relative 'url' of each
+            request, e.g. '/me/sendMail', and optionally a JSON 'body' and 'headers'.
+        access_token (str): The user's Graph access token.
+
+    Returns:
+        list: One dict per request, in the same order, with its 'status' and 'body'.
+        Requests whose batch was sent with a rejected access token answer 401,
+        the others in the call still ran.
+    """
+    pending = {}
+    for i, item in enumerate(requests):
+        entry = {"id": str(i), "method": item["method"], "url": item["url"]}
+        if item.get("body") is not None:
+            entry["body"] = item["body"]
+            entry["headers"] = {"Content-Type": "application/json", **item.get("headers", {})}
+        elif item.get("headers"):
+            entry["headers"] = item["headers"]
+        pending[entry["id"]] = entry
+
+    results = {}
+    for attempt in range(GRAPH_MAX_RETRIES + 1):
+        entries = list(pending.values())
+        chunks = [entries[i:i + GRAPH_BATCH_SIZE] for i in range(0, len(entries), GRAPH_BATCH_SIZE)]
+        answers = {}
+        for chunk_answers in await asyncio.gather(*(_send_batch(chunk, access_token) for chunk in chunks)):
+            answers.update(chunk_answers)
+
+        throttled = []
+        for request_id in list(pending):
+            answer = answers.get(request_id, {"status": 500, "body": "No answer in the batch response"})
+            results[request_id] = {"status": answer.get("status"), "body": answer.get("body")}
+            idempotent = pending[request_id]["method"].upper() in IDEMPOTENT_METHODS
+            if _should_retry(answer.get("status"), answer.get("headers"), idempotent) and attempt < GRAPH_MAX_RETRIES:
+                throttled.append(answer)
+            else:
+                pending.pop(request_id)
+        if not pending:
+            break
+        graph_logger.info(f"Graph throttled {len(pending)} batched requests, retrying")
+        await asyncio.sleep(max(_retry_delay(answer.get("headers"), attempt) for answer in throttled))
+
+    return [results[str(i)] for i in range(len(requests))]
@@ -1,124 +1,219 @@
 import re
 import json
+import threading
+from collections import OrderedDict
+from functools import lru_cache
 from google import genai
-from PIL import Image, ImageDraw
+from google.genai import types
+from PIL import Image, ImageDraw, ImageOps
 import os
+import io
 import uuid
-import base64
-import requests
+from helpers import sandbox_client
+from helpers.artifact_cache import cached_artifact, file_hash, query_key
+from tools.box_geometry import INSIDE, OVERLAPPING, OUTSIDE, normalize_regions, analyze, box_statuses, region_summary
 
-def is_inside(box, target_area_box):
-    x1, y1, x2, y2 = box
-    gx1, gy1, gx2, gy2 = target_area_box
-    return gx1 <= x1 and gy1 <= y1 and gx2 >= x2 and gy2 >= y2
+IMAGE_MAX_SIDE = int(os.getenv('IMAGE_MAX_SIDE', 1024))
+IMAGE_ENCODE_FORMAT = os.getenv('IMAGE_ENCODE_FORMAT', 'JPEG').upper()
+IMAGE_ENCODE_QUALITY = int(os.getenv('IMAGE_ENCODE_QUALITY', 85))
+DETECTION_CACHE_MAX_ENTRIES = int(os.getenv('DETECTION_CACHE_MAX_ENTRIES', 256))
+STATUS_COLORS = {INSIDE: 'blue', OVERLAPPING: 'orange', OUTSIDE: 'purple'}
+# The model returns box_2d as [ymin, xmin, ymax, xmax] normalized to 0-1000
+BOX_SCALE = 1000
 
-def is_overlapping(box, target_area_box):
-    x1, y1, x2, y2 = box
-    gx1, gy1, gx2, gy2 = target_area_box
-    return not (x2 < gx1 or x1 > gx2 or y2 < gy1 or y1 > gy2)
 
-def detect_objects(query, file, target_area_box=None):
+@lru_cache(maxsize=None)
+def get_genai_client():
+    """The Gemini client, created once per process."""
+    return genai.Client(api_key=os.getenv('GEMINI_API_KEY', ''))
 
-    # Load and resize the image to 1000x1000 pixels
-    image = Image.open(file)
-    image = image.resize((1000, 1000))
 
-    # Initialize Google GenAI client
-    client = genai.Client(api_key=os.getenv('GEMINI_API_KEY', ''))
-    # Send the image to the model
-    response = client.models.generate_content(
-        model=os.getenv('GEMINI_RECOGNITION_MODEL', ''),
-        contents=[query, image]
-    )
+def prepare_image(image):
+    """
+    Encodes an image compactly for the recognition model.
+
+    The longest side is capped at IMAGE_MAX_SIDE keeping the aspect ratio, smaller
+    images aren't upscaled. Box coordinates are normalized by the model, so they
+    apply to the original image as they are.
+
+    Returns:
+        tuple: (encoded bytes, MIME type)
+    """
+    prepared = image.convert('RGB' if IMAGE_ENCODE_FORMAT == 'JPEG' or 'A' not in image.mode else 'RGBA')
+    prepared.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE), Image.LANCZOS)
+    buffer = io.BytesIO()
+    prepared.save(buffer, format=IMAGE_ENCODE_FORMAT, quality=IMAGE_ENCODE_QUALITY)
+    return buffer.getvalue(), Image.MIME.get(IMAGE_ENCODE_FORMAT, 'image/jpeg')
+
+
+def to_pixel_box(box_2d, width, height):
+    """Maps a normalized [ymin, xmin, ymax, xmax] box to [x1, y1, x2, y2] pixels of a width x height image."""
+    y1, x1, y2, x2 = box_2d
+    return [
+        round(x1 * width / BOX_SCALE), round(y1 * height / BOX_SCALE),
+        round(x2 * width / BOX_SCALE), round(y2 * height / BOX_SCALE),
+    ]
+
+
+class DetectionCache:
+    """
+    Bounded LRU cache of parsed detections, keyed by (image hash, model, normalized query).
+
+    Each entry also remembers the images already rendered for it by target area,
+    so asking again about the same area doesn't render or upload anything.
+    """
 
-    # Extract bounding box JSON from response
-    match = re.search(r"\[.*\]", response.text, re.DOTALL)
-    if match:
-        json_text = match.group(0)  # Extract JSON part
-        try:
-            bounding_boxes = json.loads(json_text)  # Convert to Python list
-        except json.JSONDecodeError:
-            print("Error: Extracted text is not valid JSON.")
-            bounding_boxes = []
-    else:
-        return response.text
-
-    # Draw bounding boxes on the image
+    def __init__(self, max_entries=DETECTION_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        if not self.max_entries:
+            return
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class Detections:
+    __slots__ = ('response_text', 'boxes', 'renders')
+
+    def __init__(self, response_text, boxes):
+        self.response_text = response_text
+        self.boxes = boxes  # [{'label', 'box_2d'}] normalized as returned by the model, None if it returned no JSON
+        self.renders = {}  # target area -> uploaded files
+
+
+detection_cache = DetectionCache()
+
+
+def parse_detections(response_text):
+    """Extracts the bounding box list from the model's answer, or None if it has none."""
+    match = re.search(r"\[.*\]", response_text, re.DOTALL)
+    if not match:
+        return None
+    try:
+        return json.loads(match.group(0))
+    except json.JSONDecodeError:
+        print("Error: Extracted text is not valid JSON.")
+        return []
+
+
+def get_detections(query, file, image):
+    """
+    Returns the model's detections for an image and query.
+
+    Served from memory when the same image was asked the same question before,
+    then from the database, and only then from the model.
+    """
+    model = os.getenv('GEMINI_RECOGNITION_MODEL', '')
+    key = (file_hash(file), model, query_key(query))
+    detections = detection_cache.get(key)
+    if detections is not None:
+        return detections
+
+    def recognize():
+        # Send a downscaled copy of the image to the model
+        data, mime_type = prepare_image(image)
+        return get_genai_client().models.generate_content(
+            model=model,
+            contents=[query, types.Part.from_bytes(data=data, mime_type=mime_type)]
+        ).text
+
+    # The same image and question always get the same answer, so only ask the model once
+    response_text = cached_artifact(file, f"detections:{model}:{key[2]}", recognize)
+    detections = Detections(response_text, parse_detections(response_text))
+    detection_cache.put(key, detections)
+    return detections
+
+
+def render_detections(image, file, boxes, regions, statuses):
+    """Draws the pixel boxes and the target areas on the image and uploads it to the sandbox."""
+    width, height = image.size
     draw = ImageDraw.Draw(image)
+    line_width = max(2, max(width, height) // 500)
 
-    if target_area_box:
-        # Draw the manually defined green box
-        draw.rectangle(target_area_box, outline="green", width=3)
+    for region in regions:
+        # Draw the manually defined green boxes
+        draw.rectangle(region, outline="green", width=line_width + 1)
 
-    corrected_bounding_boxes = []
-    for item in bounding_boxes:
+    for item, status in zip(boxes, statuses):
         label = item["label"]
-        y1, x1, y2, x2 = item["box_2d"]
-
-        corrected_bounding_boxes.append({
-            "label": label,
-            "box_2d": [x1, y1, x2, y2]
-        })
+        x1, y1, x2, y2 = item["box_2d"]
 
         # Draw the detected bounding box
-        draw.rectangle([(x1, y1), (x2, y2)], outline="red", width=2)
-
-        status = ''
-        color = 'red'
-        if target_area_box:
-            # Determine the relation to the green box
-            if is_inside((x1, y1, x2, y2), target_area_box):
-                status = "Inside"
-                color = "blue"
-            elif is_overlapping((x1, y1, x2, y2), target_area_box):
-                status = "Overlapping"
-                color = "orange"
-            else:
-                status = "Outside"
-                color = "purple"
-
-        # Draw status text
-        draw.text((x1, y1 - 20 if y1 - 20 > 0 else y1 + 5), f"{label}{': ' if status else ''}", fill=color)
-
-    # Save the modified image
-    fn = str(uuid.uuid4())
-    file_extension = file.split('.')[-1].lower()
-    temp_save_path = f"/tmp/{fn}.{file_extension}"
-    image.save(temp_save_path)
+        draw.rectangle([(x1, y1), (x2, y2)], outline="red", width=line_width)
 
-    # Read and encode the image for transfer
-    with open(temp_save_path, "rb") as f:
-        img_bytes = f.read()
-        encoded_img = base64.b64encode(img_bytes).decode("utf-8")  # Convert to Base64 string
+        # Draw status text, colored by the relation to the target areas
+        color = STATUS_COLORS.get(status, 'red')
+        draw.text((x1, y1 - 20 if y1 - 20 > 0 else y1 + 5), f"{label}{': ' + status if status else ''}", fill=color)
 
-    # Python code to be executed remotely
-    code = f"""
-import uuid
-import base64
-from PIL import Image
-import io
+    # Save the modified image to memory and stream the bytes to the sandbox
+    file_extension = file.split('.')[-1].lower()
+    image_format = Image.registered_extensions().get(f".{file_extension}", "PNG")
+    buffer = io.BytesIO()
+    image.save(buffer, format=image_format)
+    return sandbox_client.upload_file(
+        buffer, f"{uuid.uuid4()}.{file_extension}",
+        content_type=Image.MIME.get(image_format, "application/octet-stream")
+    )
 
-# Decode and save the image file
-img_bytes = base64.b64decode("{encoded_img}")
-fn = uuid.uuid4()
-fn = str(fn)
-file_path = f"/tmp/sandbox/{{fn}}.{file_extension}"
 
-# Save the decoded image
-image = Image.open(io.BytesIO(img_bytes))
-image.save(file_path)
-    """
-    SANDBOX_URL = os.getenv('SANDBOX_ENDPOINT', '')
-    # Execute remotely and return result
-    res = requests.post(f"{SANDBOX_URL}/upload", json={"code": code}, timeout=30)
-    r = res.json().get("output", "No output received")
-    if isinstance(r, dict):
-        r = r["files"]
-
-    pattern = r"\[.*?\]"
-    response_text = response.text
-    response_text = re.sub(pattern, str(corrected_bounding_boxes), response.text)
+def detect_objects(query, file, target_area_box=None):
+
+    # Load the image upright, boxes and the target area are in its original pixels
+    image = ImageOps.exif_transpose(Image.open(file))
+    width, height = image.size
+
+    detections = get_detections(query, file, image)
+    if detections.boxes is None:
+        return detections.response_text
+
+    corrected_bounding_boxes = [
+        {"label": item["label"], "box_2d": to_pixel_box(item["box_2d"], width, height)}
+        for item in detections.boxes
+    ]
+
+    regions = normalize_regions(target_area_box)
+    statuses = [''] * len(corrected_bounding_boxes)
+    summary = None
+    if regions:
+        # Relate every box to every target area at once
+        pixel_boxes = [item["box_2d"] for item in corrected_bounding_boxes]
+        inside, overlapping, iou_matrix = analyze(pixel_boxes, regions)
+        statuses = box_statuses(inside, overlapping)
+        for item, status in zip(corrected_bounding_boxes, statuses):
+            item["status"] = status
+        labels = [item["label"] for item in corrected_bounding_boxes]
+        summary = region_summary(labels, regions, inside, overlapping, iou_matrix)
+
+    # Only new target areas need a new image, the detections are the same
+    render_key = tuple(tuple(region) for region in regions)
+    r = detections.renders.get(render_key)
+    if r is None:
+        r = detections.renders[render_key] = render_detections(image, file, corrected_bounding_boxes, regions, statuses)
+
+    # Swap the model's normalized boxes for the pixel boxes
+    response_text = detections.response_text
+    match = re.search(r"\[.*\]", response_text, re.DOTALL)
+    response_text = response_text[:match.start()] + json.dumps(corrected_bounding_boxes) + response_text[match.end():]
     # Combine results into a response
     full = f"{r} \n\n {response_text}"
+    if summary is not None:
+        full += f"\n\n Target areas: {json.dumps(summary)}"
     return full
-
@@ -0,0 +1,132 @@
+import os
+import re
+import json
+import zipfile
+import xml.etree.ElementTree as ET
+from docx.styles import BabelFish
+
+STYLE_MAP_TOKEN_BUDGET = int(os.getenv('STYLE_MAP_TOKEN_BUDGET', 6000))
+CHARS_PER_TOKEN = 4
+
+W = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+MC = '{http://schemas.openxmlformats.org/markup-compatibility/2006}'
+PARAGRAPH = f'{W}p'
+TEXT = f'{W}t'
+PARAGRAPH_STYLE = f'{W}pStyle'
+FALLBACK = f'{MC}Fallback'
+CONTAINERS = {f'{W}body', f'{W}hdr', f'{W}ftr'}
+BREAKS = {f'{W}tab': '\t', f'{W}br': '\n', f'{W}cr': '\n'}
+
+HEADER_FOOTER_PART = re.compile(r'^word/(header|footer)(\d*)\.xml$')
+
+
+def read_style_names(archive: zipfile.ZipFile):
+    """
+    Returns the paragraph style names by style ID, plus the name of the default paragraph style.
+
+    Names are translated the same way python-docx does, e.g. 'heading 1' becomes 'Heading 1'.
+    """
+    names, default = {}, 'Normal'
+    if 'word/styles.xml' not in archive.namelist():
+        return names, default
+    with archive.open('word/styles.xml') as f:
+        for style in ET.parse(f).getroot().iter(f'{W}style'):
+            name = style.find(f'{W}name')
+            if name is None:
+                continue
+            ui_name = BabelFish.internal2ui(name.get(f'{W}val'))
+            names[style.get(f'{W}styleId')] = ui_name
+            if style.get(f'{W}type') == 'paragraph' and style.get(f'{W}default') in ('1', 'true', 'on'):
+                default = ui_name
+    return names, default
+
+
+def text_parts(archive: zipfile.ZipFile):
+    """Returns (segment prefix, part name) for the body, then every header and footer part."""
+    parts = [('body', 'word/document.xml')]
+    others = []
+    for name in archive.namelist():
+        match = HEADER_FOOTER_PART.match(name)
+        if match:
+            others.append((match.group(1), int(match.group(2) or 0), name))
+    for kind, number, name in sorted(others, key=lambda part: (part[0] != 'header', part[1])):
+        parts.append((f'{kind}{number}', name))
+    return parts
+
+
+def iter_part_paragraphs(f, style_names, default_style):
+    """
+    Streams (style name, text) for every paragraph of a part in document order.
+
+    Paragraphs inside text boxes are nested in a run of their anchor paragraph, so
+    each open paragraph keeps its own text on a stack. The VML copy of a text box
+    in mc:Fallback is skipped, it duplicates the mc:Choice content.
+    """
+    stack = []  # [style, text pieces] of each open paragraph
+    parents = []
+    fallback_depth = 0
+    for event, elem in ET.iterparse(f, events=('start', 'end')):
+        tag = elem.tag
+        if event == 'start':
+            parents.append(elem)
+            if tag == FALLBACK:
+                fallback_depth += 1
+            elif tag == PARAGRAPH and not fallback_depth:
+                stack.append([default_style, []])
+            continue
+
+        parents.pop()
+        if tag == FALLBACK:
+            fallback_depth -= 1
+        elif fallback_depth or not stack:
+            pass
+        elif tag == TEXT:
+            stack[-1][1].append(elem.text or '')
+        elif tag in BREAKS:
+            stack[-1][1].append(BREAKS[tag])
+        elif tag == PARAGRAPH_STYLE:
+            style_id = elem.get(f'{W}val')
+            stack[-1][0] = style_names.get(style_id, style_id)
+        elif tag == PARAGRAPH:
+            style, pieces = stack.pop()
+            yield style, ''.join(pieces)
+
+        # Drop finished top-level blocks so memory stays flat on large documents
+        if parents and parents[-1].tag in CONTAINERS:
+            parents[-1].remove(elem)
+
+
+def iter_segments(document_path: str):
+    """
+    Streams the non-empty paragraphs of a Word document as [style, text, '', segment id].
+
+    Covers the body (including tables and text boxes), headers and footers. Segment IDs
+    are '<part>:<paragraph number>', so they stay the same for the same document.
+    """
+    with zipfile.ZipFile(document_path) as archive:
+        style_names, default_style = read_style_names(archive)
+        for prefix, part in text_parts(archive):
+            with archive.open(part) as f:
+                for number, (style, text) in enumerate(iter_part_paragraphs(f, style_names, default_style)):
+                    text = text.strip()
+                    if text:
+                        yield [style or 'Unknown', text, '', f'{prefix}:{number}']
+
+
+def estimate_tokens(segment) -> int:
+    return len(json.dumps(segment, ensure_ascii=False)) // CHARS_PER_TOKEN + 1
+
+
+def paginate(segments, token_budget: int = STYLE_MAP_TOKEN_BUDGET):
+    """Splits segments into pages of at most `token_budget` estimated tokens, never splitting a segment."""
+    pages, page, used = [], [], 0
+    for segment in segments:
+        tokens = estimate_tokens(segment)
+        if page and used + tokens > token_budget:
+            pages.append(page)
+            page, used = [], 0
+        page.append(segment)
+        used += tokens
+    if page or not pages:
+        pages.append(page)
+    return pages
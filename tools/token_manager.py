@@ -0,0 +1,290 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from prometheus_client import Counter
+from helpers.database import run_async, get_user_tokens, save_user_tokens, clear_user_tokens
+from helpers.metrics import REGISTRY
+from tools.graph_client import get_client
+
+token_logger = logging.getLogger(__name__)
+
+CLIENT_ID = os.getenv("CLIENT_ID", "")
+CLIENT_SECRET = os.getenv("CLIENT_SECRET", "")
+TENANT_ID = os.getenv('TENANT_ID', '')
+TOKEN_URL = os.getenv('OAUTH_TOKEN_URL', f"https://login.microsoftonline.com/{TENANT_ID}/oauth2/v2.0/token")
+# offline_access makes the token endpoint hand out a refresh token
+GRAPH_SCOPES = "User.Read Mail.Read Mail.Send offline_access"
+
+TOKEN_RENEW_BEFORE = float(os.getenv('TOKEN_RENEW_BEFORE', 600))
+TOKEN_EXPIRY_MARGIN = float(os.getenv('TOKEN_EXPIRY_MARGIN', 60))
+TOKEN_CACHE_MAX = int(os.getenv('TOKEN_CACHE_MAX', 1000))
+
+TOKEN_REFRESHES = Counter(
+    'ai_employee_token_refreshes_total', 'OAuth token refreshes by outcome', ['outcome'], registry=REGISTRY
+)
+
+_tokens = OrderedDict()  # user_id -> Token, least recently used first, the rest are reloaded from SQLite
+_tokens_lock = threading.Lock()
+_refreshes = {}  # user_id -> Future of the running refresh, shared by every caller
+_refreshes_lock = threading.Lock()
+_background = set()  # Background renewals, referenced until they finish
+
+
+class AuthenticationRequired(Exception):
+    """Raised when the user has no usable token and has to go through the consent URL again."""
+
+
+class TokenRefreshError(Exception):
+    """Raised when the token endpoint can't be reached or fails for a reason other than a rejected refresh token."""
+
+
+class Token:
+    __slots__ = ('user_email', 'access_token', 'refresh_token', 'expires_at')
+
+    def __init__(self, user_email, access_token, refresh_token=None, expires_at=None):
+        self.user_email = user_email
+        self.access_token = access_token
+        self.refresh_token = refresh_token
+        self.expires_at = expires_at
+
+    def expires_in(self):
+        """Seconds until the access token expires, None for tokens stored without an expiry."""
+        return None if self.expires_at is None else self.expires_at - time.time()
+
+    def usable(self) -> bool:
+        remaining = self.expires_in()
+        return remaining is None or remaining > TOKEN_EXPIRY_MARGIN
+
+
+def _cached(user_id: str):
+    """Returns the user's token held in memory and marks it as recently used, or None."""
+    with _tokens_lock:
+        token = _tokens.get(user_id)
+        if token is not None:
+            _tokens.move_to_end(user_id)
+        return token
+
+
+def _cache(user_id: str, token: Token):
+    """Holds a token in memory, dropping the least recently used ones beyond TOKEN_CACHE_MAX."""
+    with _tokens_lock:
+        _tokens[user_id] = token
+        _tokens.move_to_end(user_id)
+        while len(_tokens) > TOKEN_CACHE_MAX:
+            _tokens.popitem(last=False)
+
+
+def _uncache(user_id: str):
+    with _tokens_lock:
+        _tokens.pop(user_id, None)
+
+
+def token_from_response(user_email: str, token_response: dict, refresh_token: str = None) -> Token:
+    """Builds a Token from the token endpoint's answer, keeping `refresh_token` if no new one was issued."""
+    expires_in = token_response.get("expires_in")
+    return Token(
+        user_email,
+        token_response["access_token"],
+        token_response.get("refresh_token") or refresh_token,
+        time.time() + float(expires_in) if expires_in else None,
+    )
+
+
+def load_token(user_id: str):
+    row = get_user_tokens(user_id)
+    return Token(*row) if row else None
+
+
+def persist_token(user_id: str, token: Token):
+    save_user_tokens(user_id, token.user_email, token.access_token, token.refresh_token, token.expires_at)
+
+
+async def store(user_id: str, user_email: str, token_response: dict):
+    """Saves the tokens of a user who just authenticated."""
+    token = token_from_response(user_email, token_response)
+    await run_async(persist_token, user_id, token)
+    _cache(user_id, token)
+
+
+async def _forget(user_id: str):
+    _uncache(user_id)
+    await run_async(clear_user_tokens, user_id)
+
+
+async def _request_refresh(refresh_token: str) -> dict:
+    data = {
+        "client_id": CLIENT_ID,
+        "client_secret": CLIENT_SECRET,
+        "grant_type": "refresh_token",
+        "refresh_token": refresh_token,
+        "scope": GRAPH_SCOPES,
+    }
+    try:
+        async with get_client() as client:
+            response = await client.post(TOKEN_URL, data=data)
+    except Exception as e:
+        raise TokenRefreshError(f"Couldn't reach the token endpoint: {e}")
+    if response.status_code == 200:
+        return response.json()
+    if response.status_code in (400, 401):
+        # invalid_grant and friends: the refresh token expired or was revoked
+        token_logger.info(f"Refresh token rejected: {response.status_code} {response.text}")
+        return None
+    raise TokenRefreshError(f"{response.status_code} {response.text}")
+
+
+async def _refresh_token(user_id: str, rejected: str = None):
+    """
+    Renews a user's access token with the stored refresh token.
+
+    Another worker may have renewed it already, then the newer stored token is used.
+
+    Returns:
+        Token: The renewed token, None if the user has to authenticate again.
+    """
+    stored = await run_async(load_token, user_id)
+    if stored is None:
+        _uncache(user_id)
+        return None
+    cached = _cached(user_id)
+    if stored.usable() and stored.access_token != rejected and (
+            cached is None or stored.access_token != cached.access_token):
+        _cache(user_id, stored)
+        return stored
+    if not stored.refresh_token:
+        TOKEN_REFRESHES.labels(outcome='no_refresh_token').inc()
+        await _forget(user_id)
+        return None
+
+    try:
+        token_response = await _request_refresh(stored.refresh_token)
+    except TokenRefreshError:
+        TOKEN_REFRESHES.labels(outcome='error').inc()
+        raise
+    if token_response is None:
+        TOKEN_REFRESHES.labels(outcome='rejected').inc()
+        await _forget(user_id)
+        return None
+
+    token = token_from_response(stored.user_email, token_response, stored.refresh_token)
+    await run_async(persist_token, user_id, token)
+    _cache(user_id, token)
+    TOKEN_REFRESHES.labels(outcome='success').inc()
+    return token
+
+
+async def refresh(user_id: str, rejected: str = None):
+    """
+    Renews a user's access token, at most once at a time per user.
+
+    Concurrent callers, on any event loop, wait for the same renewal instead of
+    each spending the refresh token.
+
+    Args:
+        user_id (str): The user's ID.
+        rejected (str): An access token Graph just rejected, it's never handed out again.
+
+    Returns:
+        Token: The renewed token, None if the user has to authenticate again.
+
+    Raises:
+        TokenRefreshError: If the token endpoint fails.
+    """
+    with _refreshes_lock:
+        future = _refreshes.get(user_id)
+        owner = future is None
+        if owner:
+            future = _refreshes[user_id] = Future()
+    if not owner:
+        return await asyncio.wrap_future(future)
+
+    try:
+        token = await _refresh_token(user_id, rejected)
+        future.set_result(token)
+        return token
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _refreshes_lock:
+            _refreshes.pop(user_id, None)
+
+
+def _renew_in_background(user_id: str):
+    # Saves a task per call while a renewal runs, refresh() itself makes sure only one does
+    with _refreshes_lock:
+        if user_id in _refreshes:
+            return
+    task = asyncio.get_running_loop().create_task(refresh(user_id))
+    _background.add(task)
+
+    def done(task):
+        _background.discard(task)
+        if not task.cancelled() and task.exception():
+            token_logger.warning(f"Background token renewal for {user_id} failed: {task.exception()}")
+    task.add_done_callback(done)
+
+
+async def get_token(user_id: str) -> str:
+    """
+    Returns a usable access token for the user.
+
+    Tokens are served from memory. A token within TOKEN_RENEW_BEFORE seconds of
+    its expiry is still handed out while a renewal runs in the background, so
+    active users never wait for one. Only a token that has already expired is
+    renewed before returning.
+
+    Args:
+        user_id (str): The user's ID.
+
+    Returns:
+        str: The access token.
+
+    Raises:
+        AuthenticationRequired: If the user hasn't authenticated or their refresh token was rejected.
+        TokenRefreshError: If an expired token can't be renewed because the token endpoint fails.
+    """
+    token = _cached(user_id)
+    if token is None:
+        token = await run_async(load_token, user_id)
+        if token is None:
+            raise AuthenticationRequired(user_id)
+        _cache(user_id, token)
+
+    remaining = token.expires_in()
+    if remaining is None or remaining > TOKEN_RENEW_BEFORE:
+        return token.access_token
+    if token.usable():
+        if token.refresh_token:
+            _renew_in_background(user_id)
+        return token.access_token
+
+    token = await refresh(user_id)
+    if token is None:
+        raise AuthenticationRequired(user_id)
+    return token.access_token
+
+
+async def renew(user_id: str, rejected: str) -> str:
+    """
+    Returns a new access token after Graph rejected `rejected`.
+
+    Raises:
+        AuthenticationRequired: If there's no refresh token or it was rejected too.
+    """
+    token = await refresh(user_id, rejected)
+    if token is None:
+        raise AuthenticationRequired(user_id)
+    return token.access_token
+
+
+def stats() -> dict:
+    return {
+        'cached': len(_tokens),
+        'max_cached': TOKEN_CACHE_MAX,
+        'refreshing': len(_refreshes),
+    }
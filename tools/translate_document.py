@@ -0,0 +1,133 @@
+import os
+import time
+import uuid
+import random
+import asyncio
+import logging
+from tools.style_map import paginate
+from tools.translate_text import atranslate_segments
+from tools.edit_word_doc import get_style_segments, combined_replace, prefetch_document
+from helpers.tool_executor import run_tool
+from helpers.database import run_async
+from helpers import translation_memory
+
+translation_logger = logging.getLogger(__name__)
+
+TRANSLATION_BATCH_TOKENS = int(os.getenv('TRANSLATION_BATCH_TOKENS', 1500))
+TRANSLATION_PARALLELISM = int(os.getenv('TRANSLATION_PARALLELISM', 4))
+TRANSLATION_MAX_RETRIES = int(os.getenv('TRANSLATION_MAX_RETRIES', 2))
+RETRY_BACKOFF = 1.0
+UNTRANSLATED_REPORT_LIMIT = 20
+
+_progress = {}  # translation id -> progress of a running translation
+
+
+def translation_progress() -> dict:
+    """Progress of the document translations running in this worker, by translation id."""
+    return {path: dict(progress) for path, progress in _progress.items()}
+
+
+def make_batches(texts, token_budget=TRANSLATION_BATCH_TOKENS):
+    """Splits texts into batches of at most `token_budget` estimated tokens."""
+    return [batch for batch in paginate(texts, token_budget) if batch]
+
+
+async def translate_batches(batches, target_language, progress, source_language=None):
+    """
+    Translates batches concurrently, at most TRANSLATION_PARALLELISM at a time.
+
+    Failed batches are retried up to TRANSLATION_MAX_RETRIES times, split in half
+    so a single bad segment doesn't keep failing a whole batch. Every translated
+    batch is added to the translation memory.
+
+    Returns:
+        tuple: (dict of source text -> translation, list of texts that couldn't be translated)
+    """
+    semaphore = asyncio.Semaphore(TRANSLATION_PARALLELISM)
+    translations = {}
+
+    async def translate(batch):
+        async with semaphore:
+            try:
+                result = await atranslate_segments(batch, target_language)
+            except Exception as e:
+                translation_logger.warning(f"Translation batch of {len(batch)} segments failed: {e}")
+                progress['failed_batches'] += 1
+                return batch
+        translated = dict(zip(batch, result))
+        translations.update(translated)
+        progress['translated_segments'] += len(batch)
+        await run_async(translation_memory.store, translated, target_language, source_language)
+        return None
+
+    pending = batches
+    for attempt in range(TRANSLATION_MAX_RETRIES + 1):
+        if attempt:
+            await asyncio.sleep(random.uniform(0, RETRY_BACKOFF * 2 ** attempt))
+            pending = [half for batch in pending for half in (batch[:len(batch) // 2], batch[len(batch) // 2:]) if half]
+            progress['retried_batches'] += len(pending)
+        failed = await asyncio.gather(*(translate(batch) for batch in pending))
+        pending = [batch for batch in failed if batch]
+        if not pending:
+            break
+    return translations, [text for batch in pending for text in batch]
+
+
+async def translate_document(document_path: str, target_language: str, source_language: str = None):
+    """
+    Translates a Word document into another language.
+
+    The document's style map segments are deduplicated and looked up in the
+    translation memory. The rest are grouped into token-bounded batches and
+    translated concurrently. The translations are then written into the document
+    with combined_replace().
+
+    Args:
+        document_path (str): Path to the .docx file.
+        target_language (str): The language to translate into.
+        source_language (str): The document's language, None when unknown.
+
+    Returns:
+        dict: The new document's 'files', the replacement report, the number of
+        translated segments and batches, and the first segments left untranslated.
+    """
+    start = time.monotonic()
+    segments = await run_tool('document', get_style_segments, document_path)
+    # Parsed and indexed for the replacement while the batches are translated
+    prefetch_document(document_path)
+    texts = list(dict.fromkeys(segment[1] for segment in segments))
+    remembered = await run_async(translation_memory.lookup, texts, target_language, source_language)
+    batches = make_batches([text for text in texts if text not in remembered])
+
+    # The same document can be translated by several calls at once, e.g. into different languages
+    translation_id = str(uuid.uuid4())
+    progress = _progress[translation_id] = {
+        'document_path': document_path,
+        'target_language': target_language,
+        'segments': len(texts),
+        'remembered_segments': len(remembered),
+        'translated_segments': 0,
+        'batches': len(batches),
+        'failed_batches': 0,
+        'retried_batches': 0,
+    }
+    try:
+        translations, untranslated = await translate_batches(batches, target_language, progress, source_language)
+        translations.update(remembered)
+        replacements = [[segment[0], segment[1], translations.get(segment[1], '')] for segment in segments]
+        result = await run_tool('document', combined_replace, document_path, replacements)
+    finally:
+        _progress.pop(translation_id, None)
+
+    translation_logger.info(
+        f"Translated {document_path} into {target_language}: {len(texts) - len(untranslated)}/{len(texts)} segments, "
+        f"{len(remembered)} from the translation memory, in {len(batches)} batches, {time.monotonic() - start:.1f}s"
+    )
+    return {
+        **result,
+        'translated_segments': len(texts) - len(untranslated),
+        'remembered_segments': len(remembered),
+        'untranslated_count': len(untranslated),
+        'untranslated_segments': untranslated[:UNTRANSLATED_REPORT_LIMIT],
+        'batches': len(batches),
+    }
@@ -1,34 +1,61 @@
-import os
-from llama_index.llms.azure_inference import AzureAICompletionsModel
+import re
+import json
+from llama_index.core.llms import ChatMessage
+
+SYSTEM_PROMPT = """You are a translator, able to translate documents to and from many different languages.
+        You will be given a string of text to translate, and a target language. You should translate the text into
+        the target language making sure to preserve as its context."""
+
+BATCH_SYSTEM_PROMPT = """You are a translator, able to translate documents to and from many different languages.
+        You will be given a JSON list of text segments from one document, and a target language. Translate every
+        segment into the target language, keeping the document's context and each segment's punctuation and numbering.
+        Answer with a JSON list of strings only: exactly one translation per segment, in the same order."""
 
-from deep_translator import GoogleTranslator
 
-# def translate_with_llm(text: str, target_language: str):
-#     try:
-#         translation = GoogleTranslator(source='auto', target=target_language).translate(text)
-#         if translation:
-#             return translation
-#         return "There was some kind of issue and the translation didn't happen..."
-#     except Exception as e:
-#         return f"There was an error: {e}"
+def get_translator_llm():
+    """The agent's shared LLM, so translations run on whichever backend get_llm() selected."""
+    # Imported here, core imports the tools
+    from core import get_shared_llm
+    return get_shared_llm()
+
 
 def translate_with_llm(text_to_translate: str, target_language: str):
     try:
-        system_prompt = """You are a translator, able to translate documents to and from many different languages.
-        You will be given a string of text to translate, and a target language. You should translate the text into
-        the target language making sure to preserve as its context."""
-
-        translator_llm = AzureAICompletionsModel(
-            endpoint=os.getenv('MODEL_ENDPOINT', ''),
-            credential=os.getenv("MODEL_API_KEY", ""),
-            model_name=os.getenv('MODEL_NAME', ''),
-            timeout=float(os.getenv('MODEL_TIMEOUT', 300.00)),
-            system_prompt=system_prompt
-        )
         full_message = f"TEXT: {text_to_translate} \n\n TARGET_LANGUAGE: {target_language}"
-        response = translator_llm.chat(full_message)
-        if not isinstance(response, (dict, list)):
-            response = str(response)
-        return response
+        response = get_translator_llm().chat([
+            ChatMessage(role="system", content=SYSTEM_PROMPT),
+            ChatMessage(role="user", content=full_message),
+        ])
+        return str(response.message.content)
     except Exception as e:
-        return e
\ No newline at end of file
+        return e
+
+
+async def atranslate_segments(texts: list[str], target_language: str) -> list[str]:
+    """
+    Translates a batch of text segments in one LLM call.
+
+    Args:
+        texts (list[str]): The segments to translate.
+        target_language (str): The language to translate into.
+
+    Returns:
+        list[str]: One translation per segment, in the same order.
+
+    Raises:
+        ValueError: If the model's answer isn't a JSON list with one string per segment.
+    """
+    full_message = f"SEGMENTS: {json.dumps(texts, ensure_ascii=False)} \n\n TARGET_LANGUAGE: {target_language}"
+    response = await get_translator_llm().achat([
+        ChatMessage(role="system", content=BATCH_SYSTEM_PROMPT),
+        ChatMessage(role="user", content=full_message),
+    ])
+    content = str(response.message.content)
+
+    match = re.search(r"\[.*\]", content, re.DOTALL)
+    if not match:
+        raise ValueError("The translation isn't a JSON list")
+    translations = json.loads(match.group(0))
+    if not isinstance(translations, list) or len(translations) != len(texts):
+        raise ValueError(f"Expected {len(texts)} translations, got {len(translations)}")
+    return [str(translation) for translation in translations]